@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the hot paths of the import process.
+"""
+import re
+import time
+import argparse
+from collections import defaultdict
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from fiftystates import utils
+from fiftystates.backend import db
+from fiftystates.backend.names import NameResolver
+from fiftystates.backend.utils import (prepare_obj, convert_timestamps,
+                                       split_name, make_plus_fields)
+
+
+def _timed(func, objs):
+    start = time.time()
+    results = [func(obj) for obj in objs]
+    return time.time() - start, results
+
+
+def large_bill(actions=500, votes=50, voters=100):
+    """
+    Build a JSON-encoded bill shaped like scraper output, with many
+    actions and roll calls.
+    """
+    ts = 1280000000
+    source = {'url': 'http://example.com/bill', 'retrieved': ts}
+    bill = {'_type': 'bill', 'state': 'ex', 'session': '2009-2010',
+            'chamber': 'lower', 'bill_id': 'HB 1', 'title': 'A bill',
+            'type': ['bill'], 'alternate_titles': [], 'documents': [],
+            '+extra': 'field', 'sources': [source],
+            'sponsors': [{'type': 'primary', 'name': 'Smith'}],
+            'versions': [{'name': 'Introduced',
+                          'url': 'http://example.com/v1'}],
+            'actions': [], 'votes': []}
+
+    for i in xrange(actions):
+        bill['actions'].append({'date': ts + i, 'actor': 'lower',
+                                'action': 'Action %d' % i,
+                                'type': ['other'], 'extra': i})
+
+    for i in xrange(votes):
+        names = ['Legislator %d' % n for n in xrange(voters)]
+        bill['votes'].append({'date': ts + i, 'chamber': 'lower',
+                              'motion': 'Motion %d' % i, 'passed': True,
+                              'type': 'other', 'yes_count': voters,
+                              'no_count': 0, 'other_count': 0,
+                              'yes_votes': names, 'no_votes': [],
+                              'other_votes': [], 'sources': [source],
+                              'threshold': '1/2'})
+
+    return json.dumps(bill)
+
+
+def bench_prepare(count=50, **kwargs):
+    """
+    Compare prepare_obj against the old three-pass preparation
+    (convert_timestamps, split_name and make_plus_fields) on large bills.
+    """
+    def three_pass(obj):
+        convert_timestamps(obj)
+        split_name(obj)
+        return make_plus_fields(obj)
+
+    encoded = large_bill(**kwargs)
+
+    old_time, old = _timed(three_pass,
+                           [json.loads(encoded) for i in xrange(count)])
+    new_time, new = _timed(prepare_obj,
+                           [json.loads(encoded) for i in xrange(count)])
+
+    assert old == new, "prepare_obj output differs from three-pass output"
+
+    print 'three-pass:  %.2f ms/bill' % (old_time * 1000 / count)
+    print 'prepare_obj: %.2f ms/bill' % (new_time * 1000 / count)
+
+
+def bench_names(state, session, count=100000):
+    """
+    Time building a state's NameResolver, from the database and from the
+    on-disk cache, and resolving ``count`` roll-call names from a
+    session's votes one at a time and in batches.
+    """
+    names = []
+    for bill in db.bills.find({'state': state, 'session': session},
+                              ['votes']):
+        for vote in bill['votes']:
+            for vtype in ('yes_votes', 'no_votes', 'other_votes'):
+                names.extend((vote['chamber'], v['name'])
+                             for v in vote[vtype])
+
+    if not names:
+        print 'no roll call names found for %s %s' % (state, session)
+        return
+
+    names = (names * (count // len(names) + 1))[:count]
+
+    start = time.time()
+    resolver = NameResolver(state)
+    print 'build:    %.2f ms' % ((time.time() - start) * 1000)
+
+    if NameResolver.cache_path(state):
+        resolver.save(NameResolver.cache_path(state))
+        start = time.time()
+        NameResolver.load(state)
+        print 'load:     %.2f ms' % ((time.time() - start) * 1000)
+
+    start = time.time()
+    for chamber, name in names:
+        resolver.resolve(session, chamber, name)
+    print 'resolve:  %.2f ms for %d names' % ((time.time() - start) * 1000,
+                                             count)
+
+    start = time.time()
+    by_chamber = defaultdict(list)
+    for chamber, name in names:
+        by_chamber[chamber].append(name)
+    resolved = 0
+    for chamber, chamber_names in by_chamber.iteritems():
+        ids = resolver.resolve_many(session, chamber, chamber_names)
+        resolved += sum(1 for name in chamber_names if ids[name])
+    print 'batch:    %.2f ms for %d names (%d matched)' % (
+        (time.time() - start) * 1000, count, resolved)
+
+
+def _old_keywordize(str):
+    # keywordize as it was before the Analyzer, for comparison
+    return set([utils.jellyfish.porter_stem(word.lower().encode('ascii',
+                                                                'ignore'))
+                for word in re.split(r"[\s.,!?'\"`()]+", str)
+                if (word.isalpha() or word.isdigit()) and
+                word.lower() not in utils.stop_words])
+
+
+def bench_keywordize(state, count=1):
+    """
+    Compare the old keywordize with the Analyzer (one call per title
+    and keywordize_many) on every title and alternate title of a state's
+    bills, repeated ``count`` times.
+    """
+    titles = []
+    for bill in db.bills.find({'state': state},
+                              ['title', 'alternate_titles']):
+        titles.append(bill['title'])
+        titles.extend(bill.get('alternate_titles', []))
+
+    if not titles:
+        print 'no bill titles found for %s' % state
+        return
+
+    titles = titles * count
+
+    old_time, old = _timed(_old_keywordize, titles)
+
+    utils.analyzer = utils.Analyzer()
+    new_time, new = _timed(utils.keywordize, titles)
+
+    utils.analyzer = utils.Analyzer()
+    start = time.time()
+    batch = utils.keywordize_many(titles)
+    batch_time = time.time() - start
+
+    assert old == new == batch, "Analyzer output differs from keywordize"
+
+    print '%d titles' % len(titles)
+    print 'old keywordize:  %.2f ms' % (old_time * 1000)
+    print 'keywordize:      %.2f ms' % (new_time * 1000)
+    print 'keywordize_many: %.2f ms' % (batch_time * 1000)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='run import micro-benchmarks')
+    parser.add_argument('benchmark', choices=['prepare', 'names',
+                                                 'keywordize'],
+                        help='the benchmark to run')
+    parser.add_argument('-n', '--count', type=int,
+                        help='number of iterations')
+    parser.add_argument('--state', type=str,
+                        help='state to use for database benchmarks')
+    parser.add_argument('--session', type=str,
+                        help='session to use for database benchmarks')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'prepare':
+        bench_prepare(args.count or 50)
+    elif args.benchmark == 'names':
+        bench_names(args.state, args.session, args.count or 100000)
+    elif args.benchmark == 'keywordize':
+        bench_keywordize(args.state, args.count or 1)
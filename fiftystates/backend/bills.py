@@ -6,18 +6,23 @@ import sys
 import time
 import glob
 import datetime
+from collections import defaultdict
 
 try:
     import json
 except:
     import simplejson as json
 
-from fiftystates.utils import keywordize
+from fiftystates.utils import keywordize_many
 from fiftystates.backend import db
 from fiftystates.backend.names import get_legislator_id
-from fiftystates.backend.utils import (insert_with_id,
-                                       update, prepare_obj,
-                                       get_committee_id)
+from fiftystates.backend.pipeline import (load_objects, batched,
+                                          skip_unchanged, format_counts)
+from fiftystates.backend.committees import CommitteeDirectory
+from fiftystates.search.titles import update_title_index
+from fiftystates.backend.utils import (insert_with_id, update,
+                                       load_content_hashes,
+                                       collection_version, prune_objects)
 
 import pymongo
 
@@ -44,9 +49,22 @@ def ensure_indexes():
                            ('session', pymongo.ASCENDING),
                            ('chamber', pymongo.ASCENDING),
                            ('sponsors', pymongo.ASCENDING)])
+    db.bills.ensure_index([('state', pymongo.ASCENDING),
+                           ('updated_at', pymongo.ASCENDING),
+                           ('_id', pymongo.ASCENDING)])
+    db.bills.ensure_index([('updated_at', pymongo.ASCENDING),
+                           ('_id', pymongo.ASCENDING)])
+
+    # search results are paged in _id order
+    db.bills.ensure_index([('state', pymongo.ASCENDING),
+                           ('_id', pymongo.ASCENDING)])
+    for field in ('session', '_current_session', '_current_term'):
+        db.bills.ensure_index([('state', pymongo.ASCENDING),
+                               (field, pymongo.ASCENDING),
+                               ('_id', pymongo.ASCENDING)])
 
 
-def import_bills(state, data_dir):
+def import_bills(state, data_dir, prune=False):
     data_dir = os.path.join(data_dir, state)
     pattern = os.path.join(data_dir, 'bills', '*.json')
 
@@ -60,76 +78,120 @@ def import_bills(state, data_dir):
 
     paths = glob.glob(pattern)
 
-    for path in paths:
-        with open(path) as f:
-            data = prepare_obj(json.load(f))
-
-        bill = db.bills.find_one({'state': data['state'],
-                                  'session': data['session'],
-                                  'chamber': data['chamber'],
-                                  'bill_id': data['bill_id']})
-
-        for sponsor in data['sponsors']:
-            id = get_legislator_id(state, data['session'], None,
-                                   sponsor['name'])
-            sponsor['leg_id'] = id
-
-        for vote in data['votes']:
-            if 'committee' in vote:
-                committee_id = get_committee_id(state,
-                                                vote['chamber'],
-                                                vote['committee'])
-                vote['committee_id'] = committee_id
-
-            for vtype in ('yes_votes', 'no_votes', 'other_votes'):
-                svlist = []
-                for svote in vote[vtype]:
-                    id = get_legislator_id(state, data['session'],
-                                           vote['chamber'], svote)
-                    svlist.append({'name': svote, 'leg_id': id})
-
-                vote[vtype] = svlist
-
-        data['_term'] = sessions[data['session']]
-
-        # Merge any version titles into the alternate_titles list
-        alt_titles = set(data.get('alternate_titles', []))
-        for version in data['versions']:
-            if 'title' in version:
-                alt_titles.add(version['title'])
-            if '+short_title' in version:
-                alt_titles.add(version['+short_title'])
-        try:
-            # Make sure the primary title isn't included in the
-            # alternate title list
-            alt_titles.remove(data['title'])
-        except KeyError:
-            pass
-        data['alternate_titles'] = list(alt_titles)
-
-        if not bill:
-            data['created_at'] = datetime.datetime.utcnow()
-            data['updated_at'] = data['created_at']
-            data['_keywords'] = list(bill_keywords(data))
-            insert_with_id(data)
-        else:
-            data['_keywords'] = list(bill_keywords(data))
-            update(bill, data, db.bills)
-
-    print 'imported %s bill files' % len(paths)
+    # sponsor and vote ids are resolved against legislators and
+    # committees, so a bill needs reimporting whenever those change
+    salt = collection_version(state, db.legislators, db.committees)
+    hashes = load_content_hashes(db.bills, state)
+    committees = CommitteeDirectory(state)
+    counts = defaultdict(int)
+    changed_sessions = set()
+    seen = set()
+
+    objs = skip_unchanged(load_objects(paths, salt), hashes, counts, seen)
+    for batch in batched(objs):
+        existing = find_existing_bills(state, batch)
+        for data in batch:
+            key = (data['session'], data['chamber'], data['bill_id'])
+            bill = existing.get(key)
+
+            if not import_bill(state, data, bill, sessions, committees):
+                counts['unchanged'] += 1
+                continue
+            elif bill:
+                counts['updated'] += 1
+            else:
+                counts['inserted'] += 1
+                existing[key] = data
+            changed_sessions.add(data['session'])
+
+    print 'imported %s bill files (%s)' % (len(paths),
+                                            format_counts(counts))
+
+    # an empty scrape is more likely a failed one than an empty state
+    if prune and paths:
+        removed = prune_objects(db.bills, state, seen)
+        changed_sessions.update(bill['session'] for bill in removed)
+        print 'removed %d bills missing from the scraped data' % (
+            len(removed))
 
     populate_current_fields(state)
     ensure_indexes()
+    update_title_index(state, changed_sessions)
+
+
+def find_existing_bills(state, batch):
+    """
+    Fetch the stored versions of a batch of scraped bills with a single
+    query, keyed by (session, chamber, bill_id).
+    """
+    spec = {'state': state,
+            'session': {'$in': list(set(b['session'] for b in batch))},
+            'bill_id': {'$in': list(set(b['bill_id'] for b in batch))}}
+
+    return dict(((bill['session'], bill['chamber'], bill['bill_id']), bill)
+                for bill in db.bills.find(spec))
+
+
+def import_bill(state, data, bill, sessions, committees):
+    """
+    Import a single prepared bill, given the currently stored copy (if
+    any) and the state's CommitteeDirectory. Returns True if the bill was
+    inserted or changed.
+    """
+    for sponsor in data['sponsors']:
+        id = get_legislator_id(state, data['session'], None,
+                               sponsor['name'])
+        sponsor['leg_id'] = id
+
+    for vote in data['votes']:
+        if 'committee' in vote:
+            committee_id = committees.get_id(vote['chamber'],
+                                             vote['committee'])
+            vote['committee_id'] = committee_id
+
+        for vtype in ('yes_votes', 'no_votes', 'other_votes'):
+            svlist = []
+            for svote in vote[vtype]:
+                id = get_legislator_id(state, data['session'],
+                                       vote['chamber'], svote)
+                svlist.append({'name': svote, 'leg_id': id})
+
+            vote[vtype] = svlist
+
+    data['_term'] = sessions[data['session']]
+
+    # Merge any version titles into the alternate_titles list
+    alt_titles = set(data.get('alternate_titles', []))
+    for version in data['versions']:
+        if 'title' in version:
+            alt_titles.add(version['title'])
+        if '+short_title' in version:
+            alt_titles.add(version['+short_title'])
+    try:
+        # Make sure the primary title isn't included in the
+        # alternate title list
+        alt_titles.remove(data['title'])
+    except KeyError:
+        pass
+    data['alternate_titles'] = list(alt_titles)
+
+    if not bill:
+        data['created_at'] = datetime.datetime.utcnow()
+        data['updated_at'] = data['created_at']
+        data['_keywords'] = list(bill_keywords(data))
+        insert_with_id(data)
+        return True
+    else:
+        data['_keywords'] = list(bill_keywords(data))
+        return update(bill, data, db.bills)
 
 
 def bill_keywords(bill):
     """
     Get the keyword set for all of a bill's titles.
     """
-    keywords = keywordize(bill['title'])
-    for title in bill['alternate_titles']:
-        keywords = keywords.union(keywordize(title))
-    return keywords
+    return set().union(*keywordize_many([bill['title']] +
+                                        bill['alternate_titles']))
 
 
 def populate_current_fields(state):
@@ -4,6 +4,7 @@ import os
 import sys
 import glob
 import datetime
+from collections import defaultdict
 
 try:
     import json
@@ -11,19 +12,42 @@ except:
     import simplejson as json
 
 from fiftystates.backend import db
-from fiftystates.backend.utils import prepare_obj, update, insert_with_id
+from fiftystates.backend.utils import (update, insert_with_id,
+                                       load_content_hashes,
+                                       collection_version, norm_fields,
+                                       populate_norm_fields, prune_objects)
+from fiftystates.backend.legislators import NORM_ROLE_FIELDS
+from fiftystates.backend.pipeline import (load_objects, skip_unchanged,
+                                          format_counts)
 
 import pymongo
 import name_tools
 
 
+# fields stored lowercased in '_norm' for case-insensitive searches
+NORM_FIELDS = ('committee', 'subcommittee')
+
+
 def ensure_indexes():
+    db.committees.ensure_index('_all_ids', pymongo.ASCENDING)
     db.committees.ensure_index([('state', pymongo.ASCENDING),
                                 ('committee', pymongo.ASCENDING),
                                 ('subcommittee', pymongo.ASCENDING)])
+    db.committees.ensure_index([('state', pymongo.ASCENDING),
+                                ('updated_at', pymongo.ASCENDING),
+                                ('_id', pymongo.ASCENDING)])
+    db.committees.ensure_index([('updated_at', pymongo.ASCENDING),
+                                ('_id', pymongo.ASCENDING)])
+
+    # search results are paged in _id order
+    db.committees.ensure_index([('state', pymongo.ASCENDING),
+                                ('_id', pymongo.ASCENDING)])
+    db.committees.ensure_index([('state', pymongo.ASCENDING),
+                                ('_norm.committee', pymongo.ASCENDING),
+                                ('_norm.subcommittee', pymongo.ASCENDING)])
 
 
-def import_committees(state, data_dir):
+def import_committees(state, data_dir, prune=False):
     data_dir = os.path.join(data_dir, state)
     pattern = os.path.join(data_dir, 'committees', '*.json')
 
@@ -34,92 +58,75 @@ def import_committees(state, data_dir):
 
     if not paths:
         # Not standalone committees
-        for legislator in db.legislators.find({
-            'roles': {'$elemMatch': {'term': current_term,
-                                     'state': state}}}):
-
-            for role in legislator['roles']:
-                if (role['type'] == 'committee member' and
-                    'committee_id' not in role):
-
-                    spec = {'state': role['state'],
-                            'chamber': role['chamber'],
-                            'committee': role['committee']}
-                    if 'subcommittee' in role:
-                        spec['subcommittee'] = role['subcommittee']
-
-                    committee = db.committees.find_one(spec)
-
-                    if not committee:
-                        committee = spec
-                        committee['_type'] = 'committee'
-                        committee['members'] = []
-                        committee['sources'] = []
-                        insert_with_id(committee)
-
-                    for member in committee['members']:
-                        if member['leg_id'] == legislator['leg_id']:
-                            break
-                    else:
-                        committee['members'].append(
-                            {'name': legislator['full_name'],
-                             'leg_id': legislator['leg_id'],
-                             'role': 'member'})
-                        db.committees.save(committee, safe=True)
-
-                        role['committee_id'] = committee['_id']
-
-            db.legislators.save(legislator, safe=True)
-
-    for path in paths:
-        with open(path) as f:
-            data = prepare_obj(json.load(f))
-
-        spec = {'state': state,
-                'chamber': data['chamber'],
-                'committee': data['committee']}
-        if 'subcommittee' in data:
-            spec['subcommittee'] = data['subcommittee']
-
-        committee = db.committees.find_one(spec)
-
-        if not committee:
-            insert_with_id(data)
-            committee = data
-        else:
-            update(committee, data, db.committees)
-
-        for member in committee['members']:
+        committees_from_roles(state, current_term)
+
+    legislators, by_name = load_legislators(state, current_term)
+    new_roles = defaultdict(list)
+
+    # members are matched against legislators, so a committee needs
+    # reimporting whenever they change
+    salt = collection_version(state, db.legislators)
+    hashes = load_content_hashes(db.committees, state)
+    counts = defaultdict(int)
+    seen = set()
+
+    # a state has few enough committees to look them all up at once
+    existing = defaultdict(list)
+    for committee in db.committees.find({'state': state}):
+        existing[(committee['chamber'],
+                  committee['committee'])].append(committee)
+
+    for data in skip_unchanged(load_objects(paths, salt), hashes, counts,
+                               seen):
+        candidates = existing[(data['chamber'], data['committee'])]
+
+        # resolve members before writing so that the leg_ids go out
+        # with the rest of the committee
+        for member in data['members']:
             if not member['name']:
                 continue
 
             (pre, first, last, suff) = name_tools.split(member['name'])
+            ids = by_name.get((first, last), [])
 
-            found = db.legislators.find({
-                    'first_name': first,
-                    'last_name': last,
-                    'roles': {'$elemMatch': {'term': current_term,
-                                             'state': state}}})
-
-            if found.count() > 1:
+            if len(ids) > 1:
                 print "Too many matches for %s" % member['name'].encode(
                     'ascii', 'ignore')
                 member['leg_id'] = None
-                continue
-            elif found.count() == 0:
+            elif not ids:
                 print "No matches for %s" % member['name'].encode(
                     'ascii', 'ignore')
                 member['leg_id'] = None
-                continue
+            else:
+                member['leg_id'] = ids[0]
 
-            legislator = found[0]
+        committee = None
+        for candidate in candidates:
+            if ('subcommittee' not in data or
+                candidate.get('subcommittee') == data['subcommittee']):
+                committee = candidate
+                break
 
-            member['leg_id'] = legislator['_id']
+        if not committee:
+            insert_with_id(data)
+            committee = data
+            candidates.append(data)
+            counts['inserted'] += 1
+        elif update(committee, data, db.committees):
+            counts['updated'] += 1
+        else:
+            counts['unchanged'] += 1
+
+        for member in committee['members']:
+            if not member.get('leg_id'):
+                continue
+
+            legislator = legislators[member['leg_id']]
 
             for role in legislator['roles']:
                 if (role['type'] == 'committee member' and
                     role['term'] == current_term and
-                    role['committee_id'] == committee['_id']):
+                    role.get('committee_id') == committee['_id']):
                     break
             else:
                 new_role = {'type': 'committee member',
@@ -130,32 +137,194 @@ def import_committees(state, data_dir):
                             'state': state}
                 if 'subcommittee' in committee:
                     new_role['subcommittee'] = committee['subcommittee']
+                new_role['_norm'] = norm_fields(new_role, NORM_ROLE_FIELDS)
                 legislator['roles'].append(new_role)
-                legislator['updated_at'] = datetime.datetime.utcnow()
-                db.legislators.save(legislator, safe=True)
-
-        db.committees.save(committee, safe=True)
-
-    print 'imported %s committee files' % len(paths)
+                new_roles[legislator['_id']].append(new_role)
+
+    # one write per legislator for all of their new committee roles
+    now = datetime.datetime.utcnow()
+    for leg_id, roles in new_roles.iteritems():
+        db.legislators.update({'_id': leg_id},
+                              {'$pushAll': {'roles': roles},
+                               '$set': {'updated_at': now}},
+                              safe=True)
+
+    print 'imported %s committee files (%s)' % (len(paths),
+                                                 format_counts(counts))
+
+    # committees created from roles have no content hash, so only
+    # standalone committees are ever pruned
+    if prune and paths:
+        removed = prune_objects(db.committees, state, seen)
+        print 'removed %d committees missing from the scraped data' % (
+            len(removed))
 
     link_parents(state)
+    populate_norm_fields(db.committees, state, NORM_FIELDS)
 
     ensure_indexes()
 
 
+def load_legislators(state, term):
+    """
+    Load a state's legislators for the given term in one query.
+
+    Returns a dictionary of legislators keyed by _id and an index mapping
+    (first_name, last_name) to the matching legislator ids.
+    """
+    legislators = {}
+    by_name = defaultdict(list)
+
+    for legislator in db.legislators.find(
+            {'roles': {'$elemMatch': {'term': term, 'state': state}}},
+            ['first_name', 'last_name', 'full_name', 'leg_id', 'roles']):
+        legislators[legislator['_id']] = legislator
+        by_name[(legislator['first_name'],
+                 legislator['last_name'])].append(legislator['_id'])
+
+    return legislators, by_name
+
+
+def committees_from_roles(state, term):
+    """
+    For states without standalone committee data, create committees
+    from the committee member roles of the term's legislators.
+    """
+    committees = {}
+    for committee in db.committees.find({'state': state},
+                                        ['chamber', 'committee',
+                                         'subcommittee', 'members']):
+        key = (committee['chamber'], committee['committee'],
+               committee.get('subcommittee'))
+        committees[key] = committee
+
+    new_members = defaultdict(list)
+    now = datetime.datetime.utcnow()
+
+    for legislator in db.legislators.find({
+        'roles': {'$elemMatch': {'term': term,
+                                 'state': state}}},
+        ['full_name', 'leg_id', 'roles']):
+
+        roles_changed = False
+
+        for role in legislator['roles']:
+            if (role['type'] == 'committee member' and
+                'committee_id' not in role):
+
+                key = (role['chamber'], role['committee'],
+                       role.get('subcommittee'))
+
+                try:
+                    committee = committees[key]
+                except KeyError:
+                    committee = {'state': role['state'],
+                                 'chamber': role['chamber'],
+                                 'committee': role['committee']}
+                    if 'subcommittee' in role:
+                        committee['subcommittee'] = role['subcommittee']
+                    committee['_type'] = 'committee'
+                    committee['members'] = []
+                    committee['sources'] = []
+                    committee['created_at'] = now
+                    committee['updated_at'] = now
+                    insert_with_id(committee)
+                    committees[key] = committee
+
+                for member in committee['members']:
+                    if member['leg_id'] == legislator['leg_id']:
+                        break
+                else:
+                    member = {'name': legislator['full_name'],
+                              'leg_id': legislator['leg_id'],
+                              'role': 'member'}
+                    committee['members'].append(member)
+                    new_members[committee['_id']].append(member)
+
+                role['committee_id'] = committee['_id']
+                roles_changed = True
+
+        if roles_changed:
+            db.legislators.update({'_id': legislator['_id']},
+                                  {'$set': {'roles': legislator['roles'],
+                                            'updated_at': now}},
+                                  safe=True)
+
+    for committee_id, members in new_members.iteritems():
+        db.committees.update({'_id': committee_id},
+                             {'$pushAll': {'members': members},
+                              '$set': {'updated_at': now}},
+                             safe=True)
+
+
 def link_parents(state):
-    for comm in db.committees.find({'state': state}):
+    CommitteeDirectory(state).link_parents()
+
+
+class CommitteeDirectory(object):
+    """
+    All of a state's committees, loaded with a single query, for looking
+    up committee ids and parents in memory.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.committees = {}
+        self._ids = defaultdict(list)
+
+        for comm in db.committees.find({'state': state},
+                                       ['chamber', 'committee',
+                                        'subcommittee', 'parent_id']):
+            self.committees[comm['_id']] = comm
+            self._ids[(comm['chamber'], comm['committee'],
+                       comm.get('subcommittee'))].append(comm['_id'])
+
+    def get_id(self, chamber, committee, subcommittee=None):
+        """
+        Get the id of the committee with the given name, also trying
+        'Committee on <name>'. Returns None unless exactly one committee
+        matches.
+        """
+        ids = self._ids.get((chamber, committee, subcommittee), [])
+
+        if len(ids) != 1:
+            ids = self._ids.get((chamber, 'Committee on ' + committee,
+                                 subcommittee), [])
+
+        if len(ids) == 1:
+            return ids[0]
+        return None
+
+    def get_parent_id(self, comm):
+        """
+        Get the id of a subcommittee's parent committee, or None for
+        top-level committees.
+        """
         sub = comm.get('subcommittee')
         if not sub:
-            comm['parent_id'] = None
-        else:
-            parent = db.committees.find_one({'state': state,
-                                             'chamber': comm['chamber'],
-                                             'committee': comm['committee']})
-            if not parent:
-                print "Failed finding parent for: %s" % sub
-                comm['parent_id'] = None
-            else:
-                comm['parent_id'] = parent['_id']
-
-        db.committees.save(comm)
+            return None
+
+        ids = self._ids.get((comm['chamber'], comm['committee'], None))
+        if not ids:
+            print "Failed finding parent for: %s" % sub
+            return None
+        return ids[0]
+
+    def link_parents(self):
+        """
+        Set parent_id on all of the state's committees, writing only the
+        ones that changed with one update per parent.
+        """
+        changed = defaultdict(list)
+        for comm in self.committees.itervalues():
+            parent_id = self.get_parent_id(comm)
+            if 'parent_id' not in comm or comm['parent_id'] != parent_id:
+                comm['parent_id'] = parent_id
+                changed[parent_id].append(comm['_id'])
+
+        now = datetime.datetime.utcnow()
+        for parent_id, ids in changed.iteritems():
+            db.committees.update({'_id': {'$in': ids}},
+                                 {'$set': {'parent_id': parent_id,
+                                           'updated_at': now}},
+                                 multi=True, safe=True)
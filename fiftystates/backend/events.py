@@ -4,6 +4,7 @@ import sys
 import glob
 import logging
 import datetime
+from collections import defaultdict
 
 try:
     import json
@@ -12,7 +13,11 @@ except:
 
 from fiftystates.backend import db
 from fiftystates.backend.names import get_legislator_id
-from fiftystates.backend.utils import prepare_obj, update, get_committee_id
+from fiftystates.backend.utils import (update, load_content_hashes,
+                                       content_hash, prune_objects)
+from fiftystates.backend.pipeline import (load_objects, skip_unchanged,
+                                          format_counts, batched,
+                                          BATCH_SIZE)
 from fiftystates.scrape.events import Event
 
 import pymongo
@@ -26,17 +31,34 @@ def ensure_indexes():
     db.events.ensure_index([('when', pymongo.DESCENDING),
                             ('state', pymongo.ASCENDING),
                             ('type', pymongo.ASCENDING)])
-
-
-def _insert_with_id(event):
-    query = SON([('_id', event['state'])])
-    update = SON([('$inc', SON([('seq', 1)]))])
+    db.events.ensure_index([('state', pymongo.ASCENDING),
+                            ('_guid', pymongo.ASCENDING)])
+    db.events.ensure_index([('state', pymongo.ASCENDING),
+                            ('updated_at', pymongo.ASCENDING),
+                            ('_id', pymongo.ASCENDING)])
+    db.events.ensure_index([('updated_at', pymongo.ASCENDING),
+                            ('_id', pymongo.ASCENDING)])
+
+
+def _reserve_ids(state, count=1):
+    """
+    Reserve ``count`` sequential event ids for a state, returning the
+    sequence number of the first one.
+    """
+    query = SON([('_id', state)])
+    update = SON([('$inc', SON([('seq', count)]))])
     seq = db.command(SON([('findandmodify', 'event_ids'),
                           ('query', query),
                           ('update', update),
                           ('new', True),
                           ('upsert', True)]))['value']['seq']
 
+    return seq - count + 1
+
+
+def _insert_with_id(event):
+    seq = _reserve_ids(event['state'])
+
     id = "%sE%08d" % (event['state'].upper(), seq)
     logging.info("Saving as %s" % id)
 
@@ -46,49 +68,138 @@ def _insert_with_id(event):
     return id
 
 
-def import_events(state, data_dir):
+def import_events(state, data_dir, prune=False):
     data_dir = os.path.join(data_dir, state)
     pattern = os.path.join(data_dir, 'events', '*.json')
 
-    for path in glob.iglob(pattern):
-        with open(path) as f:
-            data = prepare_obj(json.load(f))
-
-        event = None
-        if '_guid' in data:
-            event = db.events.find_one({'state': data['state'],
-                                        '_guid': data['_guid']})
-
-        if not event:
-            event = db.events.find_one({'state': data['state'],
-                                        'when': data['when'],
-                                        'end': data['end'],
-                                        'type': data['type'],
-                                        'description': data['description']})
-
-        if not event:
-            data['created_at'] = datetime.datetime.utcnow()
-            data['updated_at'] = data['created_at']
-            _insert_with_id(data)
-        else:
-            update(event, data, db.events)
+    paths = glob.glob(pattern)
+
+    hashes = load_content_hashes(db.events, state)
+    counts = defaultdict(int)
+    seen = set()
+
+    objs = skip_unchanged(load_objects(paths, ''), hashes, counts, seen)
+    for batch in batched(objs):
+        by_guid, by_when = find_existing_events(state, batch)
+        for data in batch:
+            event = None
+            if '_guid' in data:
+                event = by_guid.get(data['_guid'])
+
+            if not event:
+                for candidate in by_when[data['when']]:
+                    if all(candidate.get(key) == data[key] for key in
+                           ('end', 'type', 'description')):
+                        event = candidate
+                        break
+
+            if not event:
+                data['created_at'] = datetime.datetime.utcnow()
+                data['updated_at'] = data['created_at']
+                _insert_with_id(data)
+                counts['inserted'] += 1
+
+                # later files in the batch can match it
+                if '_guid' in data:
+                    by_guid.setdefault(data['_guid'], data)
+                by_when[data['when']].append(data)
+            elif update(event, data, db.events):
+                counts['updated'] += 1
+            else:
+                counts['unchanged'] += 1
+
+    print 'imported %s event files (%s)' % (len(paths),
+                                             format_counts(counts))
+
+    # bill:action events are derived from the bills' actions and kept up
+    # to date by actions_to_events, so they never appear in scraped files
+    if prune and paths:
+        removed = prune_objects(db.events, state, seen,
+                                {'type': {'$ne': 'bill:action'}})
+        print 'removed %d events missing from the scraped data' % (
+            len(removed))
 
     actions_to_events(state)
     ensure_indexes()
 
 
-def actions_to_events(state):
-    for bill in db.bills.find({'state': state}):
-        print "Converting %s actions to events" % bill['_id']
-
+def find_existing_events(state, batch):
+    """
+    Fetch the stored events that a batch of scraped events could match,
+    by _guid or by start time, with one query for each. Returns a dict
+    of events by _guid and lists of events keyed by start time.
+    """
+    guids = [event['_guid'] for event in batch if '_guid' in event]
+    by_guid = {}
+    if guids:
+        for event in db.events.find({'state': state, '_guid': {'$in': guids}}):
+            by_guid.setdefault(event['_guid'], event)
+
+    by_when = defaultdict(list)
+    spec = {'state': state,
+            'when': {'$in': list(set(event['when'] for event in batch))}}
+    for event in db.events.find(spec):
+        # share the copy found by _guid, so that updates to it are seen
+        same = by_guid.get(event.get('_guid'))
+        if same and same['_id'] == event['_id']:
+            event = same
+        by_when[event['when']].append(event)
+
+    return by_guid, by_when
+
+
+def _insert_many(state, events):
+    seq = _reserve_ids(state, len(events))
+    for event in events:
+        event['_id'] = "%sE%08d" % (state.upper(), seq)
+        seq += 1
+
+    db.events.insert(events, safe=True)
+
+
+def _replace_many(events):
+    """
+    Write changed events, which already carry their ``_id``, in one
+    remove and one batch insert.
+    """
+    db.events.remove({'_id': {'$in': [event['_id'] for event in events]}},
+                     safe=True)
+    db.events.insert(events, safe=True)
+
+
+def actions_to_events(state, full=False):
+    """
+    Create or update a 'bill:action' event for each action of a state's
+    bills.
+
+    Only bills updated since the last conversion are examined unless
+    ``full`` is True. Existing action events are preloaded in one query
+    and compared by content hash, new events are inserted in batches and
+    only changed events are written.
+    """
+    started = datetime.datetime.utcnow()
+
+    spec = {'state': state}
+    if not full:
+        status = db.event_ids.find_one({'_id': state}) or {}
+        if status.get('actions_converted_at'):
+            spec['updated_at'] = {'$gte': status['actions_converted_at']}
+
+    existing = {}
+    for event in db.events.find({'state': state, 'type': 'bill:action'},
+                                ['_guid', '_content_hash', 'created_at']):
+        existing[event['_guid']] = event
+
+    counts = defaultdict(int)
+    new_events = []
+    changed_events = []
+
+    for bill in db.bills.find(spec, ['bill_id', 'session', 'actions']):
         count = 1
         for action in bill['actions']:
             guid = "%s:action:%06d" % (bill['_id'], count)
             count += 1
 
-            event = db.events.find_one({'state': state,
-                                        '_guid': guid})
-
             description = "%s: %s" % (bill['bill_id'], action['action'])
             data = Event(bill['session'], action['date'],
                          'bill:action', description,
@@ -96,10 +207,43 @@ def actions_to_events(state):
             data.add_participant('actor', action['actor'])
             data['_guid'] = guid
             data['state'] = state
+            data['_content_hash'] = content_hash(data)
 
-            if not event:
+            if guid not in existing:
                 data['created_at'] = datetime.datetime.utcnow()
                 data['updated_at'] = data['created_at']
-                _insert_with_id(data)
+                new_events.append(data)
+                counts['inserted'] += 1
+
+                if len(new_events) >= BATCH_SIZE:
+                    _insert_many(state, new_events)
+                    new_events = []
             else:
-                update(event, data, db.events)
+                old = existing[guid]
+                if old.get('_content_hash') == data['_content_hash']:
+                    counts['unchanged'] += 1
+                    continue
+
+                # action events are generated in full from the bill, so
+                # the new document replaces the old one outright
+                data['_id'] = old['_id']
+                data['updated_at'] = datetime.datetime.utcnow()
+                data['created_at'] = old.get('created_at',
+                                             data['updated_at'])
+                changed_events.append(data)
+                counts['updated'] += 1
+
+                if len(changed_events) >= BATCH_SIZE:
+                    _replace_many(changed_events)
+                    changed_events = []
+
+    if new_events:
+        _insert_many(state, new_events)
+    if changed_events:
+        _replace_many(changed_events)
+
+    db.event_ids.update({'_id': state},
+                        {'$set': {'actions_converted_at': started}},
+                        upsert=True, safe=True)
+
+    print 'converted bill actions to events (%s)' % format_counts(counts)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+Store the SHA-256 of stored documents saved before documents were
+hashed, so that new downloads with the same content are deduplicated
+against them (see put_document and stream_document).
+"""
+import hashlib
+import argparse
+
+from fiftystates.backend import db, fs
+from fiftystates.backend.versions import ensure_indexes
+
+
+def hash_documents(state=None, chunk_size=256 * 1024):
+    """
+    Hash the stored files (of ``state``'s bills, if given) that have no
+    sha256, returning the number hashed.
+    """
+    spec = {'sha256': {'$exists': False}}
+    if state:
+        spec['metadata.bill.state'] = state
+
+    count = 0
+    for doc in db.documents.files.find(spec, ['_id']):
+        digest = hashlib.sha256()
+        f = fs.get(doc['_id'])
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            digest.update(chunk)
+
+        db.documents.files.update({'_id': doc['_id']},
+                                  {'$set': {'sha256': digest.hexdigest()}},
+                                  safe=True)
+        count += 1
+
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='store the hashes of previously stored documents')
+    parser.add_argument('states', metavar='STATE', type=str, nargs='*',
+                        help='states to update (default: all of them)')
+
+    args = parser.parse_args()
+
+    ensure_indexes()
+
+    for state in args.states or [None]:
+        print 'hashed %d documents' % hash_documents(state)
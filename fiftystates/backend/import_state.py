@@ -11,6 +11,7 @@ from fiftystates.backend.committees import import_committees
 from fiftystates.backend.votes import import_votes
 from fiftystates.backend.events import import_events
 from fiftystates.backend.versions import import_versions
+from fiftystates.backend.utils import bump_generation, ensure_indexes
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -28,7 +29,9 @@ if __name__ == '__main__':
                         help='the base Fifty State data directory')
     parser.add_argument('-r', '--rpm', type=int, default=60,
                         help=('maximum number of documents to download '
-                              'per minute'))
+                              'per minute from each host'))
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of concurrent version downloads')
     parser.add_argument('--bills', action='store_true',
                         help='scrape bill data')
     parser.add_argument('--legislators', action='store_true',
@@ -41,6 +44,9 @@ if __name__ == '__main__':
                         help='scrape event data')
     parser.add_argument('--versions', action='store_true',
                         help='pull down copies of bill versions')
+    parser.add_argument('--prune', action='store_true',
+                        help=('remove bills, legislators, committees and '
+                              'events whose scraped files are gone'))
 
     args = parser.parse_args()
 
@@ -65,20 +71,25 @@ if __name__ == '__main__':
     scrape_all = not any((args.bills, args.legislators, args.committees,
                           args.votes, args.events, args.versions))
 
+    ensure_indexes()
+
     # always import metadata
     import_metadata(args.state, data_dir)
 
     if args.legislators or scrape_all:
-        import_legislators(args.state, data_dir)
+        import_legislators(args.state, data_dir, args.prune)
     if args.bills or scrape_all:
-        import_bills(args.state, data_dir)
+        import_bills(args.state, data_dir, args.prune)
     if args.committees or scrape_all:
-        import_committees(args.state, data_dir)
+        import_committees(args.state, data_dir, args.prune)
     if args.votes or scrape_all:
         import_votes(args.state, data_dir)
 
     # events and versions currently excluded from scrape_all
     if args.events:
-        import_events(args.state, data_dir)
+        import_events(args.state, data_dir, args.prune)
     if args.versions:
-        import_versions(args.state, args.rpm)
+        import_versions(args.state, args.rpm, args.workers)
+
+    # invalidate the state's cached API responses
+    bump_generation(args.state)
@@ -4,6 +4,7 @@ import os
 import sys
 import glob
 import datetime
+from collections import defaultdict
 
 try:
     import json
@@ -11,12 +12,21 @@ except:
     import simplejson as json
 
 from fiftystates.backend import db
-from fiftystates.backend.utils import insert_with_id, update, prepare_obj
+from fiftystates.backend.utils import (insert_with_id, update,
+                                       load_content_hashes,
+                                       populate_norm_fields, prune_objects)
+from fiftystates.backend.pipeline import (load_objects, skip_unchanged,
+                                          format_counts, batched)
 
 import pymongo
 import name_tools
 
 
+# fields stored lowercased in '_norm' for case-insensitive searches
+NORM_FIELDS = ('first_name', 'last_name')
+NORM_ROLE_FIELDS = ('term', 'district', 'party')
+
+
 def ensure_indexes():
     db.legislators.ensure_index('_all_ids', pymongo.ASCENDING)
     db.legislators.ensure_index([('roles.state', pymongo.ASCENDING),
@@ -29,20 +39,54 @@ def ensure_indexes():
                                  ('middle_name', pymongo.ASCENDING),
                                  ('suffixes', pymongo.ASCENDING)],
                                 name='role_and_name_parts')
-
-
-def import_legislators(state, data_dir):
+    db.legislators.ensure_index([('state', pymongo.ASCENDING),
+                                 ('updated_at', pymongo.ASCENDING),
+                                 ('_id', pymongo.ASCENDING)])
+    db.legislators.ensure_index([('updated_at', pymongo.ASCENDING),
+                                 ('_id', pymongo.ASCENDING)])
+
+    # search results are paged in _id order
+    db.legislators.ensure_index([('state', pymongo.ASCENDING),
+                                 ('_id', pymongo.ASCENDING)])
+    db.legislators.ensure_index([('state', pymongo.ASCENDING),
+                                 ('active', pymongo.ASCENDING),
+                                 ('_id', pymongo.ASCENDING)])
+    for field in ('_norm.first_name', '_norm.last_name',
+                  'roles._norm.district', 'roles._norm.term'):
+        db.legislators.ensure_index([('state', pymongo.ASCENDING),
+                                     (field, pymongo.ASCENDING)])
+
+
+def import_legislators(state, data_dir, prune=False):
     data_dir = os.path.join(data_dir, state)
     pattern = os.path.join(data_dir, 'legislators', '*.json')
     paths = glob.glob(pattern)
-    for path in paths:
-        with open(path) as f:
-            data = prepare_obj(json.load(f))
-
-        import_legislator(data)
 
-    print 'imported %s legislator files' % len(paths)
+    meta = db.metadata.find_one({'_id': state})
+    term_names = [t['name'] for t in meta['terms']]
+
+    hashes = load_content_hashes(db.legislators, state)
+    counts = defaultdict(int)
+    seen = set()
+
+    objs = skip_unchanged(load_objects(paths, ''), hashes, counts, seen)
+    for batch in batched(objs):
+        existing = find_existing_legislators(state, batch)
+        for data in batch:
+            counts[import_legislator(data, existing[data['full_name']],
+                                     term_names)] += 1
+
+    print 'imported %s legislator files (%s)' % (len(paths),
+                                                  format_counts(counts))
+
+    if prune and paths:
+        removed = prune_objects(db.legislators, state, seen)
+        print 'removed %d legislators missing from the scraped data' % (
+            len(removed))
     activate_legislators(state)
+    populate_norm_fields(db.legislators, state, NORM_FIELDS,
+                         NORM_ROLE_FIELDS)
+    ensure_indexes()
 
 
 def activate_legislators(state):
@@ -57,6 +101,8 @@ def activate_legislators(state):
                                                      {'state': state,
                                                       'type': 'member'}}}):
         active_role = legislator['roles'][0]
+        before = dict((key, legislator.get(key)) for key in
+                      ('active', 'district', 'chamber', 'party'))
 
         if active_role['term'] == current_term and not active_role['end_date']:
             legislator['active'] = True
@@ -71,10 +117,48 @@ def activate_legislators(state):
                 except KeyError:
                     pass
 
-        db.legislators.save(legislator, safe=True)
+        if any(legislator.get(key) != value
+               for key, value in before.iteritems()):
+            legislator['updated_at'] = datetime.datetime.utcnow()
+            db.legislators.save(legislator, safe=True)
+
+
+def find_existing_legislators(state, batch):
+    """
+    Fetch the stored legislators that a batch of scraped legislators
+    could match with a single query, as lists keyed by full_name.
+    """
+    spec = {'full_name': {'$in': list(set(l['full_name'] for l in batch))},
+            'roles.state': state}
+
+    existing = defaultdict(list)
+    for leg in db.legislators.find(spec):
+        existing[leg['full_name']].append(leg)
+    return existing
+
+
+def _find_legislator(candidates, spec, state=None):
+    """
+    Return the first of ``candidates`` with a role matching every field
+    of ``spec`` (and from ``state``, if given), or None.
+    """
+    for leg in candidates:
+        if state and leg.get('state') != state:
+            continue
+        for role in leg['roles']:
+            if all(role.get(key) == value for key, value in
+                   spec.iteritems()):
+                return leg
+    return None
 
 
-def import_legislator(data):
+def import_legislator(data, candidates, term_names):
+    """
+    Import a single prepared legislator, given the stored legislators
+    with the same full name (see find_existing_legislators) and the
+    names of the state's terms. Returns 'inserted', 'updated' or
+    'unchanged'.
+    """
     # Rename 'role' -> 'type'
     for role in data['roles']:
         if 'role' in role:
@@ -91,29 +175,21 @@ def import_legislator(data):
     if 'chamber' in cur_role:
         spec['chamber'] = cur_role['chamber']
 
-    leg = db.legislators.find_one(
-        {'state': data['state'],
-         'full_name': data['full_name'],
-         'roles': {'$elemMatch': spec}})
+    leg = _find_legislator(candidates, spec, data['state'])
 
     if not leg:
-        metadata = db.metadata.find_one({'_id': data['state']})
-
-        term_names = [t['name'] for t in metadata['terms']]
-
         try:
             index = term_names.index(cur_role['term'])
 
             if index > 0:
                 prev_term = term_names[index - 1]
                 spec['term'] = prev_term
-                prev_leg = db.legislators.find_one(
-                    {'full_name': data['full_name'],
-                     'roles': {'$elemMatch': spec}})
+                prev_leg = _find_legislator(candidates, spec)
 
                 if prev_leg:
-                    update(prev_leg, data, db.legislators)
-                    return
+                    if update(prev_leg, data, db.legislators):
+                        return 'updated'
+                    return 'unchanged'
         except ValueError:
             print "Invalid term: %s" % cur_role['term']
             sys.exit(1)
@@ -122,7 +198,10 @@ def import_legislator(data):
         data['updated_at'] = datetime.datetime.utcnow()
 
         insert_with_id(data)
+        # later files in the batch can match it
+        candidates.append(data)
+        return 'inserted'
+    elif update(leg, data, db.legislators):
+        return 'updated'
     else:
-        update(leg, data, db.legislators)
-
-    ensure_indexes()
+        return 'unchanged'
@@ -1,42 +1,190 @@
+from __future__ import with_statement
+import os
+import re
+import heapq
+import logging
+import unicodedata
+import cPickle as pickle
+from collections import defaultdict
+
+from fiftystates import settings
 from fiftystates.backend import db
+from fiftystates.backend.utils import collection_version
 
-__matchers = {}
+import jellyfish
 
+_log = logging.getLogger('fiftystates')
 
-def get_legislator_id(state, session, chamber, name):
+__resolvers = {}
+
+
+def get_resolver(state):
+    """
+    Get the NameResolver for a state, loading it from the on-disk cache
+    or building it on first use.
+    """
     try:
-        matcher = __matchers[(state, session, chamber)]
+        return __resolvers[state]
     except KeyError:
-        matcher = init_name_matcher(state, session, chamber)
-        __matchers[(state, session, chamber)] = matcher
+        resolver = NameResolver.load(state)
+        __resolvers[state] = resolver
+        return resolver
+
+
+def get_legislator_id(state, session, chamber, name):
+    return get_resolver(state).resolve(session, chamber, name)
+
+
+def get_legislator_ids(state, session, chamber, names):
+    """
+    Resolve many names at once, returning a dictionary mapping each
+    distinct name to its legislator id (or None if it couldn't be
+    uniquely matched).
+    """
+    return get_resolver(state).resolve_many(session, chamber, names)
+
+
+class NameResolver(object):
+    """
+    Legislator name matching for every session and chamber of a state.
+
+    All of the state's NameMatchers are built from a single legislator
+    query, one per (term, chamber) plus one per term covering both
+    chambers, and share one table of interned name forms and ids. The
+    resolver can be pickled to the cache directory and is reused until
+    the state's legislators change.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.fuzzy = getattr(settings, 'FUZZY_NAME_MATCHING', False)
+        self.version = collection_version(state, db.legislators)
+        self.matchers = {}
+
+        strings = {}
+        seen = set()
+        for legislator in db.legislators.find(
+                {'roles': {'$elemMatch': {'state': state,
+                                          'type': 'member'}}},
+                ['full_name', 'first_name', 'last_name', 'middle_name',
+                 'roles']):
+            legislator.setdefault('middle_name', '')
+
+            for role in legislator['roles']:
+                if role.get('state') != state or role['type'] != 'member':
+                    continue
+
+                for chamber in (role.get('chamber'), None):
+                    key = (role['term'], chamber)
+                    if (key, legislator['_id']) in seen:
+                        continue
+                    seen.add((key, legislator['_id']))
+
+                    try:
+                        matcher = self.matchers[key]
+                    except KeyError:
+                        matcher = NameMatcher(strings)
+                        self.matchers[key] = matcher
+
+                    matcher[legislator] = legislator['_id']
+
+        self._load_sessions()
+
+    def _load_sessions(self):
+        self.sessions = {}
+        for term in db.metadata.find_one({'_id': self.state})['terms']:
+            for session in term['sessions']:
+                self.sessions[session] = term['name']
+
+    @staticmethod
+    def cache_path(state):
+        cache_dir = getattr(settings, 'FIFTYSTATES_CACHE_DIR', None)
+        if not cache_dir:
+            return None
+        return os.path.join(cache_dir, 'names', '%s.pickle' % state)
+
+    @classmethod
+    def load(cls, state):
+        """
+        Load the cached resolver for a state if it is still current,
+        otherwise build (and cache) a new one.
+        """
+        path = cls.cache_path(state)
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    resolver = pickle.load(f)
+            except Exception, e:
+                _log.warning("Couldn't load name cache %s: %s" % (path, e))
+            else:
+                if resolver.version == collection_version(state,
+                                                          db.legislators):
+                    # sessions come from metadata, which may have changed
+                    resolver._load_sessions()
+                    resolver.fuzzy = getattr(settings,
+                                             'FUZZY_NAME_MATCHING', False)
+                    return resolver
+
+        resolver = cls(state)
+        if path:
+            resolver.save(path)
+        return resolver
 
-    return matcher[name]
+    def save(self, path):
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
 
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
 
-def init_name_matcher(state, session, chamber):
-    matcher = NameMatcher()
+    def matcher(self, session, chamber):
+        try:
+            term = self.sessions[session]
+        except KeyError:
+            raise Exception("bad session: " + session)
 
-    elemMatch = {'state': state, 'type': 'member'}
+        if chamber == 'both':
+            chamber = None
 
-    metadata = db.metadata.find_one({'_id': state})
-    for term in metadata['terms']:
-        if session in term['sessions']:
-            elemMatch['term'] = term['name']
-            break
-    else:
-        raise Exception("bad session: " + session)
+        try:
+            return self.matchers[(term, chamber)]
+        except KeyError:
+            # nobody served in this term/chamber
+            return NameMatcher()
 
-    if chamber and chamber != 'both':
-        elemMatch['chamber'] = chamber
+    def resolve(self, session, chamber, name):
+        matcher = self.matcher(session, chamber)
+        if self.fuzzy:
+            return matcher.fuzzy_get(name)
+        return matcher[name]
 
-    for legislator in db.legislators.find({
-            'roles': {'$elemMatch': elemMatch}}):
-        if 'middle_name' not in legislator:
-            legislator['middle_name'] = ''
+    def resolve_many(self, session, chamber, names):
+        return self.matcher(session, chamber).resolve_many(names,
+                                                           self.fuzzy)
 
-        matcher[legislator] = legislator['_id']
 
-    return matcher
+_suffixes = frozenset(('jr', 'sr', 'ii', 'iii', 'iv'))
+
+
+def _normalize(name):
+    """
+    Normalize a name for fuzzy matching: strip accents, punctuation and
+    generational suffixes and lowercase it.
+    """
+    if isinstance(name, unicode):
+        name = unicodedata.normalize('NFKD', name)
+        name = u''.join(c for c in name if not unicodedata.combining(c))
+        name = name.encode('ascii', 'ignore')
+
+    words = re.split(r"[\s,.()'-]+", name.lower())
+    return ' '.join(w for w in words if w and w not in _suffixes)
+
+
+def _ngrams(s, n):
+    s = ' %s ' % s
+    return set(s[i:i + n] for i in xrange(len(s) - n + 1))
 
 
 class NameMatcher(object):
@@ -91,9 +239,29 @@ class NameMatcher(object):
     >>> assert nm['Stephens, M J'] == None
     """
 
-    def __init__(self):
+    def __init__(self, strings=None):
         self.names = {}
 
+        # table used to intern name forms and ids, may be shared
+        # between matchers
+        if strings is None:
+            strings = {}
+        self._strings = strings
+
+        # the fuzzy n-gram index is built on first use
+        self._fuzzy_forms = None
+        self._fuzzy_index = None
+        self._fuzzy_cache = {}
+
+    def __getstate__(self):
+        # don't pickle the n-gram index, but keep the resolved misses
+        state = self.__dict__.copy()
+        state['_fuzzy_forms'] = state['_fuzzy_index'] = None
+        return state
+
+    def _intern(self, s):
+        return self._strings.setdefault(s, s)
+
     def __setitem__(self, name, obj):
         """
         Expects a dictionary with full_name, first_name, last_name and
@@ -141,8 +309,12 @@ class NameMatcher(object):
                                           name['middle_name'][0]))
 
 
+        self._fuzzy_forms = self._fuzzy_index = None
+        self._fuzzy_cache = {}
+
+        obj = self._intern(obj)
         for form in forms:
-            form = form.replace('.', '').lower()
+            form = self._intern(form.replace('.', '').lower())
             if form in self.names:
                 self.names[form] = None
             else:
@@ -157,3 +329,99 @@ class NameMatcher(object):
         if name in self.names:
             return self.names[name]
         return None
+
+    def resolve_many(self, names, fuzzy=False):
+        """
+        Look up many names at once, returning a dictionary mapping each
+        distinct name to its value (or None).
+        """
+        if fuzzy:
+            return dict((name, self.fuzzy_get(name)) for name in set(names))
+
+        lookup = self.names.get
+        return dict((name, lookup(name.strip().replace('.', '').lower()))
+                    for name in set(names))
+
+    # fuzzy matching parameters: n-gram size, number of candidates
+    # scored per lookup and minimum Jaro-Winkler similarity
+    ngram_size = 3
+    fuzzy_candidates = 5
+    fuzzy_threshold = 0.9
+
+    def _build_fuzzy_index(self):
+        forms = {}
+        for form, obj in self.names.iteritems():
+            norm = _normalize(form)
+            # a normalized form shared by different people is ambiguous
+            if norm in forms and forms[norm] != obj:
+                forms[norm] = None
+            else:
+                forms[norm] = obj
+
+        self._fuzzy_forms = forms.items()
+        self._fuzzy_index = defaultdict(list)
+        for i, (form, obj) in enumerate(self._fuzzy_forms):
+            for gram in _ngrams(form, self.ngram_size):
+                self._fuzzy_index[gram].append(i)
+
+    def fuzzy_get(self, name):
+        """
+        Like __getitem__, but if the name isn't a known form fall back
+        to the closest one, provided it is similar enough and identifies
+        a single person. A known form that is ambiguous doesn't match.
+
+        Candidates are the forms sharing the most character n-grams with
+        the name; only those are scored with Jaro-Winkler similarity.
+        Results for names that miss the exact lookup are cached.
+
+        >>> nm = NameMatcher()
+        >>> nm[{'full_name': u'Dawnna Dukes', 'first_name': u'Dawnna', \
+                'last_name': u'Dukes', 'middle_name': ''}] = 1
+        >>> nm[{'full_name': u'Veronica Gonz\xe1lez-Toureilles', \
+                'first_name': u'Veronica', \
+                'last_name': u'Gonz\xe1lez-Toureilles', \
+                'middle_name': ''}] = 2
+        >>> assert nm['Gonzalez Toureilles'] == None
+        >>> assert nm.fuzzy_get('Gonzalez Toureilles') == 2
+        >>> assert nm.fuzzy_get('Dukes, Dawnna Jr.') == 1
+        >>> assert nm.fuzzy_get('Duke') == 1
+        >>> assert nm.fuzzy_get('Smith') == None
+        """
+        # an exact match is final, even if it's ambiguous
+        key = name.strip().replace('.', '').lower()
+        if key in self.names:
+            return self.names[key]
+
+        try:
+            return self._fuzzy_cache[name]
+        except KeyError:
+            pass
+
+        if self._fuzzy_index is None:
+            self._build_fuzzy_index()
+
+        norm = _normalize(name)
+
+        hits = defaultdict(int)
+        for gram in _ngrams(norm, self.ngram_size):
+            for i in self._fuzzy_index.get(gram, ()):
+                hits[i] += 1
+
+        candidates = heapq.nlargest(self.fuzzy_candidates,
+                                    hits.iteritems(),
+                                    key=lambda hit: hit[1])
+
+        best_score, best = 0, None
+        for i, count in candidates:
+            form, obj = self._fuzzy_forms[i]
+            score = jellyfish.jaro_winkler(norm, form)
+            if score > best_score:
+                best_score, best = score, obj
+            elif score == best_score and obj != best:
+                best = None
+
+        if best_score < self.fuzzy_threshold:
+            best = None
+
+        self._fuzzy_cache[name] = best
+        return best
@@ -0,0 +1,131 @@
+from __future__ import with_statement
+import sys
+import Queue
+import threading
+import multiprocessing
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from fiftystates import settings
+from fiftystates.backend.utils import prepare_obj, content_hash
+
+# Number of worker processes used to parse and prepare scraped files,
+# None means one per CPU
+PROCESSES = getattr(settings, 'IMPORT_PROCESSES', None)
+
+# Maximum number of prepared objects waiting on the writer
+QUEUE_SIZE = 256
+
+# Default number of objects the writer handles at once
+BATCH_SIZE = 100
+
+_DONE = object()
+
+
+def load_file(path, salt=None):
+    """
+    Read a scraped JSON file and prepare it for MongoDB.
+
+    If ``salt`` is given the prepared object's content hash is stored
+    in its '_content_hash' field.
+    """
+    with open(path) as f:
+        obj = prepare_obj(json.load(f))
+
+    if salt is not None:
+        obj['_content_hash'] = content_hash(obj, salt)
+
+    return obj
+
+
+def _load_file(args):
+    return load_file(*args)
+
+
+def load_objects(paths, salt=None, processes=PROCESSES,
+                 queue_size=QUEUE_SIZE):
+    """
+    Yield the prepared object for each of ``paths``, in order.
+
+    Files are parsed and run through prepare_obj (and hashed, if a
+    ``salt`` is given) on a pool of worker processes. A feeder thread
+    moves finished objects into a bounded queue that the caller (the
+    single writer) drains, so preparing the next files overlaps with the
+    database work done on the current ones.
+    """
+    paths = list(paths)
+
+    if processes == 1 or len(paths) < 2:
+        for path in paths:
+            yield load_file(path, salt)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    queue = Queue.Queue(queue_size)
+
+    def feed():
+        try:
+            args = [(path, salt) for path in paths]
+            for obj in pool.imap(_load_file, args, chunksize=8):
+                queue.put(obj)
+        except Exception:
+            queue.put(sys.exc_info())
+        queue.put(_DONE)
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    try:
+        while True:
+            obj = queue.get()
+            if obj is _DONE:
+                break
+            elif isinstance(obj, tuple):
+                raise obj[0], obj[1], obj[2]
+            yield obj
+    finally:
+        pool.terminate()
+
+
+def skip_unchanged(objs, hashes, counts, seen=None):
+    """
+    Filter out objects whose content hash is in ``hashes``, counting
+    them as 'skipped' in ``counts``. If a ``seen`` set is given, the hash
+    of every object, skipped or not, is added to it.
+    """
+    for obj in objs:
+        if seen is not None:
+            seen.add(obj.get('_content_hash'))
+
+        if obj.get('_content_hash') in hashes:
+            counts['skipped'] += 1
+        else:
+            yield obj
+
+
+def format_counts(counts):
+    """
+    Summarize the inserted/updated/unchanged/skipped counts of an import.
+    """
+    return ', '.join('%d %s' % (counts[key], key)
+                     for key in ('inserted', 'updated', 'unchanged',
+                                 'skipped'))
+
+
+def batched(iterable, size=BATCH_SIZE):
+    """
+    Group the items of ``iterable`` into lists of at most ``size`` items.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+Fill in the lowercased '_norm' fields that case-insensitive legislator
+and committee searches match against, for data imported before the
+importers kept them. Later imports keep them up to date.
+"""
+import argparse
+
+from fiftystates.backend import db
+from fiftystates.backend import legislators, committees
+from fiftystates.backend.utils import populate_norm_fields, bump_generation
+
+
+def populate_norm(state):
+    populate_norm_fields(db.legislators, state, legislators.NORM_FIELDS,
+                         legislators.NORM_ROLE_FIELDS)
+    populate_norm_fields(db.committees, state, committees.NORM_FIELDS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=('populate the normalized search fields of '
+                     'legislators and committees'))
+    parser.add_argument('states', metavar='STATE', type=str, nargs='*',
+                        help='states to update (default: all of them)')
+
+    args = parser.parse_args()
+
+    states = args.states or [meta['_id'] for meta in
+                             db.metadata.find({}, ['_id'])]
+
+    legislators.ensure_indexes()
+    committees.ensure_indexes()
+
+    for state in states:
+        populate_norm(state)
+        # searches of the state can now match more
+        bump_generation(state)
+        print 'populated search fields for %s' % state
@@ -1,16 +1,32 @@
+from __future__ import with_statement
 import os
 import re
 import time
 import json
+import hashlib
+import argparse
 import logging
 import datetime
+import threading
 
+import pymongo
+import gridfs
 from pymongo.son import SON
 
 from fiftystates.backend import db, fs
 
 import name_tools
 
+# common arguments for command line scripts that work on a single state
+base_arg_parser = argparse.ArgumentParser(add_help=False)
+base_arg_parser.add_argument('state', type=str,
+                             help=('the two-letter abbreviation of the '
+                                   'state to work on'))
+base_arg_parser.add_argument('-v', '--verbose', action='count',
+                             dest='verbose', default=False,
+                             help=("be verbose (use multiple times for "
+                                   "more debugging information)"))
+
 def _get_property_dict(schema):
     """ given a schema object produce a nested dictionary of fields """
     pdict = {}
@@ -77,26 +93,276 @@ def timestamp_to_dt(timestamp):
     return datetime.datetime(*time.localtime(timestamp)[0:6])
 
 
+def _diff(old, new, path, diff):
+    """
+    Add the modifiers needed to turn the stored value ``old`` at ``path``
+    into ``new`` to ``diff``, descending into subdocuments and lists so
+    that only the parts that changed are written.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in new.iteritems():
+            subpath = '%s.%s' % (path, key)
+            if key not in old:
+                diff['$set'][subpath] = value
+            elif old[key] != value:
+                _diff(old[key], value, subpath, diff)
+
+        for key in old:
+            if key not in new:
+                diff['$unset']['%s.%s' % (path, key)] = 1
+    elif (isinstance(old, list) and isinstance(new, list) and old and
+          len(new) >= len(old)):
+        if len(new) > len(old):
+            if new[:len(old)] == old:
+                diff['$pushAll'][path] = new[len(old):]
+            else:
+                diff['$set'][path] = new
+            return
+
+        changed = [i for i in xrange(len(new)) if old[i] != new[i]]
+        if len(changed) * 2 > len(new):
+            # rewriting most of the list, just replace it
+            diff['$set'][path] = new
+        else:
+            for i in changed:
+                _diff(old[i], new[i], '%s.%d' % (path, i), diff)
+    else:
+        diff['$set'][path] = new
+
+
+# keys that importers derive from a stored document after writing it
+# (see populate_norm_fields) and that scraped data never has
+_derived_keys = ('_norm',)
+
+
+def _keep_derived(old, new):
+    """
+    Copy the derived keys of ``old`` and its subdocuments into ``new`` so
+    that they aren't diffed away. They are brought up to date after the
+    import rather than removed in the meantime.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in old.iteritems():
+            if key in _derived_keys:
+                new.setdefault(key, value)
+            elif key in new:
+                _keep_derived(value, new[key])
+    elif isinstance(old, list) and isinstance(new, list):
+        for old_item, new_item in zip(old, new):
+            _keep_derived(old_item, new_item)
+
+
 def update(old, new, coll):
+    """
+    Merge ``new`` into the stored document ``old`` and write only the
+    fields that changed. Returns True if the document's contents changed.
+    """
     # To prevent deleting standalone votes..
     if 'votes' in new and not new['votes']:
         del new['votes']
 
-    changed = False
+    _keep_derived(old, new)
+
+    # the content hash is bookkeeping and doesn't count as a change
+    new_hash = new.pop('_content_hash', None)
+
+    diff = {'$set': {}, '$unset': {}, '$pushAll': {}}
     for key, value in new.items():
         if old.get(key) != value:
+            if key in old:
+                _diff(old[key], value, key, diff)
+            else:
+                diff['$set'][key] = value
             old[key] = value
-            changed = True
 
         # remove old +key field if this field no longer has a +
         plus_key = '+%s' % key
         if plus_key in old:
             del old[plus_key]
-            changed = True
+            diff['$unset'][plus_key] = 1
 
+    changed = any(diff.itervalues())
     if changed:
         old['updated_at'] = datetime.datetime.utcnow()
-        coll.save(old, safe=True)
+        diff['$set']['updated_at'] = old['updated_at']
+
+    if new_hash and old.get('_content_hash') != new_hash:
+        old['_content_hash'] = new_hash
+        diff['$set']['_content_hash'] = new_hash
+
+    diff = dict((op, fields) for op, fields in diff.iteritems() if fields)
+    if diff:
+        coll.update({'_id': old['_id']}, diff, safe=True)
+
+    return changed
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+def content_hash(obj, salt=''):
+    """
+    Return a canonical SHA-1 hex digest of a prepared object.
+
+    ``salt`` should describe anything else the import of the object
+    depends on (see collection_version) so that the hash changes along
+    with it.
+    """
+    digest = hashlib.sha1(salt)
+    digest.update(json.dumps(obj, sort_keys=True, default=_json_default))
+    return digest.hexdigest()
+
+
+def load_content_hashes(collection, state):
+    """
+    Load the set of content hashes stored on a state's documents in the
+    given collection.
+    """
+    return set(doc['_content_hash'] for doc in
+               collection.find({'state': state,
+                                '_content_hash': {'$exists': True}},
+                               ['_content_hash']))
+
+
+def collection_version(state, *collections):
+    """
+    Return a string that changes whenever a state's documents in any of
+    the given collections are added or updated.
+    """
+    parts = []
+    for collection in collections:
+        spec = {'state': state}
+        latest = list(collection.find(spec, ['updated_at']).sort(
+                'updated_at', pymongo.DESCENDING).limit(1))
+        if latest:
+            latest = latest[0].get('updated_at')
+        else:
+            latest = None
+
+        parts.append('%s:%s:%s' % (collection.name,
+                                   collection.find(spec).count(), latest))
+
+    return ';'.join(parts)
+
+
+# fields kept in tombstones to identify removed objects
+_tombstone_fields = ('_type', 'state', 'session', 'chamber', 'bill_id')
+
+
+def remove_objects(collection, spec):
+    """
+    Remove the bills, legislators, committees or events matching
+    ``spec``, leaving a tombstone for each in the tombstones collection
+    so that clients syncing from the changes feed learn of the removal.
+    """
+    now = datetime.datetime.utcnow()
+    for obj in collection.find(spec, list(_tombstone_fields)):
+        obj['updated_at'] = now
+        obj['type'] = collection.name
+        db.tombstones.save(obj, safe=True)
+
+    collection.remove(spec, safe=True)
+
+
+def prune_objects(collection, state, seen_hashes, spec=None):
+    """
+    Remove a state's objects that were imported from scraped files (and
+    so have a '_content_hash') if their hash isn't in ``seen_hashes``,
+    the hashes of every file in the current scrape. Their files are
+    gone, so the objects no longer exist upstream. ``spec`` can narrow
+    down the objects considered.
+
+    Returns the removed objects, with just their tombstone fields.
+    """
+    spec = dict(spec or {})
+    spec['state'] = state
+    spec['_content_hash'] = {'$exists': True}
+
+    fields = ['_content_hash'] + list(_tombstone_fields)
+    removed = [obj for obj in collection.find(spec, fields)
+               if obj['_content_hash'] not in seen_hashes]
+
+    for i in xrange(0, len(removed), 500):
+        ids = [obj['_id'] for obj in removed[i:i + 500]]
+        remove_objects(collection, {'_id': {'$in': ids}})
+
+    return removed
+
+
+def ensure_indexes():
+    db.tombstones.ensure_index([('state', pymongo.ASCENDING),
+                                ('updated_at', pymongo.ASCENDING),
+                                ('_id', pymongo.ASCENDING)])
+    db.tombstones.ensure_index([('updated_at', pymongo.ASCENDING),
+                                ('_id', pymongo.ASCENDING)])
+
+
+def bump_generation(state):
+    """
+    Record that a state's data has changed by incrementing its import
+    generation, along with the 'all' generation of requests that aren't
+    limited to one state. Cached API responses are keyed on these.
+    """
+    for key in (state, 'all'):
+        db.generations.update({'_id': key}, {'$inc': {'generation': 1}},
+                              upsert=True, safe=True)
+
+
+def get_generation(state):
+    gen = db.generations.find_one({'_id': state})
+    if gen:
+        return gen['generation']
+    return 0
+
+
+def normalize(value):
+    """
+    Normalize a string for case-insensitive exact matching.
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower()
+    return value
+
+
+def norm_fields(obj, fields):
+    """
+    Return a dict of the normalized values of ``fields`` in ``obj``, to
+    be stored as obj['_norm'] so that case-insensitive filters can be
+    exact (indexed) matches on '_norm.<field>'.
+    """
+    return dict((field, normalize(obj[field])) for field in fields
+                if obj.get(field) is not None)
+
+
+def populate_norm_fields(collection, state, fields, role_fields=()):
+    """
+    Bring the '_norm' fields of a state's documents (and of their roles,
+    if ``role_fields`` are given) up to date, writing only documents
+    whose normalized values changed.
+    """
+    projection = list(fields) + ['_norm']
+    if role_fields:
+        projection.append('roles')
+
+    for obj in collection.find({'state': state}, projection):
+        changes = {}
+
+        norm = norm_fields(obj, fields)
+        if obj.get('_norm') != norm:
+            changes['_norm'] = norm
+
+        if role_fields:
+            for i, role in enumerate(obj.get('roles', [])):
+                norm = norm_fields(role, role_fields)
+                if role.get('_norm') != norm:
+                    changes['roles.%d._norm' % i] = norm
+
+        if changes:
+            collection.update({'_id': obj['_id']}, {'$set': changes},
+                              safe=True)
 
 
 def convert_timestamps(obj):
@@ -170,49 +436,93 @@ def make_plus_fields(obj):
     return _make_plus_helper(obj, fields)
 
 
-def prepare_obj(obj):
+_timestamp_keys = frozenset(('date', 'when', 'end', 'start_date',
+                             'end_date', 'retrieved'))
+_timestamp_children = frozenset(('sources', 'actions', 'votes', 'roles'))
+
+
+def compile_transformer(fields, convert=True):
     """
-    Clean up scraped objects in preparation for MongoDB.
+    Build a function that does the work of convert_timestamps and
+    make_plus_fields in a single pass over an object described by
+    ``fields`` (a property dict from _get_property_dict).
+
+    The object is modified in place: timestamps are converted, roles get
+    their parent's state and non-standard keys are renamed with a '+'.
+    Child transformers for nested lists are compiled once, up front.
     """
-    convert_timestamps(obj)
+    names = frozenset(fields)
 
-    if obj['_type'] in ('person', 'legislator'):
-        split_name(obj)
+    children = []
+    for key, subfields in fields.iteritems():
+        if subfields:
+            children.append((key, compile_transformer(
+                        subfields, convert and key in _timestamp_children)))
 
-    return make_plus_fields(obj)
+    # children that convert_timestamps would descend into but that have
+    # no subschema of their own
+    convert_only = [key for key in _timestamp_children
+                    if not fields.get(key)]
 
+    def transform(obj):
+        if convert:
+            for key in _timestamp_keys:
+                value = obj.get(key)
+                if value:
+                    obj[key] = timestamp_to_dt(value)
 
-__committee_ids = {}
+            if obj.get('roles'):
+                state = obj['state']
+                for role in obj['roles']:
+                    role['state'] = state
 
+            for details in obj.get('session_details', {}).itervalues():
+                convert_timestamps(details)
 
-def get_committee_id(state, chamber, committee):
-    key = (state, chamber, committee)
-    if key in __committee_ids:
-        return __committee_ids[key]
+            for key in convert_only:
+                for item in obj.get(key, ()):
+                    convert_timestamps(item)
 
-    comms = db.committees.find({'state': state,
-                               'chamber': chamber,
-                               'committee': committee,
-                               'subcommittee': None})
+        for key, child in children:
+            value = obj.get(key)
+            if isinstance(value, list):
+                for item in value:
+                    child(item)
 
-    if comms.count() != 1:
-        comms = db.committees.find({'state': state,
-                                   'chamber': chamber,
-                                   'committee': ('Committee on ' +
-                                                 committee),
-                                   'subcommittee': None})
+        for key in [key for key in obj
+                    if key not in names and not key.startswith('_')]:
+            obj['+' + key] = obj.pop(key)
 
-    if comms and comms.count() == 1:
-        __committee_ids[key] = comms[0]['_id']
-    else:
-        __committee_ids[key] = None
+        return obj
 
-    return __committee_ids[key]
+    return transform
 
 
-def put_document(doc, content_type, metadata):
-    # Generate a new sequential ID for the document
-    query = SON([('_id', metadata['bill']['state'])])
+_transformers = dict((_type, compile_transformer(fields))
+                     for _type, fields in standard_fields.iteritems())
+
+
+def prepare_obj(obj):
+    """
+    Clean up scraped objects in preparation for MongoDB.
+    """
+    if obj['_type'] in ('person', 'legislator'):
+        split_name(obj)
+
+    try:
+        transform = _transformers[obj['_type']]
+    except KeyError:
+        transform = compile_transformer({})
+        _transformers[obj['_type']] = transform
+
+    return transform(obj)
+
+
+def next_document_id(state):
+    """
+    Generate a new sequential ID for a state's document.
+    """
+    query = SON([('_id', state)])
     update = SON([('$inc', SON([('seq', 1)]))])
     seq = db.command(SON([('findandmodify', 'doc_ids'),
                           ('query', query),
@@ -220,9 +530,134 @@ def put_document(doc, content_type, metadata):
                           ('new', True),
                           ('upsert', True)]))['value']['seq']
 
-    id = "%sD%08d" % (metadata['bill']['state'].upper(), seq)
-    logging.info("Saving as %s" % id)
+    return "%sD%08d" % (state.upper(), seq)
+
+
+# guards the check-then-write of content hashes between threads
+_document_lock = threading.Lock()
+
 
-    fs.put(doc, _id=id, content_type=content_type, metadata=metadata)
+def _file_hash_fields(sha256, fields):
+    fields = dict((key, value) for key, value in fields.iteritems()
+                  if value is not None)
+    fields['sha256'] = sha256
+    return fields
+
+
+def alias_document(id, file_id, content_type, metadata, **fields):
+    """
+    Record ``id`` as another name for the stored file ``file_id``, with
+    its own content type and metadata.
+    """
+    alias = {'_id': id, 'file_id': file_id, 'content_type': content_type,
+             'metadata': metadata}
+    alias.update((key, value) for key, value in fields.iteritems()
+                 if value is not None)
+    db.document_aliases.save(alias, safe=True)
+
+
+def _dedupe(id, sha256, content_type, metadata, fields):
+    """
+    Point ``id`` at an existing file with the same content if there is
+    one, returning that file's id, or None if the content is new.
+    """
+    existing = db.documents.files.find_one({'sha256': sha256}, ['_id'])
+    if not existing or existing['_id'] == id:
+        return None
+
+    logging.info("%s has the same content as %s" % (id, existing['_id']))
+    alias_document(id, existing['_id'], content_type, metadata, **fields)
+    return existing['_id']
+
+
+def put_document(doc, content_type, metadata, **fields):
+    """
+    Store a document, returning its new id.
+
+    If a file with identical content is already stored the new id
+    becomes an alias of it rather than storing the bytes again. Extra
+    ``fields`` (e.g. 'etag') are saved alongside the file.
+    """
+    id = next_document_id(metadata['bill']['state'])
+    sha256 = hashlib.sha256(doc).hexdigest()
+
+    with _document_lock:
+        if not _dedupe(id, sha256, content_type, metadata, fields):
+            logging.info("Saving as %s" % id)
+            fs.put(doc, _id=id, content_type=content_type, metadata=metadata,
+                   **_file_hash_fields(sha256, fields))
 
     return id
+
+
+def stream_document(id, chunks, content_type, metadata, **fields):
+    """
+    Stream an iterable of byte strings into GridFS as document ``id``,
+    returning the number of bytes read.
+
+    The content is hashed as it is written. If it turns out to match an
+    already stored file the new copy is deleted and ``id`` becomes an
+    alias of the existing file.
+    """
+    digest = hashlib.sha256()
+    size = 0
+
+    f = fs.new_file(_id=id, content_type=content_type, metadata=metadata)
+    try:
+        for chunk in chunks:
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    except:
+        f.close()
+        fs.delete(id)
+        raise
+    f.close()
+
+    sha256 = digest.hexdigest()
+    with _document_lock:
+        if _dedupe(id, sha256, content_type, metadata, fields):
+            fs.delete(id)
+        else:
+            db.documents.files.update(
+                {'_id': id}, {'$set': _file_hash_fields(sha256, fields)},
+                safe=True)
+
+    return size
+
+
+def get_document(id):
+    """
+    Return a (file, metadata) pair for document ``id``, following
+    aliases to the stored file. Raises gridfs.NoFile if there is no such
+    document.
+    """
+    try:
+        doc = fs.get(id)
+        return doc, doc.metadata
+    except gridfs.NoFile:
+        alias = db.document_aliases.find_one({'_id': id})
+        if not alias:
+            raise
+        return fs.get(alias['file_id']), alias['metadata']
+
+
+def find_document_by_url(url):
+    """
+    Find a stored document that was downloaded from ``url`` and has
+    cache validators, returning a dict with its 'file_id',
+    'content_type', 'etag' and 'last_modified', or None.
+    """
+    spec = {'metadata.url': url,
+            '$or': [{'etag': {'$exists': True}},
+                    {'last_modified': {'$exists': True}}]}
+
+    fields = ['content_type', 'etag', 'last_modified']
+
+    found = db.documents.files.find_one(spec, fields)
+    if found:
+        found['file_id'] = found['_id']
+    else:
+        found = db.document_aliases.find_one(spec, fields + ['file_id'])
+
+    return found
@@ -1,41 +1,277 @@
 #!/usr/bin/env python
-import sys
+from __future__ import with_statement
+import time
+import Queue
+import socket
+import httplib
 import logging
+import urllib2
+import urlparse
+import datetime
+import threading
+import contextlib
 
-from pymongo.son import SON
+from fiftystates.backend import db
+from fiftystates.backend.utils import (next_document_id, stream_document,
+                                       alias_document, find_document_by_url)
 
-import scrapelib
+_log = logging.getLogger('fiftystates')
 
-from fiftystates.backend import db, fs
-from fiftystates.backend.utils import put_document
 
+def ensure_indexes():
+    db.documents.files.ensure_index('sha256')
+    db.documents.files.ensure_index('metadata.url')
+    db.documents.files.ensure_index('metadata.bill.state')
+    db.document_aliases.ensure_index('metadata.url')
+    db.document_aliases.ensure_index('metadata.bill.state')
 
-def import_versions(state, rpm=60):
-    scraper = scrapelib.Scraper(requests_per_minute=rpm)
 
-    for bill in db.bills.find({'state': state}):
-        logging.info("Importing %s" % bill['bill_id'])
+class HostLimiter(object):
+    """
+    Politeness limits applied per host: at most ``concurrency``
+    simultaneous downloads and ``rpm`` requests per minute.
+    """
 
-        bill_changed = False
-        for version in bill['versions']:
-            if 'document_id' in version or 'url' not in version:
+    def __init__(self, rpm=60, concurrency=1):
+        if rpm:
+            self.interval = 60.0 / rpm
+        else:
+            self.interval = 0
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, host):
+        with self._lock:
+            try:
+                return self._hosts[host]
+            except KeyError:
+                state = {'semaphore': threading.Semaphore(self.concurrency),
+                         'lock': threading.Lock(),
+                         'last': 0}
+                self._hosts[host] = state
+                return state
+
+    @contextlib.contextmanager
+    def limit(self, url):
+        host = self._host(urlparse.urlparse(url)[1])
+
+        host['semaphore'].acquire()
+        try:
+            with host['lock']:
+                wait = host['last'] + self.interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                host['last'] = time.time()
+
+            yield
+        finally:
+            host['semaphore'].release()
+
+
+class FetchStats(object):
+    """
+    Thread-safe progress and throughput counters for a state's fetch.
+    """
+
+    def __init__(self, state, total, report_every=25):
+        self.state = state
+        self.total = total
+        self.report_every = report_every
+        self.documents = 0
+        self.bytes = 0
+        self.failures = 0
+        self.unchanged = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        with self._lock:
+            self.documents += 1
+            if size is None:
+                self.unchanged += 1
+            else:
+                self.bytes += size
+            if self.documents % self.report_every == 0:
+                _log.info(self.summary())
+
+    def fail(self):
+        with self._lock:
+            self.failures += 1
+
+    def summary(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        return ("%s: %d/%d versions (%d unchanged, %d failed), "
+                "%.1f docs/s, %.1f KB/s" %
+                (self.state, self.documents, self.total, self.unchanged,
+                 self.failures, self.documents / elapsed,
+                 self.bytes / 1024.0 / elapsed))
+
+
+class VersionFetcher(object):
+    """
+    Downloads bill versions concurrently and streams them into GridFS.
+
+    A pool of ``workers`` threads downloads the versions, subject to a
+    per-host HostLimiter. Each response is copied into GridFS in
+    ``chunk_size`` pieces rather than being buffered in memory. Failed
+    downloads (network errors and 5xx responses) are retried up to
+    ``retries`` times with exponential backoff.
+
+    Identical content is only stored once (see stream_document). If a
+    version's URL has already been downloaded for another bill, a
+    conditional request is made with the stored ETag/Last-Modified and
+    a 304 response reuses the stored file without downloading it again.
+
+    Requests are made with ``opener``, a urllib2 OpenerDirector (by
+    default one built with urllib2.build_opener()).
+    """
+
+    def __init__(self, workers=4, rpm=60, per_host=1, retries=3,
+                 backoff=2.0, chunk_size=256 * 1024, timeout=60,
+                 opener=None):
+        self.workers = workers
+        self.limiter = HostLimiter(rpm, per_host)
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.opener = opener or urllib2.build_opener()
+
+    def pending_versions(self, state):
+        """
+        Yield a job for each of a state's versions that hasn't been
+        downloaded yet.
+        """
+        for bill in db.bills.find({'state': state,
+                                   'versions.url': {'$exists': True}},
+                                  ['state', 'chamber', 'session', 'bill_id',
+                                   'title', 'versions']):
+            for index, version in enumerate(bill['versions']):
+                if 'document_id' in version or 'url' not in version:
+                    continue
+
+                metadata = {'bill': {'state': bill['state'],
+                                     'chamber': bill['chamber'],
+                                     'session': bill['session'],
+                                     'bill_id': bill['bill_id'],
+                                     'title': bill['title']},
+                            'name': version['name'],
+                            'url': version['url']}
+
+                yield {'bill': bill['_id'], 'index': index,
+                       'url': version['url'], 'metadata': metadata}
+
+    def fetch_state(self, state):
+        ensure_indexes()
+
+        jobs = list(self.pending_versions(state))
+        stats = FetchStats(state, len(jobs))
+
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+
+        threads = []
+        for i in xrange(min(self.workers, len(jobs))):
+            thread = threading.Thread(target=self._work,
+                                      args=(state, queue, stats))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        print stats.summary()
+        return stats
+
+    def _work(self, state, queue, stats):
+        while True:
+            try:
+                job = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                doc_id, size = self.fetch(state, job)
+            except Exception, e:
+                _log.error("Failed downloading %s: %s" % (job['url'], e))
+                stats.fail()
                 continue
 
-            doc = scraper.urlopen(version['url'])
+            # a bill can list the same URL more than once, so the
+            # version is found by its position (checking it's unchanged)
+            version = 'versions.%d' % job['index']
+            db.bills.update({'_id': job['bill'],
+                             version + '.url': job['url']},
+                            {'$set': {version + '.document_id': doc_id,
+                                      'updated_at':
+                                      datetime.datetime.utcnow()}},
+                            safe=True)
+            stats.add(size)
+
+    def fetch(self, state, job):
+        """
+        Download a version into GridFS, retrying on failure. Returns the
+        new document's id and size (None if the document was unchanged).
+        """
+        doc_id = next_document_id(state)
+
+        attempt = 0
+        while True:
+            try:
+                return doc_id, self._download(job, doc_id)
+            except (urllib2.URLError, socket.error,
+                    httplib.HTTPException), e:
+                if ((isinstance(e, urllib2.HTTPError) and e.code < 500) or
+                    attempt >= self.retries):
+                    raise
+
+                delay = self.backoff * 2 ** attempt
+                _log.warning("Error downloading %s (%s), retrying in %ss" %
+                             (job['url'], e, delay))
+                time.sleep(delay)
+                attempt += 1
+
+    def _download(self, job, doc_id):
+        req = urllib2.Request(job['url'])
+
+        known = find_document_by_url(job['url'])
+        if known:
+            if known.get('etag'):
+                req.add_header('If-None-Match', known['etag'])
+            if known.get('last_modified'):
+                req.add_header('If-Modified-Since', known['last_modified'])
+
+        with self.limiter.limit(job['url']):
+            try:
+                resp = self.opener.open(req, timeout=self.timeout)
+            except urllib2.HTTPError, e:
+                if e.code != 304 or not known:
+                    raise
+
+                logging.info("%s not modified, reusing %s" %
+                             (job['url'], known['file_id']))
+                alias_document(doc_id, known['file_id'],
+                               known.get('content_type'), job['metadata'],
+                               etag=known.get('etag'),
+                               last_modified=known.get('last_modified'))
+                return None
 
-            metadata = {'bill': {'state': bill['state'],
-                                 'chamber': bill['chamber'],
-                                 'session': bill['session'],
-                                 'bill_id': bill['bill_id'],
-                                 'title': bill['title']},
-                        'name': version['name'],
-                        'url': version['url']}
+            try:
+                info = resp.info()
+                logging.info("Saving %s as %s" % (job['url'], doc_id))
 
-            content_type = doc.response.headers['content-type']
+                chunks = iter(lambda: resp.read(self.chunk_size), '')
+                return stream_document(doc_id, chunks,
+                                       info.get('content-type'),
+                                       job['metadata'],
+                                       etag=info.get('etag'),
+                                       last_modified=info.get('last-modified'))
+            finally:
+                resp.close()
 
-            version['document_id'] = put_document(doc, content_type,
-                                                  metadata)
-            bill_changed = True
 
-        if bill_changed:
-            db.bills.save(bill)
+def import_versions(state, rpm=60, workers=4):
+    return VersionFetcher(workers=workers, rpm=rpm).fetch_state(state)
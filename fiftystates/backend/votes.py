@@ -4,6 +4,7 @@ import os
 import glob
 import logging
 import datetime
+from collections import defaultdict
 
 try:
     import json
@@ -11,54 +12,151 @@ except ImportError:
     import simplejson as json
 
 from fiftystates.backend import db
-from fiftystates.backend.names import get_legislator_id
-from fiftystates.backend.utils import prepare_obj
+from fiftystates.backend.names import get_legislator_ids
+from fiftystates.backend.utils import collection_version
+from fiftystates.backend.pipeline import (load_objects, skip_unchanged,
+                                          format_counts)
 
 _log = logging.getLogger('fiftystates')
 
+_vote_types = ('yes_votes', 'no_votes', 'other_votes')
+
+
 def import_votes(state, data_dir):
     data_dir = os.path.join(data_dir, state)
     pattern = os.path.join(data_dir, 'votes', '*.json')
 
     paths = glob.glob(pattern)
 
-    for path in paths:
-        with open(path) as f:
-            data = prepare_obj(json.load(f))
+    # voters are matched against legislators, so a vote needs
+    # reimporting whenever they change
+    salt = collection_version(state, db.legislators)
+    hashes = load_vote_hashes(state)
+    counts = defaultdict(int)
+
+    # Group vote files by bill so that each bill is loaded and written
+    # only once, no matter how many roll calls it has
+    votes_by_bill = defaultdict(list)
+    for data in skip_unchanged(load_objects(paths, salt), hashes, counts):
+        key = (data['bill_chamber'], data['session'], data['bill_id'])
+        votes_by_bill[key].append(data)
+
+    resolve_voters(state, votes_by_bill.itervalues())
 
+    for (chamber, session, bill_id), votes in votes_by_bill.iteritems():
         bill = db.bills.find_one({'state': state,
-                                  'chamber': data['bill_chamber'],
-                                  'session': data['session'],
-                                  'bill_id': data['bill_id']})
+                                  'chamber': chamber,
+                                  'session': session,
+                                  'bill_id': bill_id},
+                                 fields=['votes'])
 
         if not bill:
-            _log.warning("Couldn't find bill %s" % data['bill_id'])
+            _log.warning("Couldn't find bill %s" % bill_id)
             continue
 
-        del data['bill_id']
+        for data in votes:
+            del data['bill_id']
 
-        try:
-            del data['filename']
-        except KeyError:
-            pass
+            try:
+                del data['filename']
+            except KeyError:
+                pass
 
-        for vtype in ('yes_votes', 'no_votes', 'other_votes'):
-            svlist = []
-            for svote in data[vtype]:
-                id = get_legislator_id(state, data['session'],
-                                       data['chamber'], svote)
-                svlist.append({'name': svote, 'leg_id': id})
+        merge_votes(bill, votes, counts)
 
-            data[vtype] = svlist
+    print 'imported %s vote files (%s)' % (len(paths),
+                                            format_counts(counts))
 
+
+def load_vote_hashes(state):
+    """
+    Load the set of content hashes stored on a state's bill votes.
+    """
+    hashes = set()
+    for bill in db.bills.find({'state': state,
+                               'votes._content_hash': {'$exists': True}},
+                              ['votes._content_hash']):
         for vote in bill['votes']:
-            if (vote['motion'] == data['motion']
-                and vote['date'] == data['date']):
-                vote.update(data)
-                break
+            if '_content_hash' in vote:
+                hashes.add(vote['_content_hash'])
+    return hashes
+
+
+def resolve_voters(state, vote_lists):
+    """
+    Replace the voter names in each vote with {'name', 'leg_id'} dicts,
+    resolving every distinct name once per (session, chamber).
+    """
+    vote_lists = list(vote_lists)
+
+    names = defaultdict(set)
+    for votes in vote_lists:
+        for vote in votes:
+            key = (vote['session'], vote['chamber'])
+            for vtype in _vote_types:
+                names[key].update(vote[vtype])
+
+    leg_ids = {}
+    for (session, chamber), vnames in names.iteritems():
+        leg_ids[(session, chamber)] = get_legislator_ids(state, session,
+                                                         chamber, vnames)
+
+    for votes in vote_lists:
+        for vote in votes:
+            ids = leg_ids[(vote['session'], vote['chamber'])]
+            for vtype in _vote_types:
+                vote[vtype] = [{'name': name, 'leg_id': ids[name]}
+                               for name in vote[vtype]]
+
+
+def merge_votes(bill, votes, counts):
+    """
+    Merge a list of standalone votes into a bill's existing votes
+    (matching on motion and date) and write the result back with a
+    single targeted update.
+
+    The number of inserted, updated and unchanged votes is added to
+    ``counts``.
+    """
+    existing = bill['votes']
+
+    # match the first of any existing votes sharing a motion and date
+    index = {}
+    for i, vote in enumerate(existing):
+        index.setdefault((vote['motion'], vote['date']), i)
+
+    changed = set()
+    new_votes = []
+    for data in votes:
+        key = (data['motion'], data['date'])
+        if key in index:
+            vote = existing[index[key]]
+            for k, v in data.iteritems():
+                if vote.get(k) != v:
+                    vote[k] = v
+                    changed.add(index[key])
+
+            if index[key] in changed:
+                counts['updated'] += 1
+            else:
+                counts['unchanged'] += 1
         else:
-            bill['votes'].append(data)
+            index[key] = len(existing)
+            existing.append(data)
+            new_votes.append(data)
+            counts['inserted'] += 1
 
-        db.bills.save(bill, safe=True)
+    if changed and new_votes:
+        # Mongo won't $set an array element and $push onto the same
+        # array in one update, so just replace the whole list
+        update = {'$set': {'votes': existing}}
+    elif changed:
+        update = {'$set': dict(('votes.%d' % i, existing[i])
+                               for i in changed)}
+    elif new_votes:
+        update = {'$pushAll': {'votes': new_votes}}
+    else:
+        return
 
-    print 'imported %s vote files' % len(paths)
+    update.setdefault('$set', {})['updated_at'] = datetime.datetime.utcnow()
+    db.bills.update({'_id': bill['_id']}, update, safe=True)
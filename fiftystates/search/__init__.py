@@ -0,0 +1,21 @@
+from fiftystates import settings
+
+_backend = None
+
+
+def get_backend():
+    """
+    Return the configured full-text search backend for bill versions
+    (see settings.SEARCH_BACKEND), or None if there isn't one.
+    """
+    global _backend
+
+    if _backend is None:
+        name = getattr(settings, 'SEARCH_BACKEND', None)
+        if name == 'sqlite':
+            from fiftystates.search.fts import FTSIndex
+            _backend = FTSIndex(settings.SEARCH_SQLITE_PATH)
+        elif name:
+            raise ValueError("unknown SEARCH_BACKEND %r" % name)
+
+    return _backend
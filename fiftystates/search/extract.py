@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+Extract plain text from stored bill versions for the search indexers.
+"""
+import os
+import re
+import logging
+import argparse
+import datetime
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+
+from fiftystates.backend import db, fs
+from fiftystates.backend.utils import base_arg_parser
+from fiftystates.backend.pipeline import PROCESSES, batched
+
+import lxml.html
+
+_log = logging.getLogger('fiftystates')
+
+# Number of files read from GridFS and handed to the pool at once
+EXTRACT_BATCH_SIZE = 50
+
+_whitespace_re = re.compile(r'[ \t\r\f\v]+')
+_blank_lines_re = re.compile(r'\n\s*\n+')
+
+
+def _run(command, data):
+    """
+    Run an external converter on ``data`` and return its stdout decoded
+    as UTF-8. The data is written to a temporary file whose path replaces
+    the None in ``command``.
+    """
+    fd, path = tempfile.mkstemp()
+    try:
+        os.write(fd, data)
+        os.close(fd)
+
+        command = [path if arg is None else arg for arg in command]
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode:
+            raise ValueError("%s failed: %s" % (command[0], err.strip()))
+    finally:
+        os.unlink(path)
+
+    return out.decode('utf-8', 'replace')
+
+
+def pdf_to_text(data):
+    return _run(['pdftotext', '-layout', '-enc', 'UTF-8', '-q', None, '-'],
+                data)
+
+
+def html_to_text(data):
+    doc = lxml.html.fromstring(data)
+    for el in doc.xpath('//script|//style'):
+        el.drop_tree()
+    return doc.text_content()
+
+
+def word_to_text(data):
+    return _run(['antiword', '-m', 'UTF-8.txt', None], data)
+
+
+def plain_to_text(data):
+    return data.decode('utf-8', 'replace')
+
+
+def _get_extractor(content_type, data):
+    content_type = (content_type or '').split(';')[0].strip().lower()
+
+    if content_type == 'application/pdf' or data.startswith('%PDF'):
+        return pdf_to_text
+    elif content_type == 'application/msword' or data.startswith(
+        '\xd0\xcf\x11\xe0'):
+        return word_to_text
+    elif 'html' in content_type or 'xml' in content_type:
+        return html_to_text
+    elif content_type.startswith('text/'):
+        return plain_to_text
+
+    return None
+
+
+def clean_text(text):
+    text = _whitespace_re.sub(' ', text)
+    text = _blank_lines_re.sub('\n\n', text)
+    return text.strip()
+
+
+def extract_text(id, content_type, data):
+    """
+    Convert a document's raw bytes to plain text. Returns a dict ready to
+    be saved in the document_text collection.
+    """
+    record = {'_id': id, 'sha256': hashlib.sha256(data).hexdigest(),
+              'extracted_at': datetime.datetime.utcnow()}
+
+    extractor = _get_extractor(content_type, data)
+    if not extractor:
+        record['text'] = None
+        record['error'] = 'unsupported content type %s' % content_type
+        return record
+
+    try:
+        record['text'] = clean_text(extractor(data))
+    except OSError:
+        # a missing converter shouldn't mark documents as failed
+        raise
+    except Exception, e:
+        record['text'] = None
+        record['error'] = str(e)
+
+    return record
+
+
+def _extract_text(args):
+    return extract_text(*args)
+
+
+def pending_files(state):
+    """
+    Yield the ids of the stored files used by a state's versions whose
+    text hasn't been extracted from their current content. Besides the
+    files stored for the state's bills these include the files that its
+    versions are aliases of, which may have been stored for another
+    state.
+    """
+    file_ids = set(doc['_id'] for doc in
+                   db.documents.files.find({'metadata.bill.state': state},
+                                           ['_id']))
+    file_ids.update(alias['file_id'] for alias in
+                    db.document_aliases.find({'metadata.bill.state': state},
+                                             ['file_id']))
+
+    for ids in batched(sorted(file_ids), 500):
+        extracted = dict((doc['_id'], doc['sha256']) for doc in
+                         db.document_text.find({'_id': {'$in': ids}},
+                                               ['sha256']))
+
+        for doc in db.documents.files.find({'_id': {'$in': ids}},
+                                           ['sha256']):
+            if doc['_id'] not in extracted:
+                yield doc['_id']
+            elif (doc.get('sha256') and
+                  doc['sha256'] != extracted[doc['_id']]):
+                yield doc['_id']
+
+
+def extract_state(state, processes=PROCESSES,
+                  batch_size=EXTRACT_BATCH_SIZE):
+    """
+    Extract the text of every stored file of a state that hasn't been
+    extracted yet, converting the files on a pool of processes.
+    """
+    pool = multiprocessing.Pool(processes)
+    counts = {'extracted': 0, 'failed': 0}
+
+    try:
+        for ids in batched(pending_files(state), batch_size):
+            jobs = []
+            for id in ids:
+                f = fs.get(id)
+                jobs.append((id, f.content_type, f.read()))
+
+            for record in pool.imap_unordered(_extract_text, jobs):
+                record['state'] = state
+                db.document_text.save(record, safe=True)
+
+                if record['text'] is None:
+                    _log.warning("Couldn't extract text from %s: %s" %
+                                 (record['_id'], record['error']))
+                    counts['failed'] += 1
+                else:
+                    counts['extracted'] += 1
+    finally:
+        pool.terminate()
+
+    db.document_text.ensure_index('state')
+
+    print 'extracted text from %d documents (%d failed)' % (
+        counts['extracted'], counts['failed'])
+
+
+def iter_version_texts(state, batch_size=500, indexed=None):
+    """
+    Yield lists of up to ``batch_size`` plain-text search documents, one
+    per downloaded version of a state's bills, in document id order.
+    Each document's '_sha256' is the hash of the stored file its text
+    was extracted from.
+
+    ``indexed`` maps the ids of versions that are already indexed to the
+    '_sha256' they were indexed with; they are left out unless their
+    file has changed since. Versions whose text hasn't been extracted
+    yet are left out too, for a later run to pick up. Versions that are
+    aliases of the same stored file share its text.
+    """
+    indexed = indexed or {}
+
+    aliases = dict((alias['_id'], alias['file_id']) for alias in
+                   db.document_aliases.find({'metadata.bill.state': state},
+                                            ['file_id']))
+
+    versions = []
+    spec = {'state': state, 'versions.document_id': {'$exists': True}}
+    for bill in db.bills.find(spec, ['bill_id', 'session', 'chamber',
+                                     'title', 'versions']):
+        for version in bill['versions']:
+            doc_id = version.get('document_id')
+            if doc_id:
+                versions.append((doc_id, bill, version))
+    versions.sort(key=lambda v: v[0])
+
+    # find what needs indexing from the hashes alone, without loading
+    # the text of versions that are already indexed
+    hashes = {}
+    file_ids = set(aliases.get(doc_id, doc_id)
+                   for doc_id, bill, version in versions)
+    for ids in batched(sorted(file_ids), 500):
+        for doc in db.document_text.find({'_id': {'$in': ids},
+                                          'text': {'$ne': None}},
+                                         ['sha256']):
+            hashes[doc['_id']] = doc.get('sha256')
+
+    pending = []
+    for doc_id, bill, version in versions:
+        file_id = aliases.get(doc_id, doc_id)
+        if file_id not in hashes:
+            _log.info("text of %s hasn't been extracted yet, skipping" %
+                      doc_id)
+        elif doc_id not in indexed or indexed[doc_id] != hashes[file_id]:
+            pending.append((doc_id, bill, version))
+
+    for batch in batched(pending, batch_size):
+        file_ids = set(aliases.get(doc_id, doc_id)
+                       for doc_id, bill, version in batch)
+        texts = dict((doc['_id'], doc['text']) for doc in
+                     db.document_text.find({'_id': {'$in': list(file_ids)}},
+                                           ['text']))
+
+        docs = []
+        for doc_id, bill, version in batch:
+            file_id = aliases.get(doc_id, doc_id)
+            text = texts.get(file_id)
+            if not text:
+                continue
+
+            docs.append({'id': doc_id,
+                         'state': state,
+                         'session': bill['session'],
+                         'chamber': bill['chamber'],
+                         'bill_id': bill['bill_id'],
+                         'bill_title': bill['title'],
+                         'document_name': version['name'],
+                         'url': version.get('url'),
+                         'text': text,
+                         '_sha256': hashes[file_id]})
+
+        if docs:
+            yield docs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        parents=[base_arg_parser],
+        description="Extract plain text from stored bill versions.")
+    parser.add_argument('-p', '--processes', type=int, default=PROCESSES,
+                        help='number of extraction processes')
+
+    args = parser.parse_args()
+
+    verbosity = {0: logging.WARNING,
+                 1: logging.INFO}.get(args.verbose, logging.DEBUG)
+
+    logging.basicConfig(level=verbosity,
+                        format=("%(asctime)s %(name)s %(levelname)s " +
+                                args.state + " %(message)s"),
+                        datefmt="%H:%M:%S")
+
+    extract_state(args.state, args.processes)
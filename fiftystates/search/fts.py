@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+An embedded full-text index of bill version text, built on SQLite FTS5.
+"""
+import re
+import logging
+import argparse
+import sqlite3
+import threading
+
+from fiftystates.backend.utils import base_arg_parser, bump_generation
+from fiftystates.search.extract import iter_version_texts
+
+_log = logging.getLogger('fiftystates')
+
+# the indexed columns, in table order
+_columns = ('id', 'state', 'session', 'chamber', 'bill_id', 'bill_title',
+            'document_name', 'url', 'text')
+
+_create_table = ("CREATE VIRTUAL TABLE IF NOT EXISTS versions USING fts5("
+                 "id UNINDEXED, state UNINDEXED, session UNINDEXED, "
+                 "chamber UNINDEXED, bill_id UNINDEXED, bill_title, "
+                 "document_name UNINDEXED, url UNINDEXED, text, "
+                 "tokenize='porter unicode61')")
+
+# bm25 column weights: matches in the bill's title count for more than
+# matches in the text, metadata columns aren't searched
+_weights = (0, 0, 0, 0, 0, 4.0, 0, 0, 1.0)
+
+_query_re = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+_token_re = re.compile(r'\w+', re.UNICODE)
+
+
+def fts_query(query):
+    """
+    Turn a user's search string into an FTS5 query: words must all
+    appear and "quoted phrases" must appear as written. Everything else
+    is dropped, so the result is always valid FTS5 syntax.
+
+    >>> fts_query('tax "motor vehicle" a-b')
+    u'"tax" "motor vehicle" "a b"'
+    """
+    if not isinstance(query, unicode):
+        query = query.decode('utf-8', 'replace')
+
+    terms = []
+    for phrase, word in _query_re.findall(query):
+        tokens = _token_re.findall((phrase or word).lower())
+        if tokens:
+            terms.append(u'"%s"' % u' '.join(tokens))
+    return u' '.join(terms)
+
+
+class FTSIndex(object):
+    """
+    A SQLite FTS5 index of extracted version text with bill metadata,
+    ranked with bm25.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute(_create_table)
+            conn.execute("CREATE TABLE IF NOT EXISTS indexed "
+                         "(id TEXT PRIMARY KEY, state TEXT, sha256 TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS indexed_state "
+                         "ON indexed (state)")
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE "
+                            "name = 'status'").fetchone():
+                # built when runs resumed after the last indexed id,
+                # which could skip versions; rebuild from scratch
+                conn.execute("DELETE FROM versions")
+                conn.execute("DROP TABLE status")
+                conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def update(self, state, full=False):
+        """
+        Add a state's newly extracted (or re-extracted) versions to the
+        index, or rebuild the state's part of the index if ``full`` is
+        True. Returns the number of versions added.
+        """
+        conn = self.conn
+
+        if full:
+            conn.execute("DELETE FROM versions WHERE state = ?", (state,))
+            conn.execute("DELETE FROM indexed WHERE state = ?", (state,))
+
+        indexed = dict(conn.execute("SELECT id, sha256 FROM indexed "
+                                    "WHERE state = ?", (state,)))
+
+        insert = "INSERT INTO versions (%s) VALUES (%s)" % (
+            ', '.join(_columns), ', '.join('?' * len(_columns)))
+
+        # each version is recorded in the indexed table in the same
+        # transaction that adds it, so it's never added twice
+        count = 0
+        for docs in iter_version_texts(state, indexed=indexed):
+            changed = [doc['id'] for doc in docs if doc['id'] in indexed]
+            if changed:
+                conn.execute("DELETE FROM versions WHERE id IN (%s)" %
+                             ', '.join('?' * len(changed)), changed)
+            conn.executemany(insert, [[doc.get(col) for col in _columns]
+                                      for doc in docs])
+            conn.executemany("INSERT OR REPLACE INTO indexed "
+                             "VALUES (?, ?, ?)",
+                             [(doc['id'], state, doc['_sha256'])
+                              for doc in docs])
+            conn.commit()
+            count += len(docs)
+
+        conn.commit()
+        return count
+
+    def search(self, query, state=None, session=None, chamber=None,
+               limit=100):
+        """
+        Return up to ``limit`` of the best matching versions for
+        ``query`` as dicts with the version's metadata, a 'score' (higher
+        is better) and a 'snippet' of the matching text.
+        """
+        match = fts_query(query)
+        if not match:
+            return []
+
+        sql = ["SELECT id, state, session, chamber, bill_id, document_name,"
+               " bm25(versions, %s) AS rank,"
+               " snippet(versions, %d, '<b>', '</b>', '...', 24)"
+               " FROM versions WHERE versions MATCH ?" % (
+                ', '.join(str(w) for w in _weights), _columns.index('text'))]
+        params = [match]
+
+        for col, value in (('state', state), ('session', session),
+                           ('chamber', chamber)):
+            if value:
+                sql.append("AND %s = ?" % col)
+                params.append(value)
+
+        sql.append("ORDER BY rank LIMIT ?")
+        params.append(limit)
+
+        results = []
+        for row in self.conn.execute(' '.join(sql), params):
+            results.append({'id': row[0], 'state': row[1], 'session': row[2],
+                            'chamber': row[3], 'bill_id': row[4],
+                            'document_name': row[5], 'score': -row[6],
+                            'snippet': row[7]})
+        return results
+
+
+if __name__ == '__main__':
+    from fiftystates.search import get_backend
+
+    parser = argparse.ArgumentParser(
+        parents=[base_arg_parser],
+        description="Update the embedded full-text index of bill versions.")
+    parser.add_argument('--full', action='store_true',
+                        help="rebuild the state's index from scratch")
+
+    args = parser.parse_args()
+
+    verbosity = {0: logging.WARNING,
+                 1: logging.INFO}.get(args.verbose, logging.DEBUG)
+
+    logging.basicConfig(level=verbosity,
+                        format=("%(asctime)s %(name)s %(levelname)s " +
+                                args.state + " %(message)s"),
+                        datefmt="%H:%M:%S")
+
+    backend = get_backend()
+    if backend is None:
+        print 'no full-text search backend is configured (SEARCH_BACKEND)'
+    else:
+        print 'indexed %d %s versions' % (backend.update(args.state,
+                                                         args.full),
+                                          args.state)
+        # full-text bill searches have changed
+        bump_generation(args.state)
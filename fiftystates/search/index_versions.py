@@ -1,49 +1,195 @@
 #!/usr/bin/env python
-import sys
+from __future__ import with_statement
+import re
+import Queue
 import logging
+import datetime
 import argparse
-
-from pymongo.son import SON
-
-import urllib
-import urllib2_file
+import threading
 import urllib2
+from xml.sax.saxutils import escape, quoteattr
 
-from fiftystates.backend import db, fs
+from fiftystates.backend import db
 from fiftystates.backend.utils import base_arg_parser
+from fiftystates.search.extract import iter_version_texts
+
+_log = logging.getLogger('fiftystates')
+
+# characters that aren't allowed in XML 1.0 documents
+_invalid_xml_re = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
 
 
-def import_versions(state, solr_url="http://localhost:8983/solr/"):
-    for bill in db.bills.find({'state': state}):
-        for version in bill['versions']:
-            if 'document_id' not in version:
+def solr_add_xml(docs, commit_within=None):
+    """
+    Build a Solr XML update message adding ``docs`` (dicts of field
+    name to value, None values and names starting with '_' are left
+    out).
+    """
+    if commit_within:
+        parts = [u'<add commitWithin="%d">' % commit_within]
+    else:
+        parts = [u'<add>']
+
+    for doc in docs:
+        parts.append(u'<doc>')
+        for name, value in sorted(doc.iteritems()):
+            if value is None or name.startswith('_'):
                 continue
+            if not isinstance(value, unicode):
+                value = str(value).decode('utf-8', 'replace')
+            value = _invalid_xml_re.sub(u' ', value)
+            parts.append(u'<field name=%s>%s</field>' % (quoteattr(name),
+                                                        escape(value)))
+        parts.append(u'</doc>')
+
+    parts.append(u'</add>')
+    return u''.join(parts).encode('utf-8')
+
+
+class SolrIndexer(object):
+    """
+    Posts a state's extracted version texts to Solr in batches of
+    ``batch_size`` documents, using ``workers`` concurrent connections.
+
+    Each version is recorded in the search_index.versions collection
+    once Solr has accepted it, so an interrupted or incremental run only
+    posts the versions that haven't been indexed (or whose file has
+    changed) since. Versions are downloaded concurrently, so their ids
+    don't arrive in order and a resume point wouldn't do. A commit is
+    sent at the end; if ``commit_within`` (milliseconds) is given, Solr
+    is also asked to make each batch visible within that time.
+    """
+
+    def __init__(self, solr_url='http://localhost:8983/solr/',
+                 batch_size=100, workers=2, commit_within=None, timeout=60):
+        if not solr_url.endswith('/'):
+            solr_url += '/'
+        self.update_url = solr_url + 'update'
+        self.batch_size = batch_size
+        self.workers = workers
+        self.commit_within = commit_within
+        self.timeout = timeout
+
+    def post(self, body):
+        req = urllib2.Request(self.update_url, body,
+                              {'Content-Type': 'text/xml; charset=utf-8'})
+        resp = urllib2.urlopen(req, timeout=self.timeout)
+        try:
+            resp.read()
+        finally:
+            resp.close()
+
+    def commit(self):
+        self.post('<commit/>')
+
+    def index_state(self, state, resume=True):
+        """
+        Index a state's version texts, returning the number of documents
+        posted.
+        """
+        db.search_index.versions.ensure_index('state')
+
+        if resume:
+            indexed = dict((doc['_id'], doc.get('sha256')) for doc in
+                           db.search_index.versions.find({'state': state},
+                                                         ['sha256']))
+            _log.info("%d %s versions already indexed" % (len(indexed),
+                                                          state))
+        else:
+            db.search_index.versions.remove({'state': state}, safe=True)
+            indexed = {}
+
+        progress = _Progress(state)
+        queue = Queue.Queue(self.workers * 2)
+
+        threads = []
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      args=(queue, progress))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for docs in iter_version_texts(state, self.batch_size, indexed):
+            queue.put(docs)
+
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+        self.commit()
+
+        print 'indexed %d %s versions (%d batches failed)' % (
+            progress.indexed, state, progress.failures)
+        return progress.indexed
+
+    def _work(self, queue, progress):
+        while True:
+            docs = queue.get()
+            if docs is None:
+                return
+
+            try:
+                self.post(solr_add_xml(docs, self.commit_within))
+            except Exception, e:
+                _log.error("Failed posting %s..%s: %s" %
+                           (docs[0]['id'], docs[-1]['id'], e))
+                progress.fail()
+            else:
+                progress.done(docs)
+
+
+class _Progress(object):
+    """
+    Counts the versions indexed and records each one in
+    search_index.versions.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.indexed = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def fail(self):
+        with self._lock:
+            self.failures += 1
 
-            doc = fs.get(version['document_id'])
+    def done(self, docs):
+        now = datetime.datetime.utcnow()
+        ids = [doc['id'] for doc in docs]
+        db.search_index.versions.remove({'_id': {'$in': ids}}, safe=True)
+        db.search_index.versions.insert([{'_id': doc['id'],
+                                          'state': self.state,
+                                          'sha256': doc['_sha256'],
+                                          'indexed_at': now}
+                                         for doc in docs], safe=True)
+        with self._lock:
+            self.indexed += len(docs)
 
-            params = {}
-            params['literal.bill_id'] = doc.metadata['bill']['bill_id']
-            params['literal.state'] = doc.metadata['bill']['state']
-            params['literal.chamber'] = doc.metadata['bill']['chamber']
-            params['literal.bill_title'] = (
-                doc.metadata['bill']['title'].encode('ascii', 'replace'))
-            params['literal.document_name'] = doc.metadata['name']
-            params['literal.url'] = doc.metadata['url']
-            params['literal.id'] = version['document_id']
-            params['commit'] = 'false'
 
-            url = "%supdate/extract?%s" % (solr_url, urllib.urlencode(params))
-            req = urllib2.Request(url, {'file': doc})
-            urllib2.urlopen(req)
+def index_versions(state, solr_url="http://localhost:8983/solr/",
+                   resume=True, **kwargs):
+    return SolrIndexer(solr_url, **kwargs).index_state(state, resume)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         parents=[base_arg_parser],
-        description="Download and store copies of bill versions.")
+        description="Index the text of stored bill versions in Solr.")
     parser.add_argument('-u', '--url', type=str, dest='url',
                         default='http://localhost:8983/solr/',
                         help='the solr instance URL')
+    parser.add_argument('-b', '--batch_size', type=int, default=100,
+                        help='number of documents posted at once')
+    parser.add_argument('-w', '--workers', type=int, default=2,
+                        help='number of concurrent posts')
+    parser.add_argument('--commit_within', type=int,
+                        help=('ask solr to make documents searchable within '
+                              'this many milliseconds'))
+    parser.add_argument('--full', action='store_true',
+                        help="reindex everything instead of resuming")
 
     args = parser.parse_args()
 
@@ -55,4 +201,6 @@ if __name__ == '__main__':
                                 args.state + " %(message)s"),
                         datefmt="%H:%M:%S")
 
-    import_versions(args.state, args.url)
+    index_versions(args.state, args.url, not args.full,
+                   batch_size=args.batch_size, workers=args.workers,
+                   commit_within=args.commit_within)
@@ -0,0 +1,345 @@
+"""
+A ranked inverted index over bill titles.
+
+Each (state, session) is indexed separately. A partition's bills are
+split into chunks of CHUNK_BILLS, each stored in title_index.chunks with
+the compressed postings of every keyword (see fiftystates.utils.keywordize)
+of its bills, so that no document gets near MongoDB's size limit. The
+title_index collection holds a header for each partition. Search
+processes keep the partitions they use in memory and reload them when an
+import rebuilds them.
+"""
+from __future__ import with_statement
+import math
+import time
+import heapq
+import datetime
+import threading
+
+from fiftystates.backend import db
+from fiftystates.backend.pipeline import batched
+from fiftystates.utils import keywordize, keywordize_many
+
+import pymongo
+from pymongo.binary import Binary
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# How often (in seconds) a search process checks for rebuilt partitions
+CHECK_INTERVAL = 60
+
+# Number of bills stored in each chunk of a partition
+CHUNK_BILLS = 2000
+
+
+def encode_postings(postings):
+    """
+    Compress a list of (doc number, term frequency) pairs, sorted by doc
+    number, as varint encoded doc number gaps and frequencies.
+
+    >>> decode_postings(encode_postings([(0, 1), (5, 2), (300, 1)]))
+    [(0, 1), (5, 2), (300, 1)]
+    """
+    out = bytearray()
+    last = 0
+    for doc, tf in postings:
+        for n in (doc - last, tf):
+            while n >= 0x80:
+                out.append((n & 0x7f) | 0x80)
+                n >>= 7
+            out.append(n)
+        last = doc
+    return str(out)
+
+
+def decode_postings(data):
+    postings = []
+    numbers = []
+    n = shift = 0
+    for byte in bytearray(data):
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            numbers.append(n)
+            n = shift = 0
+
+    doc = 0
+    for i in xrange(0, len(numbers), 2):
+        doc += numbers[i]
+        postings.append((doc, numbers[i + 1]))
+    return postings
+
+
+def bill_terms(bill):
+    """
+    Count the number of a bill's titles that each of its keywords
+    appears in.
+    """
+    terms = {}
+    titles = [bill['title']] + bill.get('alternate_titles', [])
+    for keywords in keywordize_many(titles):
+        for keyword in keywords:
+            terms[keyword] = terms.get(keyword, 0) + 1
+    return terms
+
+
+def _chunk(bills):
+    """
+    Build the index of a chunk of bills.
+    """
+    chambers = []
+    lengths = []
+    postings = {}
+
+    for doc, bill in enumerate(bills):
+        chambers.append(bill['chamber'])
+
+        terms = bill_terms(bill)
+        lengths.append(sum(terms.itervalues()))
+        for term, tf in terms.iteritems():
+            postings.setdefault(term, []).append((doc, tf))
+
+    return {'bills': [bill['_id'] for bill in bills],
+            'chambers': chambers, 'lengths': lengths,
+            'postings': dict(
+            (term, [len(plist), Binary(encode_postings(plist))])
+            for term, plist in postings.iteritems())}
+
+
+def build_partition(state, session):
+    """
+    (Re)build the title index of a state's session.
+
+    The new chunks are written before the partition's header is switched
+    over to them, and the old chunks are removed afterwards.
+    """
+    key = '%s:%s' % (state, session)
+    built_at = datetime.datetime.utcnow()
+    n = 0
+
+    bills = db.bills.find({'state': state, 'session': session},
+                          ['title', 'alternate_titles', 'chamber']).sort(
+        '_id', pymongo.ASCENDING)
+    for batch in batched(bills, CHUNK_BILLS):
+        chunk = _chunk(batch)
+        chunk.update({'partition': key, 'built_at': built_at, 'n': n})
+        db.title_index.chunks.insert(chunk, safe=True)
+        n += 1
+
+    db.title_index.save({'_id': key, 'state': state, 'session': session,
+                         'built_at': built_at, 'chunks': n}, safe=True)
+    db.title_index.chunks.remove({'partition': key,
+                                  'built_at': {'$ne': built_at}},
+                                 safe=True)
+
+
+def update_title_index(state, sessions=()):
+    """
+    Rebuild the title index of each of ``sessions``, along with any of
+    the state's sessions that haven't been indexed yet.
+    """
+    built = set(part['session'] for part in
+                db.title_index.find({'state': state}, ['session']))
+    sessions = set(sessions)
+    sessions.update(session for session in
+                    db.bills.find({'state': state}).distinct('session')
+                    if session not in built)
+
+    db.title_index.chunks.ensure_index([('partition', pymongo.ASCENDING),
+                                        ('built_at', pymongo.ASCENDING),
+                                        ('n', pymongo.ASCENDING)])
+    for session in sessions:
+        build_partition(state, session)
+
+    db.title_index.ensure_index('state')
+    return sessions
+
+
+class _Chunk(object):
+    def __init__(self, doc):
+        self.bills = doc['bills']
+        self.chambers = doc['chambers']
+        self.lengths = doc['lengths']
+        self.postings = doc['postings']
+
+    def df(self, term):
+        return self.postings.get(term, (0, None))[0]
+
+    def match(self, terms, chamber=None):
+        """
+        Return {doc: {term: tf}} for the docs containing all ``terms``,
+        intersecting postings starting from the shortest list.
+        """
+        terms = sorted(terms, key=self.df)
+        if not terms or not self.df(terms[0]):
+            return {}
+
+        matches = dict((doc, {terms[0]: tf}) for doc, tf in
+                       decode_postings(self.postings[terms[0]][1]))
+        if chamber:
+            matches = dict((doc, tfs) for doc, tfs in matches.iteritems()
+                           if self.chambers[doc] == chamber)
+
+        for term in terms[1:]:
+            if not matches:
+                break
+
+            found = {}
+            for doc, tf in decode_postings(self.postings[term][1]):
+                if doc in matches:
+                    matches[doc][term] = tf
+                    found[doc] = matches[doc]
+            matches = found
+
+        return matches
+
+
+class _Partition(object):
+    def __init__(self, doc, chunks):
+        self.state = doc['state']
+        self.session = doc['session']
+        self.built_at = doc['built_at']
+        self.chunks = [_Chunk(chunk) for chunk in chunks]
+        self.size = sum(len(chunk.bills) for chunk in self.chunks)
+        self.avg_length = (float(sum(sum(chunk.lengths)
+                                     for chunk in self.chunks)) /
+                           max(self.size, 1))
+
+    def df(self, term):
+        return sum(chunk.df(term) for chunk in self.chunks)
+
+
+class TitleIndex(object):
+    """
+    The in-memory side of the title index: loads partitions on demand
+    and answers ranked keyword queries against them.
+    """
+
+    def __init__(self, check_interval=CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._partitions = {}
+        self._built = {}
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        # find out which partitions exist and when they were built,
+        # dropping any that are out of date
+        with self._lock:
+            if time.time() - self._checked < self.check_interval:
+                return
+            self._checked = time.time()
+
+            built = {}
+            for part in db.title_index.find({}, ['state', 'session',
+                                                 'built_at']):
+                key = (part['state'], part['session'])
+                built[key] = part['built_at']
+
+                loaded = self._partitions.get(key)
+                if loaded and loaded.built_at != part['built_at']:
+                    del self._partitions[key]
+
+            for key in self._partitions.keys():
+                if key not in built:
+                    del self._partitions[key]
+
+            self._built = built
+
+    def _partition(self, key):
+        part = self._partitions.get(key)
+        if part is None:
+            doc = db.title_index.find_one({'_id': '%s:%s' % key})
+            if not doc:
+                return None
+
+            if 'chunks' in doc:
+                chunks = list(db.title_index.chunks.find(
+                        {'partition': doc['_id'],
+                         'built_at': doc['built_at']}).sort(
+                        'n', pymongo.ASCENDING))
+                if len(chunks) != doc['chunks']:
+                    # rebuilt since the header was read
+                    return None
+            else:
+                # built before partitions were split into chunks
+                chunks = [doc]
+
+            part = self._partitions[key] = _Partition(doc, chunks)
+        return part
+
+    def version(self, state=None):
+        """
+        When the newest partition of ``state`` (or of any state) that
+        this process searches was built, so that cached results can be
+        keyed on the version of the index that produced them.
+        """
+        self._refresh()
+        return max([built_at for key, built_at in self._built.iteritems()
+                    if not state or key[0] == state] or [None])
+
+    def has_state(self, state):
+        self._refresh()
+        return any(key[0] == state for key in self._built)
+
+    def search(self, query, state=None, sessions=None, chamber=None,
+               limit=None):
+        """
+        Return a list of (score, bill id) pairs for the bills whose
+        titles contain every keyword of ``query``, best first. Only the
+        top ``limit`` are returned if it's given.
+        """
+        terms = keywordize(query)
+        if not terms:
+            return []
+
+        self._refresh()
+
+        parts = []
+        for key in self._built:
+            if state and key[0] != state:
+                continue
+            if sessions is not None and key[1] not in sessions:
+                continue
+            part = self._partition(key)
+            if part:
+                parts.append(part)
+
+        # collection statistics over every partition searched, so that
+        # scores are comparable across partitions
+        total = sum(part.size for part in parts)
+        if not total:
+            return []
+        avg_length = (sum(part.avg_length * part.size
+                          for part in parts) / total)
+        idf = {}
+        for term in terms:
+            df = sum(part.df(term) for part in parts)
+            idf[term] = math.log(1 + (total - df + 0.5) / (df + 0.5))
+
+        results = []
+        for part in parts:
+            for chunk in part.chunks:
+                for doc, tfs in chunk.match(terms, chamber).iteritems():
+                    norm = K1 * (1 - B + B * chunk.lengths[doc] / avg_length)
+                    score = sum(idf[term] * tf * (K1 + 1) / (tf + norm)
+                                for term, tf in tfs.iteritems())
+                    results.append((score, chunk.bills[doc]))
+
+        if limit:
+            return heapq.nlargest(limit, results)
+        results.sort(reverse=True)
+        return results
+
+
+_index = None
+
+
+def get_title_index():
+    global _index
+    if _index is None:
+        _index = TitleIndex()
+    return _index
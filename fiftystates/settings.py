@@ -14,5 +14,18 @@ FIFTYSTATES_CACHE_DIR = os.path.abspath(os.path.join(os.path.abspath(
 FIFTYSTATES_ERROR_DIR = os.path.abspath(os.path.join(os.path.abspath(
             os.path.dirname(__file__)), '..', 'errors'))
 
+# Number of processes used to prepare scraped files for import,
+# None to use one per CPU
+IMPORT_PROCESSES = None
+
+# Fall back to fuzzy matching of sponsor/voter names that don't exactly
+# match a known form of a legislator's name
+FUZZY_NAME_MATCHING = False
+
+# Full-text search backend for bill versions: None or 'sqlite'
+SEARCH_BACKEND = None
+SEARCH_SQLITE_PATH = os.path.abspath(os.path.join(os.path.abspath(
+            os.path.dirname(__file__)), '..', 'search.sqlite'))
+
 NIMSP_API_KEY = ''
 VOTESMART_API_KEY = ''
@@ -0,0 +1,206 @@
+"""
+A cache of API responses in front of the piston resources.
+
+Responses are kept in each process and, if settings.API_CACHE_BACKEND
+names a Django cache backend (e.g. 'memcached://127.0.0.1:11211/', or
+'locmem://' when testing), in a cache shared between processes. Cache
+keys include the import generation of the requested state, which
+import_state.py bumps when it finishes, so an import invalidates a
+state's cached responses without anything having to be purged. They
+also include the version of the title index the process is searching,
+which is reloaded on its own schedule, so bill searches ranked on a
+stale index are never served once the process has reloaded it.
+"""
+from __future__ import with_statement
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from fiftystates.backend.utils import get_generation
+from fiftystates.search.titles import get_title_index
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.http import HttpResponse
+
+# Total size (in bytes) of the responses kept by each process
+LOCAL_SIZE = getattr(settings, 'API_CACHE_LOCAL_SIZE', 64 * 1024 * 1024)
+
+# Responses larger than this aren't cached (memcached's limit is 1MB)
+MAX_ITEM_SIZE = getattr(settings, 'API_CACHE_MAX_ITEM_SIZE', 1000 * 1000)
+
+# How long (in seconds) responses are kept in the shared cache
+TIMEOUT = getattr(settings, 'API_CACHE_TIMEOUT', 24 * 60 * 60)
+
+# How often (in seconds) a process checks a state's import generation
+CHECK_INTERVAL = getattr(settings, 'API_CACHE_CHECK_INTERVAL', 10)
+
+# query parameters that don't affect the response
+_ignored_params = ('apikey',)
+
+_state_re = re.compile(r'^[a-zA-Z]{2}$')
+
+
+class LRUCache(object):
+    """
+    A thread-safe in-process cache of strings (or (status, headers,
+    body) tuples) that evicts the least recently used entries once their
+    total size passes ``max_size`` bytes.
+
+    It has the get/set interface of Django's cache backends, so it can
+    stand in for the shared tier too.
+    """
+
+    def __init__(self, max_size=LOCAL_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = (value, size)
+            return value
+
+    def set(self, key, value, timeout=None):
+        size = len(value[-1] if isinstance(value, tuple) else value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self.size -= old[1]
+
+            self._entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_size and self._entries:
+                self.size -= self._entries.popitem(last=False)[1][1]
+
+
+class _Generations(object):
+    """
+    Each state's import generation, rechecked every ``check_interval``
+    seconds.
+    """
+
+    def __init__(self, check_interval=CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, state):
+        with self._lock:
+            gen, checked = self._generations.get(state, (None, 0))
+        if time.time() - checked < self.check_interval:
+            return gen
+
+        gen = get_generation(state)
+        with self._lock:
+            self._generations[state] = (gen, time.time())
+        return gen
+
+
+def request_state(request, kwargs):
+    """
+    Get the state a request is limited to from its URL or query, or
+    'all' if it isn't limited to one.
+    """
+    state = (kwargs.get('state') or request.GET.get('state') or
+             kwargs.get('id', '')[:2])
+    if _state_re.match(state):
+        return state.lower()
+    return 'all'
+
+
+class ResponseCache(object):
+    """
+    A two-tier cache of successful GET responses, keyed on the request's
+    path, query and emitter format and the generation of its state (and
+    the version of that state's title index).
+    """
+
+    def __init__(self, local, shared=None, max_item_size=MAX_ITEM_SIZE,
+                 timeout=TIMEOUT, generations=None, title_index=None):
+        self.local = local
+        self.shared = shared
+        self.max_item_size = max_item_size
+        self.timeout = timeout
+        self.generations = generations or _Generations()
+        self.title_index = title_index or get_title_index()
+
+    def key(self, request, format, kwargs):
+        state = request_state(request, kwargs)
+        query = sorted((name, sorted(values)) for name, values in
+                       request.GET.lists() if name not in _ignored_params)
+        key = repr((self.generations.get(state),
+                    self.title_index.version(state if state != 'all'
+                                             else None),
+                    state, request.path, format, query))
+        return 'api:' + hashlib.sha1(key).hexdigest()
+
+    def get(self, key):
+        """
+        Return the response cached under ``key``, or None.
+        """
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+
+        if value is None:
+            return None
+
+        status, headers, body = value
+        resp = HttpResponse(body, status=status)
+        for header, header_value in headers:
+            resp[header] = header_value
+        return resp
+
+    def store(self, key, resp):
+        """
+        Return a response equivalent to ``resp`` that caches its body
+        under ``key`` as it is sent (streamed responses keep streaming).
+        """
+        if resp.status_code != 200:
+            return resp
+
+        cached = HttpResponse(self._tee(key, resp), status=resp.status_code)
+        for header, value in resp.items():
+            cached[header] = value
+        return cached
+
+    def _tee(self, key, resp):
+        chunks = []
+        size = 0
+        for chunk in resp:
+            if chunks is not None:
+                size += len(chunk)
+                if size > self.max_item_size:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+
+        if chunks is not None:
+            value = (resp.status_code, resp.items(), ''.join(chunks))
+            self.local.set(key, value)
+            if self.shared is not None:
+                self.shared.set(key, value, self.timeout)
+
+
+_cache = None
+
+
+def get_response_cache():
+    global _cache
+    if _cache is None:
+        backend = getattr(settings, 'API_CACHE_BACKEND', None)
+        _cache = ResponseCache(LRUCache(),
+                               get_cache(backend) if backend else None)
+    return _cache
@@ -0,0 +1,94 @@
+"""
+ETag and Last-Modified validators for API responses, so that clients
+can poll with If-None-Match / If-Modified-Since and get a 304 back.
+"""
+import hashlib
+import calendar
+import datetime
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+from django.http import HttpResponseNotModified
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+def http_date(dt):
+    return formatdate(calendar.timegm(dt.utctimetuple()), usegmt=True)
+
+
+def validators(result, salt=''):
+    """
+    Return (etag, last_modified) header values for a handler's result,
+    a document or a list of documents, or (None, None) for anything
+    else. ``salt`` should describe anything else the response depends
+    on, such as the link to the next page.
+
+    Documents are identified by their _id and updated_at, or by a hash
+    of their content if they don't have them, so the document itself
+    never needs to be serialized. last_modified is a single document's
+    updated_at, or None. Lists only get an ETag: removing an object
+    from a list doesn't change the newest updated_at of the rest.
+    """
+    if isinstance(result, dict):
+        docs = [result]
+    elif isinstance(result, list):
+        docs = result
+    else:
+        return None, None
+
+    digest = hashlib.sha1(salt)
+
+    for doc in docs:
+        if not isinstance(doc, dict):
+            return None, None
+
+        updated_at = doc.get('updated_at')
+        if '_id' in doc and isinstance(updated_at, datetime.datetime):
+            digest.update(repr((doc['_id'], updated_at)))
+        else:
+            digest.update(json.dumps(doc, sort_keys=True, default=str))
+
+    last_modified = None
+    if isinstance(result, dict) and isinstance(result.get('updated_at'),
+                                               datetime.datetime):
+        last_modified = http_date(result['updated_at'])
+
+    return '"%s"' % digest.hexdigest(), last_modified
+
+
+def not_modified(request, etag, last_modified):
+    """
+    Check whether the client's copy of a response with the given
+    validators is still current.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if not etag:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        since = parsedate_tz(if_modified_since.split(';')[0])
+        if since:
+            modified = mktime_tz(parsedate_tz(last_modified))
+            return modified <= mktime_tz(since)
+
+    return False
+
+
+def set_validators(resp, etag, last_modified):
+    if etag:
+        resp['ETag'] = etag
+    if last_modified:
+        resp['Last-Modified'] = last_modified
+
+
+def not_modified_response(etag, last_modified):
+    resp = HttpResponseNotModified()
+    set_validators(resp, etag, last_modified)
+    return resp
@@ -1,8 +1,10 @@
+import re
 import json
 import datetime
 
 from fiftystates.site.api.feeds import EventFeed
 
+from django.http import HttpResponse
 from django.core.serializers.json import DateTimeAwareJSONEncoder
 from piston.emitters import Emitter, JSONEmitter
 
@@ -42,7 +44,89 @@ class OpenStateJSONEmitter(JSONEmitter):
         return obj
 
 
-class FeedEmitter(Emitter):
+class StreamingJSONEmitter(OpenStateJSONEmitter):
+    """
+    Like OpenStateJSONEmitter, but encodes the result one object at a
+    time and returns a generator of chunks, so that the response is sent
+    with chunked encoding instead of being serialized into one string.
+    """
+
+    chunk_size = 16 * 1024
+
+    _callback_re = re.compile(r'^[a-zA-Z_$][0-9a-zA-Z_$.]*$')
+
+    def render(self, request):
+        if isinstance(self.data, HttpResponse):
+            # piston sends responses returned by handlers (rc.BAD_REQUEST
+            # and the like) as they are
+            return self.data
+
+        callback = request.GET.get('callback')
+        if callback and not self._callback_re.match(callback):
+            callback = None
+
+        return self._chunks(self._encode(self.data, callback))
+
+    def stream_render(self, request, stream=True):
+        # render already returns a generator
+        return self.render(request)
+
+    def _encode(self, data, callback):
+        encoder = DateTimeAwareJSONEncoder(ensure_ascii=False)
+
+        if callback:
+            yield callback + '('
+
+        if isinstance(data, (dict, basestring)) or not hasattr(data,
+                                                                '__iter__'):
+            yield encoder.encode(self._clean(data))
+        else:
+            yield '['
+            first = True
+            for obj in data:
+                if not first:
+                    yield ', '
+                first = False
+                yield encoder.encode(self._clean(obj))
+            yield ']'
+
+        if callback:
+            yield ')'
+
+    def _chunks(self, pieces):
+        buf = []
+        size = 0
+        for piece in pieces:
+            if isinstance(piece, unicode):
+                piece = piece.encode('utf-8')
+            buf.append(piece)
+            size += len(piece)
+            if size >= self.chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+
+        if buf:
+            yield ''.join(buf)
+
+
+class BufferedEmitter(Emitter):
+    """
+    An emitter that renders its whole response before piston sends it,
+    even when the resource streams.
+
+    piston's default stream_render is a generator, so errors raised
+    while rendering (including responses returned by the handler, like
+    rc.NOT_FOUND) would only surface once the 200 had been sent.
+    """
+
+    def stream_render(self, request, stream=True):
+        if isinstance(self.data, HttpResponse):
+            return self.data
+        return self.render(request)
+
+
+class FeedEmitter(BufferedEmitter):
     """
     Emits an RSS feed from a list of Open State 'event' objects.
 
@@ -54,7 +138,7 @@ class FeedEmitter(Emitter):
         return EventFeed()(request, self.construct())
 
 
-class ICalendarEmitter(Emitter):
+class ICalendarEmitter(BufferedEmitter):
     """
     Emits an iCalendar-format calendar from a list of Open State 'event'
     object.
@@ -1,8 +1,14 @@
 import re
+import base64
 import datetime
 
 from fiftystates.backend import db
+from fiftystates.backend.utils import normalize
+from fiftystates.search import get_backend
+from fiftystates.search.titles import get_title_index
 from fiftystates.site.geo.models import District
+from fiftystates.site.api.conditional import (validators, not_modified,
+                                              not_modified_response)
 from fiftystates.utils import keywordize
 
 from django.http import HttpResponse
@@ -27,26 +33,215 @@ _chamber_aliases = {
     }
 
 
-def _build_mongo_filter(request, keys, icase=True):
-    # We use regex queries to get case insensitive search - this
-    # means they won't use any indexes for now. Real case insensitive
-    # queries are coming eventually:
-    # http://jira.mongodb.org/browse/SERVER-90
+def _build_mongo_filter(request, keys):
+    # state and chamber are stored lowercase; other fields are matched
+    # exactly against the lowercased copies the importers keep in
+    # '_norm', so that case-insensitive filters can use indexes
     _filter = {}
     for key in keys:
         value = request.GET.get(key)
         if value:
+            value = normalize(value)
             if key == 'chamber':
-                value = value.lower()
                 _filter[key] = _chamber_aliases.get(value, value)
+            elif key == 'state':
+                _filter[key] = value
             else:
-                _filter[key] = re.compile('^%s$' % value, re.IGNORECASE)
+                _filter['_norm.' + key] = value
     return _filter
 
 
+# Number of results returned by search methods by default, and at most
+DEFAULT_PER_PAGE = 100
+MAX_PER_PAGE = 500
+
+
+def _bad_request(message):
+    resp = rc.BAD_REQUEST
+    resp.write(": %s" % message)
+    return resp
+
+
+def _page_params(request):
+    """
+    Get the page size and decoded cursor (or None) from a search
+    request. Raises ValueError if either is invalid.
+    """
+    try:
+        per_page = int(request.GET.get('per_page', DEFAULT_PER_PAGE))
+        if per_page < 1:
+            raise ValueError
+    except ValueError:
+        raise ValueError("invalid per_page parameter, must be a positive "
+                         "integer")
+    per_page = min(per_page, MAX_PER_PAGE)
+
+    cursor = request.GET.get('cursor')
+    if cursor:
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            if not isinstance(cursor, dict):
+                raise ValueError
+        except (ValueError, TypeError):
+            raise ValueError("invalid cursor parameter")
+    else:
+        cursor = None
+
+    return per_page, cursor
+
+
+def _set_next_page(request, cursor):
+    """
+    Record the URL of the page following this request's results (the
+    same query with ``cursor``), to be sent in a Link header.
+    """
+    params = request.GET.copy()
+    params['cursor'] = base64.urlsafe_b64encode(json.dumps(cursor))
+    request.next_page = '%s?%s' % (request.build_absolute_uri(request.path),
+                                   params.urlencode())
+
+
+def _paginate(request, collection, spec, fields):
+    """
+    Return one page of the documents matching ``spec``, in ``_id``
+    order. The cursor holds the last ``_id`` of the previous page, so
+    each page is a range scan of the ``_id`` index.
+    """
+    per_page, cursor = _page_params(request)
+
+    if cursor:
+        if 'after' not in cursor:
+            raise ValueError("invalid cursor parameter")
+        spec['_id'] = {'$gt': cursor['after']}
+
+    results = list(collection.find(spec, fields).sort(
+            '_id', pymongo.ASCENDING).limit(per_page + 1))
+
+    if len(results) > per_page:
+        results = results[:per_page]
+        _set_next_page(request, {'after': results[-1]['_id']})
+
+    return results
+
+
+def _page_offset(request):
+    """
+    Return (offset, per_page) for paging through a ranked result list,
+    whose cursors hold the offset of the next page.
+    """
+    per_page, cursor = _page_params(request)
+
+    offset = 0
+    if cursor:
+        offset = cursor.get('offset')
+        if not isinstance(offset, int) or offset < 0:
+            raise ValueError("invalid cursor parameter")
+
+    return offset, per_page
+
+
+# Number of objects that can be requested at once from batch methods
+MAX_BATCH_IDS = 500
+
+
+def _batch_ids(request):
+    """
+    Get the comma separated ``ids`` parameter of a batch request (sent
+    as a GET parameter or POSTed, for long lists), without duplicates.
+    Raises ValueError if there are none or too many.
+    """
+    ids = []
+    seen = set()
+    for id in (request.GET.get('ids') or request.POST.get('ids') or
+               '').split(','):
+        id = id.strip()
+        if id and id not in seen:
+            seen.add(id)
+            ids.append(id)
+
+    if not ids:
+        raise ValueError("the ids parameter is required")
+    if len(ids) > MAX_BATCH_IDS:
+        raise ValueError("at most %d ids can be requested at once" %
+                         MAX_BATCH_IDS)
+    return ids
+
+
+def _batch_lookup(collection, ids, fields=None):
+    """
+    Look up the objects with any of ``ids`` (current or old ids) with a
+    single query, returning them in the order they were asked for.
+    """
+    found = {}
+    for obj in collection.find({'_all_ids': {'$in': ids}}, fields):
+        for id in obj['_all_ids']:
+            found[id] = obj
+
+    objs = []
+    seen = set()
+    for id in ids:
+        obj = found.get(id)
+        if obj and obj['_id'] not in seen:
+            seen.add(obj['_id'])
+            objs.append(obj)
+    return objs
+
+
+# a (possibly nested) field name, private fields can't be requested
+_field_re = re.compile(r'^\+?[a-zA-Z0-9][\w-]*(\.\+?[a-zA-Z0-9][\w-]*)*$')
+
+
+def _fields(request, default=None, required=()):
+    """
+    Get the Mongo projection for a request's comma separated ``fields``
+    parameter, which may name nested fields (e.g. ``actions.date``).
+    The ``required`` fields the handler needs are always included, and
+    so is ``id``. Returns ``default`` if no fields were asked for, and
+    raises ValueError if a field name is invalid.
+    """
+    value = request.GET.get('fields')
+    if not value:
+        return default
+
+    names = set()
+    for name in value.split(','):
+        name = name.strip()
+        if name == 'id':
+            # _id is always returned, _type lets the emitter expose it
+            continue
+        if not _field_re.match(name):
+            raise ValueError("invalid field name %r" % name)
+        names.add(name)
+    names.update(('_type',) + tuple(required))
+
+    # Mongo rejects projections of both a field and its subfields
+    fields = {}
+    for name in names:
+        parts = name.split('.')
+        if not any('.'.join(parts[:i]) in names
+                   for i in xrange(1, len(parts))):
+            fields[name] = 1
+    return fields
+
+
+def _parse_since(since):
+    """
+    Parse an updated_since parameter. Raises ValueError if it isn't a
+    date in YYYY-MM-DD or YYYY-MM-DD HH:MM format.
+    """
+    for format in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(since, format)
+        except ValueError:
+            pass
+    raise ValueError("invalid updated_since parameter. Please supply a "
+                     "date in YYYY-MM-DD format.")
+
+
 class FiftyStateHandlerMetaClass(HandlerMetaClass):
     """
-    Returns 404 if Handler result is None.
+    Returns 404 if Handler result is None, and 304 if the client's copy
+    of the result of a GET is current.
     """
     def __new__(cls, name, bases, attrs):
         new_cls = super(FiftyStateHandlerMetaClass, cls).__new__(
@@ -55,14 +250,28 @@ class FiftyStateHandlerMetaClass(HandlerMetaClass):
         if hasattr(new_cls, 'read'):
             old_read = new_cls.read
 
-            def new_read(*args, **kwargs):
-                obj = old_read(*args, **kwargs)
+            def new_read(self, request, *args, **kwargs):
+                obj = old_read(self, request, *args, **kwargs)
                 if isinstance(obj, HttpResponse):
                     return obj
 
                 if obj is None:
                     return rc.NOT_FOUND
 
+                # batch lookups POSTed by create() aren't conditional
+                if request.method not in ('GET', 'HEAD'):
+                    return obj
+
+                # answer conditional requests before anything is
+                # serialized, the resource sends the validators with
+                # full responses
+                etag, last_modified = validators(
+                    obj, getattr(request, 'next_page', None) or '')
+                request.etag = etag
+                request.last_modified = last_modified
+                if etag and not_modified(request, etag, last_modified):
+                    return not_modified_response(etag, last_modified)
+
                 return obj
 
             new_cls.read = new_read
@@ -83,7 +292,11 @@ class MetadataHandler(FiftyStateHandler):
         """
         Get metadata about a state legislature.
         """
-        return db.metadata.find_one({'_id': state.lower()})
+        try:
+            fields = _fields(request)
+        except ValueError, e:
+            return _bad_request(e)
+        return db.metadata.find_one({'_id': state.lower()}, fields)
 
 
 class BillHandler(FiftyStateHandler):
@@ -92,7 +305,57 @@ class BillHandler(FiftyStateHandler):
                  'bill_id': bill_id}
         if chamber:
             query['chamber'] = chamber.lower()
-        return db.bills.find_one(query)
+
+        try:
+            fields = _fields(request)
+        except ValueError, e:
+            return _bad_request(e)
+        return db.bills.find_one(query, fields)
+
+
+class BillBatchHandler(FiftyStateHandler):
+    """
+    Looks up many bills at once, given ids of the form
+    ``state|session|bill_id``.
+    """
+    allowed_methods = ('GET', 'POST')
+
+    def read(self, request):
+        try:
+            keys = []
+            for id in _batch_ids(request):
+                parts = id.split('|')
+                if len(parts) != 3 or not all(parts):
+                    raise ValueError("invalid bill id %r, must be "
+                                     "state|session|bill_id" % id)
+                keys.append((parts[0].lower(), parts[1], parts[2]))
+
+            fields = _fields(request, required=('state', 'session',
+                                                'bill_id'))
+        except ValueError, e:
+            return _bad_request(e)
+
+        # one $in on bill_id per state and session, usually just one
+        groups = {}
+        for state, session, bill_id in keys:
+            groups.setdefault((state, session), []).append(bill_id)
+        spec = {'$or': [{'state': state, 'session': session,
+                         'bill_id': {'$in': bill_ids}}
+                        for (state, session), bill_ids in
+                        groups.iteritems()]}
+
+        found = {}
+        for bill in db.bills.find(spec, fields):
+            key = (bill['state'], bill['session'], bill['bill_id'])
+            found.setdefault(key, []).append(bill)
+
+        bills = []
+        for key in keys:
+            bills.extend(found.get(key, []))
+        return bills
+
+    def create(self, request):
+        return self.read(request)
 
 
 class BillSearchHandler(FiftyStateHandler):
@@ -105,11 +368,17 @@ class BillSearchHandler(FiftyStateHandler):
         # normal mongo search logic
         _filter = _build_mongo_filter(request, ('state', 'chamber'))
 
-        # process full-text query
+        # process keyword query, unless searching the text of bills
         query = request.GET.get('q')
-        if query:
-            keywords = list(keywordize(query))
-            _filter['_keywords'] = {'$all': keywords}
+        full_text = request.GET.get('full_text', '').lower() == 'true'
+        state = request.GET.get('state', '').lower()
+        ranked = False
+        if query and not full_text:
+            if state and get_title_index().has_state(state):
+                ranked = True
+            else:
+                keywords = list(keywordize(query))
+                _filter['_keywords'] = {'$all': keywords}
 
         # process search_window
         search_window = request.GET.get('search_window', '').lower()
@@ -130,28 +399,188 @@ class BillSearchHandler(FiftyStateHandler):
                            "'term', 'session' or 'all'")
                 return resp
 
-        # process updated_since
-        since = request.GET.get('updated_since')
-        if since:
-            try:
-                _filter['since'] = datetime.datetime.strptime(since,
-                                                          "%Y-%m-%d %H:%M")
-            except ValueError:
-                try:
-                    _filter['since'] = datetime.datetime.strptime(since,
-                                                               "%Y-%m-%d")
-                except ValueError:
-                    resp = rc.BAD_REQUEST
-                    resp.write(": invalid updated_since parameter."
-                    " Please supply a date in YYYY-MM-DD format.")
-                    return resp
-
-        return list(db.bills.find(_filter, bill_fields))
+        try:
+            # text matches are attached to bills by these fields
+            required = ()
+            if query and full_text:
+                required = ('state', 'session', 'chamber', 'bill_id')
+            bill_fields = _fields(request, bill_fields, required)
+
+            # process updated_since
+            since = request.GET.get('updated_since')
+            if since:
+                _filter['updated_at'] = {'$gte': _parse_since(since)}
+
+            if query and full_text:
+                return self._search_text(request, query, _filter,
+                                         bill_fields)
+
+            if ranked:
+                return self._search_titles(request, query, state, _filter,
+                                           bill_fields)
+
+            return _paginate(request, db.bills, _filter, bill_fields)
+        except ValueError, e:
+            return _bad_request(e)
+
+    def _ranked_page(self, request, ids, _filter, bill_fields,
+                     filtered=False):
+        """
+        Return the page of bills requested from the ranked list of bill
+        ids, leaving out bills that don't match the other filters unless
+        the list is already ``filtered``.
+        """
+        offset, per_page = _page_offset(request)
+
+        if not filtered:
+            _filter['_id'] = {'$in': ids}
+            matching = set(bill['_id'] for bill in
+                           db.bills.find(_filter, ['_id']))
+            ids = [id for id in ids if id in matching]
+
+        page = ids[offset:offset + per_page]
+        if offset + per_page < len(ids):
+            _set_next_page(request, {'offset': offset + per_page})
+        if not page:
+            return []
+
+        _filter['_id'] = {'$in': page}
+        bills = dict((bill['_id'], bill) for bill in
+                     db.bills.find(_filter, bill_fields))
+
+        return [bills[id] for id in page if id in bills]
+
+    def _search_titles(self, request, query, state, _filter, bill_fields):
+        """
+        Find bills whose titles match ``query`` with the title index,
+        returning them best match first.
+
+        The index itself restricts matches to a chamber and sessions, so
+        when there are no other filters only the top matches up to the
+        requested page are ranked and no bills need to be checked.
+        """
+        sessions, others = self._title_filters(state, _filter)
+        chamber = _filter.get('chamber')
+
+        limit = None
+        if not others:
+            offset, per_page = _page_offset(request)
+            limit = offset + per_page + 1
+
+        ranked = get_title_index().search(query, state, sessions, chamber,
+                                          limit)
+        if not ranked:
+            return []
+
+        return self._ranked_page(request, [id for score, id in ranked],
+                                 _filter, bill_fields, filtered=not others)
+
+    def _title_filters(self, state, _filter):
+        """
+        Turn the session filter of a title search (from session or
+        search_window) into the list of sessions to search, or None for
+        all of them. Also returns the keys of any filters that the title
+        index can't apply.
+        """
+        others = set(_filter) - set(['state'])
+        if isinstance(_filter.get('chamber'), basestring):
+            others.remove('chamber')
+
+        sessions = None
+        if isinstance(_filter.get('session'), basestring):
+            sessions = [_filter['session']]
+            others.remove('session')
+        elif others & set(['_current_session', '_current_term', '_term']):
+            meta = db.metadata.find_one({'_id': state}, ['terms']) or {}
+            terms = meta.get('terms', [])
+
+            if '_term' in _filter:
+                terms = [t for t in terms if t['name'] == _filter['_term']]
+            else:
+                terms = terms[-1:]
+
+            sessions = []
+            for term in terms:
+                sessions.extend(term['sessions'])
+            if '_current_session' in _filter:
+                sessions = sessions[-1:]
+
+            others -= set(['_current_session', '_current_term', '_term'])
+
+        return sessions, others
+
+    def _search_text(self, request, query, _filter, bill_fields):
+        """
+        Search the text of bill versions with the configured search
+        backend, returning matching bills in order of relevance along
+        with their matching versions.
+        """
+        backend = get_backend()
+        if backend is None:
+            return _bad_request("full text search is not available")
+
+        hits = backend.search(query,
+                              state=request.GET.get('state', '').lower(),
+                              session=_filter.get('session'),
+                              chamber=_filter.get('chamber'))
+
+        keys = []
+        matches = {}
+        for hit in hits:
+            key = (hit['state'], hit['session'], hit['chamber'],
+                   hit['bill_id'])
+            if key not in matches:
+                keys.append(key)
+                matches[key] = []
+            matches[key].append({'document_id': hit['id'],
+                                 'name': hit['document_name'],
+                                 'snippet': hit['snippet']})
+
+        if not keys:
+            return []
+
+        _filter['$or'] = [{'state': state, 'session': session,
+                           'chamber': chamber, 'bill_id': bill_id}
+                          for state, session, chamber, bill_id in keys]
+
+        ids = {}
+        for bill in db.bills.find(_filter, ['state', 'session', 'chamber',
+                                            'bill_id']):
+            ids[(bill['state'], bill['session'], bill['chamber'],
+                 bill['bill_id'])] = bill['_id']
+        del _filter['$or']
+
+        bills = self._ranked_page(request,
+                                  [ids[key] for key in keys if key in ids],
+                                  _filter, bill_fields)
+        for bill in bills:
+            bill['text_matches'] = matches[(bill['state'], bill['session'],
+                                            bill['chamber'],
+                                            bill['bill_id'])]
+        return bills
 
 
 class LegislatorHandler(FiftyStateHandler):
     def read(self, request, id):
-        return db.legislators.find_one({'_all_ids': id})
+        try:
+            fields = _fields(request)
+        except ValueError, e:
+            return _bad_request(e)
+        return db.legislators.find_one({'_all_ids': id}, fields)
+
+
+class LegislatorBatchHandler(FiftyStateHandler):
+    allowed_methods = ('GET', 'POST')
+
+    def read(self, request):
+        try:
+            return _batch_lookup(db.legislators, _batch_ids(request),
+                                 _fields(request, required=('_all_ids',)))
+        except ValueError, e:
+            return _bad_request(e)
+
+    def create(self, request):
+        return self.read(request)
 
 
 class LegislatorSearchHandler(FiftyStateHandler):
@@ -172,7 +601,12 @@ class LegislatorSearchHandler(FiftyStateHandler):
         elif active:
             _filter['active'] = (active.lower() == 'true')
 
-        return list(db.legislators.find(_filter, legislator_fields))
+        try:
+            legislator_fields = _fields(request, legislator_fields)
+            return _paginate(request, db.legislators, _filter,
+                             legislator_fields)
+        except ValueError, e:
+            return _bad_request(e)
 
 
 class LegislatorGeoHandler(FiftyStateHandler):
@@ -191,7 +625,10 @@ class LegislatorGeoHandler(FiftyStateHandler):
             if not filters:
                 return []
 
-            return list(db.legislators.find({'$or': filters}))
+            return list(db.legislators.find({'$or': filters},
+                                            _fields(request)))
+        except ValueError, e:
+            return _bad_request(e)
         except KeyError:
             resp = rc.BAD_REQUEST
             resp.write(": Need lat and long parameters")
@@ -200,7 +637,25 @@ class LegislatorGeoHandler(FiftyStateHandler):
 
 class CommitteeHandler(FiftyStateHandler):
     def read(self, request, id):
-        return db.committees.find_one({'_all_ids': id})
+        try:
+            fields = _fields(request)
+        except ValueError, e:
+            return _bad_request(e)
+        return db.committees.find_one({'_all_ids': id}, fields)
+
+
+class CommitteeBatchHandler(FiftyStateHandler):
+    allowed_methods = ('GET', 'POST')
+
+    def read(self, request):
+        try:
+            return _batch_lookup(db.committees, _batch_ids(request),
+                                 _fields(request, required=('_all_ids',)))
+        except ValueError, e:
+            return _bad_request(e)
+
+    def create(self, request):
+        return self.read(request)
 
 
 class CommitteeSearchHandler(FiftyStateHandler):
@@ -209,7 +664,12 @@ class CommitteeSearchHandler(FiftyStateHandler):
 
         _filter = _build_mongo_filter(request, ('committee', 'subcommittee',
                                                 'chamber', 'state'))
-        return list(db.committees.find(_filter, committee_fields))
+        try:
+            committee_fields = _fields(request, committee_fields)
+            return _paginate(request, db.committees, _filter,
+                             committee_fields)
+        except ValueError, e:
+            return _bad_request(e)
 
 
 class StatsHandler(FiftyStateHandler):
@@ -224,12 +684,14 @@ class StatsHandler(FiftyStateHandler):
 
             if state == 'total':
                 val['legislators'] = db.legislators.count()
-                val['documents'] = db.documents.files.count()
+                val['documents'] = (db.documents.files.count() +
+                                    db.document_aliases.count())
             else:
                 val['legislators'] = db.legislators.find(
                     {'roles.state': state}).count()
-                val['documents'] = db.documents.files.find(
-                    {'metadata.bill.state': state}).count()
+                spec = {'metadata.bill.state': state}
+                val['documents'] = (db.documents.files.find(spec).count() +
+                                    db.document_aliases.find(spec).count())
 
             counts[state] = val
 
@@ -244,8 +706,13 @@ class EventsHandler(FiftyStateHandler):
         if events:
             return events
 
+        try:
+            fields = _fields(request)
+        except ValueError, e:
+            return _bad_request(e)
+
         if id:
-            return db.events.find_one({'_id': id})
+            return db.events.find_one({'_id': id}, fields)
 
         spec = {}
 
@@ -261,10 +728,128 @@ class EventsHandler(FiftyStateHandler):
             else:
                 spec[key] = {'$in': split}
 
-        return list(db.events.find(spec).sort(
+        return list(db.events.find(spec, fields).sort(
             'when', pymongo.DESCENDING).limit(20))
 
 
+# collections whose changes are listed by the changes feed
+CHANGE_TYPES = ('bills', 'committees', 'events', 'legislators')
+
+_cursor_time_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class ChangesHandler(FiftyStateHandler):
+    """
+    Lists the bills, legislators, committees and events added, updated
+    or removed after a point in time, oldest change first.
+    """
+
+    def read(self, request):
+        spec = {}
+        state = request.GET.get('state')
+        if state:
+            spec['state'] = state.lower()
+
+        types = CHANGE_TYPES
+        if request.GET.get('type'):
+            types = request.GET['type'].lower().split(',')
+            if not set(types) <= set(CHANGE_TYPES):
+                return _bad_request("invalid type. Valid choices are %s" %
+                                    ', '.join(CHANGE_TYPES))
+
+        try:
+            per_page, cursor = _page_params(request)
+
+            if cursor:
+                after = self._position(cursor)
+            elif request.GET.get('updated_since'):
+                # a position just before every change at that time
+                after = (_parse_since(request.GET['updated_since']), '', '')
+            else:
+                after = None
+
+            return self._changes(request, spec, types, after, per_page,
+                                 _fields(request))
+        except ValueError, e:
+            return _bad_request(e)
+
+    def _position(self, cursor):
+        try:
+            updated_at, source, id = cursor['after']
+            updated_at = datetime.datetime.strptime(updated_at,
+                                                    _cursor_time_format)
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("invalid cursor parameter")
+        return updated_at, source, id
+
+    def _changes(self, request, spec, types, after, per_page, fields=None):
+        """
+        Return the page of changes after the ``after`` position. Changes
+        are ordered by (updated_at, collection, _id), so each collection
+        is read with a range scan of its (state, updated_at, _id) index,
+        or of its (updated_at, _id) index for changes in every state.
+        """
+        keys = []
+        for source in list(types) + ['tombstones']:
+            source_spec = dict(spec)
+            if source == 'tombstones':
+                source_spec['type'] = {'$in': list(types)}
+
+            if after is None:
+                source_spec['updated_at'] = {'$ne': None}
+            elif source < after[1]:
+                source_spec['updated_at'] = {'$gt': after[0]}
+            elif source > after[1]:
+                source_spec['updated_at'] = {'$gte': after[0]}
+            else:
+                source_spec['$or'] = [{'updated_at': {'$gt': after[0]}},
+                                      {'updated_at': after[0],
+                                       '_id': {'$gt': after[2]}}]
+
+            for doc in db[source].find(source_spec, ['updated_at']).sort(
+                [('updated_at', pymongo.ASCENDING),
+                 ('_id', pymongo.ASCENDING)]).limit(per_page + 1):
+                keys.append((doc['updated_at'], source, doc['_id']))
+
+        keys.sort()
+        if len(keys) > per_page:
+            keys = keys[:per_page]
+            updated_at, source, id = keys[-1]
+            _set_next_page(request, {'after': [
+                        updated_at.strftime(_cursor_time_format), source,
+                        id]})
+
+        # then load the page's documents with one query per collection
+        ids = {}
+        for updated_at, source, id in keys:
+            ids.setdefault(source, []).append(id)
+
+        docs = {}
+        for source, source_ids in ids.iteritems():
+            # tombstones are sent whole, they're only identifying fields
+            for doc in db[source].find({'_id': {'$in': source_ids}},
+                                       None if source == 'tombstones'
+                                       else fields):
+                docs[(source, doc['_id'])] = doc
+
+        changes = []
+        for updated_at, source, id in keys:
+            doc = docs.get((source, id))
+            if doc is None:
+                continue
+
+            if source == 'tombstones':
+                changes.append({'_id': id, 'type': doc.pop('type'),
+                                'updated_at': updated_at, 'deleted': True,
+                                'object': doc})
+            else:
+                changes.append({'_id': id, 'type': source,
+                                'updated_at': updated_at, 'deleted': False,
+                                'object': doc})
+
+        return changes
+
+
 class ReconciliationHandler(BaseHandler):
     """
     An endpoint compatible with the Google Refine 2.0 reconciliation API.
@@ -7,10 +7,61 @@ from piston.emitters import Emitter
 
 from fiftystates.site.api.handlers import *
 from fiftystates.site.api.views import document, legislator_preview
+from fiftystates.site.api.cache import get_response_cache
+from fiftystates.site.api.conditional import (set_validators, not_modified,
+                                              not_modified_response)
 from fiftystates.site.api.models import LogEntry
-from fiftystates.site.api.emitters import OpenStateJSONEmitter
+from fiftystates.site.api.emitters import StreamingJSONEmitter
 from fiftystates.site.api.emitters import FeedEmitter, ICalendarEmitter
 
+
+class PagedResource(piston.resource.Resource):
+    """
+    Sends a Link header pointing to the next page of results when a
+    search handler has set one, ETag and Last-Modified headers for the
+    handler's result, and serves GET requests from the response cache if
+    ``cache`` is True.
+    """
+
+    def __init__(self, handler, authentication=None, cache=False):
+        super(PagedResource, self).__init__(handler, authentication)
+        # let piston stream the emitter's output instead of buffering it
+        # (Resource.__init__ sets this from PISTON_STREAM_OUTPUT)
+        self.stream = True
+        self.response_cache = cache and get_response_cache()
+
+    def __call__(self, request, *args, **kwargs):
+        key = None
+        if self.response_cache and request.method == 'GET':
+            # never serve cached responses to unauthorized callers
+            actor, anonymous = self.authenticate(request, 'GET')
+            if anonymous is not piston.resource.CHALLENGE:
+                key = self.response_cache.key(
+                    request, self.determine_emitter(request, *args,
+                                                    **kwargs), kwargs)
+                resp = self.response_cache.get(key)
+                if resp is not None:
+                    etag = resp.get('ETag')
+                    last_modified = resp.get('Last-Modified')
+                    if not_modified(request, etag, last_modified):
+                        return not_modified_response(etag, last_modified)
+                    return resp
+
+        resp = super(PagedResource, self).__call__(request, *args, **kwargs)
+
+        next_page = getattr(request, 'next_page', None)
+        if next_page:
+            resp['Link'] = '<%s>; rel="next"' % next_page
+
+        set_validators(resp, getattr(request, 'etag', None),
+                       getattr(request, 'last_modified', None))
+
+        if key:
+            resp = self.response_cache.store(key, resp)
+
+        return resp
+
+
 if getattr(settings, 'USE_LOCKSMITH', False):
     from locksmith.auth.authentication import PistonKeyAuthentication
 
@@ -23,7 +74,7 @@ if getattr(settings, 'USE_LOCKSMITH', False):
 
     authorizer = Authorizer()
 
-    class Resource(piston.resource.Resource):
+    class Resource(PagedResource):
         def __call__(self, request, *args, **kwargs):
             resp = super(Resource, self).__call__(request, *args, **kwargs)
 
@@ -39,9 +90,9 @@ if getattr(settings, 'USE_LOCKSMITH', False):
             return resp
 else:
     authorizer = None
-    Resource = piston.resource.Resource
+    Resource = PagedResource
 
-Emitter.register('json', OpenStateJSONEmitter,
+Emitter.register('json', StreamingJSONEmitter,
                  'application/json; charset=utf-8')
 
 Emitter.register('rss', FeedEmitter, 'application/rss+xml')
@@ -52,19 +103,32 @@ Emitter.unregister('yaml')
 Emitter.unregister('django')
 Emitter.unregister('pickle')
 
-metadata_handler = Resource(MetadataHandler, authentication=authorizer)
-bill_handler = Resource(BillHandler, authentication=authorizer)
-bill_search_handler = Resource(BillSearchHandler, authentication=authorizer)
-legislator_handler = Resource(LegislatorHandler, authentication=authorizer)
+metadata_handler = Resource(MetadataHandler, authentication=authorizer,
+                            cache=True)
+bill_handler = Resource(BillHandler, authentication=authorizer, cache=True)
+bill_batch_handler = Resource(BillBatchHandler, authentication=authorizer,
+                              cache=True)
+bill_search_handler = Resource(BillSearchHandler, authentication=authorizer,
+                               cache=True)
+legislator_handler = Resource(LegislatorHandler, authentication=authorizer,
+                              cache=True)
+legislator_batch_handler = Resource(LegislatorBatchHandler,
+                                    authentication=authorizer, cache=True)
 legsearch_handler = Resource(LegislatorSearchHandler,
-                             authentication=authorizer)
+                             authentication=authorizer, cache=True)
 legislator_geo_handler = Resource(LegislatorGeoHandler,
                                   authentication=authorizer)
-committee_handler = Resource(CommitteeHandler, authentication=authorizer)
+committee_handler = Resource(CommitteeHandler, authentication=authorizer,
+                             cache=True)
+committee_batch_handler = Resource(CommitteeBatchHandler,
+                                   authentication=authorizer, cache=True)
 committee_search_handler = Resource(CommitteeSearchHandler,
-                                    authentication=authorizer)
+                                    authentication=authorizer, cache=True)
 stats_handler = Resource(StatsHandler, authentication=authorizer)
-events_handler = Resource(EventsHandler, authentication=authorizer)
+changes_handler = Resource(ChangesHandler, authentication=authorizer,
+                           cache=True)
+events_handler = Resource(EventsHandler, authentication=authorizer,
+                          cache=True)
 reconciliation_handler = Resource(ReconciliationHandler,
                                   authentication=authorizer)
 
@@ -78,13 +142,16 @@ urlpatterns = patterns('',
     url(r'^v1/bills/(?P<state>[a-zA-Z]{2,2})/(?P<session>.+)/'
         r'(?P<bill_id>.+)/$', bill_handler),
     url(r'^v1/bills/$', bill_search_handler),
+    url(r'^v1/bills/batch/$', bill_batch_handler),
 
     url(r'^v1/legislators/(?P<id>[A-Z]{2,2}L\d{6,6})/$', legislator_handler),
     url(r'^v1/legislators/$', legsearch_handler),
+    url(r'^v1/legislators/batch/$', legislator_batch_handler),
     url(r'^v1/legislators/geo/$', legislator_geo_handler),
 
     url(r'^v1/committees/(?P<id>[A-Z]{2,2}C\d{6,6})/$', committee_handler),
     url(r'^v1/committees/$', committee_search_handler),
+    url(r'^v1/committees/batch/$', committee_batch_handler),
 
     url(r'^v1/documents/(?P<id>[A-Z]{2,2}D\d{8,8})/$', document),
 
@@ -95,5 +162,7 @@ urlpatterns = patterns('',
     url(r'^v1/legislators/preview/(?P<id>[A-Z]{2,2}L\d{6,6})/$',
         legislator_preview),
 
+    url(r'^v1/changes/$', changes_handler),
+
     url(r'^v1/stats/$', stats_handler),
 )
@@ -1,4 +1,5 @@
-from fiftystates.backend import db, fs
+from fiftystates.backend import db
+from fiftystates.backend.utils import get_document
 
 from django.http import HttpResponse, Http404
 from django.shortcuts import render_to_response
@@ -8,7 +9,7 @@ import gridfs
 
 def document(request, id):
     try:
-        doc = fs.get(id)
+        doc = get_document(id)[0]
     except gridfs.NoFile:
         raise Http404
 
@@ -90,6 +90,9 @@ INSTALLED_APPS = (
     'locksmith.auth',
 )
 
+# Django cache backend shared by API processes for cached responses
+# (see fiftystates.site.api.cache), e.g. 'memcached://127.0.0.1:11211/'
+API_CACHE_BACKEND = None
 
 try:
     from local_settings import *
@@ -0,0 +1,52 @@
+"""
+Tests of the importers, search and API. Those that need a MongoDB
+server use the database named by OPENSTATES_MONGO_DATABASE
+(fiftystates_test by default), which they empty as they go. Tests are
+skipped if the server (or Django, for the API) isn't available.
+
+Run them with ``python -m unittest discover fiftystates/tests``.
+"""
+import os
+import unittest
+import threading
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+
+os.environ.setdefault('OPENSTATES_MONGO_DATABASE', 'fiftystates_test')
+
+from pymongo.errors import ConnectionFailure
+
+try:
+    from fiftystates.backend import db
+except ConnectionFailure:
+    db = None
+
+requires_mongo = unittest.skipIf(db is None, 'no MongoDB server available')
+
+
+def reset_db():
+    for name in db.collection_names():
+        if not name.startswith('system.'):
+            db.drop_collection(name)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    A local HTTP server that answers requests with ``handler`` (a
+    BaseHTTPRequestHandler subclass) on a background thread, for
+    testing code that talks to other services.
+    """
+    daemon_threads = True
+
+    def __init__(self, handler, host='127.0.0.1'):
+        HTTPServer.__init__(self, (host, 0), handler)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path='/', host='127.0.0.1'):
+        return 'http://%s:%d%s' % (host, self.server_port, path)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
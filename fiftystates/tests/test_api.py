@@ -0,0 +1,232 @@
+import json
+import base64
+import datetime
+import unittest
+import urlparse
+
+from pymongo.errors import ConnectionFailure
+
+try:
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure()
+    from django.http import HttpRequest, HttpResponse, QueryDict
+    from fiftystates.site.api.conditional import validators
+    from fiftystates.site.api.emitters import StreamingJSONEmitter
+except ImportError:
+    validators = None
+
+try:
+    from fiftystates.site.api import handlers
+except (ImportError, ConnectionFailure):
+    handlers = None
+
+requires_django = unittest.skipIf(validators is None,
+                                  'Django or piston is not available')
+requires_handlers = unittest.skipIf(handlers is None,
+                                    "the API handlers can't be imported")
+
+
+def make_request(query=''):
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = '/api/v1/bills/'
+    request.GET = QueryDict(query)
+    request.META = {'SERVER_NAME': 'example.com', 'SERVER_PORT': '80'}
+    return request
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor))
+
+
+@requires_handlers
+class FilterTest(unittest.TestCase):
+
+    def test_build_mongo_filter(self):
+        request = make_request('state=EX&chamber=Senate&party= Democrat'
+                               '&district=&session=2010')
+        self.assertEqual(handlers._build_mongo_filter(
+                request, ('state', 'chamber', 'party', 'district')),
+                         {'state': 'ex', 'chamber': 'upper',
+                          '_norm.party': 'democrat'})
+
+    def test_chamber_aliases(self):
+        for chamber, expected in (('house', 'lower'), ('Assembly', 'lower'),
+                                  ('upper', 'upper'), ('joint', 'joint')):
+            request = make_request('chamber=' + chamber)
+            self.assertEqual(handlers._build_mongo_filter(
+                    request, ('chamber',)), {'chamber': expected})
+
+
+@requires_handlers
+class CursorTest(unittest.TestCase):
+
+    def test_page_params(self):
+        self.assertEqual(handlers._page_params(make_request()),
+                         (handlers.DEFAULT_PER_PAGE, None))
+        self.assertEqual(handlers._page_params(make_request('per_page=10')),
+                         (10, None))
+        self.assertEqual(handlers._page_params(
+                make_request('per_page=100000')),
+                         (handlers.MAX_PER_PAGE, None))
+
+        for per_page in ('0', '-1', 'x'):
+            self.assertRaises(ValueError, handlers._page_params,
+                              make_request('per_page=' + per_page))
+
+    def test_next_page(self):
+        request = make_request('state=ex&cursor=old&per_page=10')
+        handlers._set_next_page(request, {'after': 'EXB00000010'})
+
+        url = urlparse.urlparse(request.next_page)
+        self.assertEqual(url.netloc, 'example.com')
+        self.assertEqual(url.path, '/api/v1/bills/')
+
+        query = urlparse.parse_qs(url.query)
+        self.assertEqual(query['state'], ['ex'])
+        self.assertEqual(query['per_page'], ['10'])
+
+        # the next page's request decodes the cursor it was sent
+        next_request = make_request(url.query)
+        self.assertEqual(handlers._page_params(next_request),
+                         (10, {'after': 'EXB00000010'}))
+
+    def test_invalid_cursors(self):
+        for cursor in ('not base64!', base64.urlsafe_b64encode('not json'),
+                       encode_cursor([1, 2])):
+            self.assertRaises(ValueError, handlers._page_params,
+                              make_request('cursor=' + cursor))
+
+    def test_page_offset(self):
+        self.assertEqual(handlers._page_offset(make_request('per_page=5')),
+                         (0, 5))
+        self.assertEqual(handlers._page_offset(make_request(
+                    'cursor=' + encode_cursor({'offset': 20}))),
+                         (20, handlers.DEFAULT_PER_PAGE))
+
+        for cursor in ({'offset': -1}, {'offset': '20'}, {'after': 'x'}):
+            self.assertRaises(ValueError, handlers._page_offset,
+                              make_request('cursor=' + encode_cursor(cursor)))
+
+
+@requires_handlers
+class FieldsTest(unittest.TestCase):
+
+    def fields(self, value, **kwargs):
+        return handlers._fields(make_request('fields=' + value), **kwargs)
+
+    def test_default(self):
+        self.assertEqual(handlers._fields(make_request()), None)
+        self.assertEqual(handlers._fields(make_request('fields='),
+                                          default={'title': 1}),
+                         {'title': 1})
+
+    def test_fields(self):
+        self.assertEqual(self.fields('id, title,actions.date,%2Bextra'),
+                         {'_type': 1, 'title': 1, 'actions.date': 1,
+                          '+extra': 1})
+        self.assertEqual(self.fields('title', required=('state',)),
+                         {'_type': 1, 'title': 1, 'state': 1})
+
+    def test_subfields(self):
+        # a field and its subfields can't both be projected
+        self.assertEqual(self.fields('actions.date,actions,votes.date'),
+                         {'_type': 1, 'actions': 1, 'votes.date': 1})
+
+    def test_invalid(self):
+        for value in ('_id', 'actions._norm', 'a..b', 'title,', '$where'):
+            self.assertRaises(ValueError, self.fields, value)
+
+
+@requires_django
+class ValidatorsTest(unittest.TestCase):
+    updated_at = datetime.datetime(2010, 7, 1, 12, 30)
+
+    def test_document(self):
+        doc = {'_id': 'EXB1', 'updated_at': self.updated_at}
+        etag, last_modified = validators(doc)
+        self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+        self.assertEqual(last_modified, 'Thu, 01 Jul 2010 12:30:00 GMT')
+
+        # only the id and update time identify the document
+        self.assertEqual(validators(dict(doc, title='x'))[0], etag)
+        self.assertNotEqual(validators(dict(
+                    doc, updated_at=self.updated_at +
+                    datetime.timedelta(seconds=1)))[0], etag)
+        self.assertNotEqual(validators(doc, salt='next')[0], etag)
+
+    def test_list(self):
+        docs = [{'_id': 'EXB1', 'updated_at': self.updated_at},
+                {'_id': 'EXB2', 'updated_at': self.updated_at}]
+        etag, last_modified = validators(docs)
+        self.assertEqual(last_modified, None)
+
+        self.assertNotEqual(validators(docs[:1])[0], etag)
+        self.assertNotEqual(validators(docs[::-1])[0], etag)
+        self.assertNotEqual(validators([])[0], etag)
+
+    def test_content(self):
+        # documents without an update time are hashed
+        etag, last_modified = validators({'state': 'ex'})
+        self.assertEqual(last_modified, None)
+        self.assertEqual(validators({'state': 'ex'})[0], etag)
+        self.assertNotEqual(validators({'state': 'ey'})[0], etag)
+
+    def test_other(self):
+        self.assertEqual(validators(None), (None, None))
+        self.assertEqual(validators(HttpResponse('x')), (None, None))
+        self.assertEqual(validators(['x']), (None, None))
+
+
+@requires_django
+class StreamingJSONEmitterTest(unittest.TestCase):
+
+    def render(self, data, query=''):
+        emitter = StreamingJSONEmitter(data, {}, None)
+        result = emitter.render(make_request(query))
+        if isinstance(result, HttpResponse):
+            return result
+        return ''.join(result)
+
+    def test_clean(self):
+        data = [{'_id': 'EXL1', '_type': 'person', '_norm': {'x': 1},
+                 'full_name': 'Jane Smith',
+                 'roles': [{'_norm': {}, 'district': '1'}]},
+                {'_id': 'EXB1', '_type': 'bill', 'title': 'A bill',
+                 'updated_at': datetime.datetime(2010, 7, 1)}]
+        self.assertEqual(json.loads(self.render(data)),
+                         [{'id': 'EXL1', 'full_name': 'Jane Smith',
+                           'roles': [{'district': '1'}]},
+                          {'title': 'A bill',
+                           'updated_at': '2010-07-01 00:00:00'}])
+
+    def test_single_object(self):
+        self.assertEqual(json.loads(self.render({'_id': 'x', 'a': 1})),
+                         {'a': 1})
+        self.assertEqual(json.loads(self.render(u'\xe9')), u'\xe9')
+
+    def test_chunks(self):
+        emitter = StreamingJSONEmitter([{'text': 'x' * 100}] * 10, {}, None)
+        emitter.chunk_size = 300
+        chunks = list(emitter.render(make_request()))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(len(json.loads(''.join(chunks))), 10)
+
+    def test_jsonp(self):
+        self.assertEqual(self.render([{'a': 1}], 'callback=jQuery.cb_1'),
+                         'jQuery.cb_1([{"a": 1}])')
+
+        # anything that isn't a plain name is ignored
+        for callback in ('alert(1);x', '1abc', 'a b'):
+            self.assertEqual(self.render([{'a': 1}],
+                                         'callback=' + callback),
+                             '[{"a": 1}]')
+
+    def test_responses_passed_through(self):
+        resp = HttpResponse('Not Found', status=404)
+        self.assertTrue(self.render(resp) is resp)
+
+
+if __name__ == '__main__':
+    unittest.main()
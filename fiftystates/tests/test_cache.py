@@ -0,0 +1,215 @@
+import time
+import unittest
+
+from pymongo.errors import ConnectionFailure
+
+try:
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure()
+    from django.http import HttpRequest, HttpResponse, QueryDict
+    from fiftystates.site.api import cache
+except (ImportError, ConnectionFailure):
+    cache = None
+
+requires_django = unittest.skipIf(cache is None, 'Django is not available')
+
+
+def make_request(path, query=''):
+    request = HttpRequest()
+    request.path = path
+    request.GET = QueryDict(query)
+    return request
+
+
+class FakeGenerations(object):
+    def __init__(self):
+        self.generations = {}
+
+    def get(self, state):
+        return self.generations.get(state, 0)
+
+
+class FakeTitleIndex(object):
+    def __init__(self):
+        self.versions = {}
+        self.asked = []
+
+    def version(self, state=None):
+        self.asked.append(state)
+        return self.versions.get(state)
+
+
+@requires_django
+class LRUCacheTest(unittest.TestCase):
+    def test_get_and_set(self):
+        lru = cache.LRUCache(100)
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.get('a', 'default'), 'default')
+
+        lru.set('a', (200, [], 'x' * 10))
+        self.assertEqual(lru.get('a'), (200, [], 'x' * 10))
+        self.assertEqual(lru.size, 10)
+
+        # replacing an entry replaces its size
+        lru.set('a', (200, [], 'x' * 20))
+        self.assertEqual(lru.size, 20)
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(30)
+        lru.set('a', 'x' * 10)
+        lru.set('b', 'x' * 10)
+        lru.set('c', 'x' * 10)
+
+        # reading 'a' makes 'b' the least recently used
+        lru.get('a')
+        lru.set('d', 'x' * 10)
+
+        self.assertEqual(lru.get('b'), None)
+        for key in 'acd':
+            self.assertEqual(lru.get(key), 'x' * 10)
+        self.assertEqual(lru.size, 30)
+
+    def test_oversized_entry(self):
+        lru = cache.LRUCache(10)
+        lru.set('a', 'x' * 5)
+        lru.set('b', 'x' * 20)
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.size, 0)
+
+
+@requires_django
+class GenerationsTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.generation = 1
+        self.get_generation = cache.get_generation
+
+        def get_generation(state):
+            self.calls.append(state)
+            return self.generation
+        cache.get_generation = get_generation
+
+    def tearDown(self):
+        cache.get_generation = self.get_generation
+
+    def test_rechecks_after_interval(self):
+        generations = cache._Generations(check_interval=60)
+        self.assertEqual(generations.get('ex'), 1)
+
+        self.generation = 2
+        self.assertEqual(generations.get('ex'), 1)
+        self.assertEqual(self.calls, ['ex'])
+
+        # other states are checked separately
+        self.assertEqual(generations.get('ey'), 2)
+
+        generations._generations['ex'] = (1, time.time() - 61)
+        self.assertEqual(generations.get('ex'), 2)
+        self.assertEqual(self.calls, ['ex', 'ey', 'ex'])
+
+
+@requires_django
+class ResponseCacheKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.generations = FakeGenerations()
+        self.titles = FakeTitleIndex()
+        self.cache = cache.ResponseCache(cache.LRUCache(),
+                                         generations=self.generations,
+                                         title_index=self.titles)
+
+    def key(self, path, query='', format='json', **kwargs):
+        return self.cache.key(make_request(path, query), format, kwargs)
+
+    def test_request_state(self):
+        self.assertEqual(cache.request_state(make_request('/'),
+                                             {'state': 'EX'}), 'ex')
+        self.assertEqual(cache.request_state(make_request('/', 'state=ex'),
+                                             {}), 'ex')
+        self.assertEqual(cache.request_state(make_request('/'),
+                                             {'id': 'EXB00000001'}), 'ex')
+        self.assertEqual(cache.request_state(make_request('/'), {}), 'all')
+
+    def test_query_order_and_ignored_params(self):
+        key = self.key('/api/bills/', 'q=tax&state=ex')
+        self.assertEqual(self.key('/api/bills/', 'state=ex&q=tax'), key)
+        self.assertEqual(self.key('/api/bills/',
+                                  'apikey=secret&state=ex&q=tax'), key)
+        self.assertNotEqual(self.key('/api/bills/', 'q=tax&state=ey'), key)
+        self.assertNotEqual(self.key('/api/bills/', 'q=tax&state=ex',
+                                     format='xml'), key)
+        self.assertNotEqual(self.key('/api/legislators/', 'q=tax&state=ex'),
+                            key)
+
+    def test_generation(self):
+        key = self.key('/api/bills/', state='ex')
+        other = self.key('/api/bills/', state='ey')
+
+        self.generations.generations['ex'] = 1
+        self.assertNotEqual(self.key('/api/bills/', state='ex'), key)
+        self.assertEqual(self.key('/api/bills/', state='ey'), other)
+
+    def test_title_index_version(self):
+        key = self.key('/api/bills/', 'q=tax&state=ex')
+        all_key = self.key('/api/bills/', 'q=tax')
+        self.assertEqual(self.titles.asked, ['ex', None])
+
+        # a reloaded title index changes the keys of its state's
+        # searches even though the generation hasn't changed
+        self.titles.versions['ex'] = 1
+        self.assertNotEqual(self.key('/api/bills/', 'q=tax&state=ex'), key)
+        self.assertEqual(self.key('/api/bills/', 'q=tax'), all_key)
+
+        self.titles.versions[None] = 1
+        self.assertNotEqual(self.key('/api/bills/', 'q=tax'), all_key)
+
+
+@requires_django
+class ResponseCacheStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.local = cache.LRUCache()
+        self.shared = cache.LRUCache()
+        self.cache = cache.ResponseCache(self.local, self.shared,
+                                         max_item_size=10,
+                                         generations=FakeGenerations(),
+                                         title_index=FakeTitleIndex())
+
+    def test_tee(self):
+        resp = HttpResponse(iter(['abc', 'def']), mimetype='text/plain')
+        stored = self.cache.store('key', resp)
+
+        # nothing is cached until the body has been sent
+        self.assertEqual(self.local.get('key'), None)
+        self.assertEqual(''.join(stored), 'abcdef')
+
+        status, headers, body = self.local.get('key')
+        self.assertEqual((status, body), (200, 'abcdef'))
+        self.assertTrue(('Content-Type', 'text/plain') in headers)
+        self.assertEqual(self.shared.get('key'), (status, headers, body))
+
+        cached = self.cache.get('key')
+        self.assertEqual(cached.content, 'abcdef')
+        self.assertEqual(cached['Content-Type'], 'text/plain')
+
+    def test_tee_too_large(self):
+        resp = HttpResponse(iter(['abcdef', 'ghijkl']))
+        self.assertEqual(''.join(self.cache.store('key', resp)),
+                         'abcdefghijkl')
+        self.assertEqual(self.local.get('key'), None)
+        self.assertEqual(self.shared.get('key'), None)
+
+    def test_errors_not_cached(self):
+        resp = HttpResponse('missing', status=404)
+        self.assertTrue(self.cache.store('key', resp) is resp)
+        self.assertEqual(''.join(resp), 'missing')
+        self.assertEqual(self.cache.get('key'), None)
+
+    def test_shared_fills_local(self):
+        self.shared.set('key', (200, [], 'abc'))
+        self.assertEqual(self.cache.get('key').content, 'abc')
+        self.assertEqual(self.local.get('key'), (200, [], 'abc'))
+
+
+if __name__ == '__main__':
+    unittest.main()
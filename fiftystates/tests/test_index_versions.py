@@ -0,0 +1,145 @@
+from __future__ import with_statement
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler
+from xml.etree import ElementTree
+
+from fiftystates.tests import db, requires_mongo, reset_db, StubServer
+
+
+class FakeSolr(BaseHTTPRequestHandler):
+    """
+    Records the bodies posted to /solr/update, failing any that add one
+    of the server's ``fail_ids``.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.posts.append((self.path, body))
+
+        if any('>%s<' % id in body for id in self.server.fail_ids):
+            self.send_response(500)
+        else:
+            self.send_response(200)
+        self.end_headers()
+        self.wfile.write('<response/>')
+
+    def log_message(self, *args):
+        pass
+
+
+def added_ids(body):
+    return [field.text for field in ElementTree.fromstring(body).findall(
+            'doc/field') if field.get('name') == 'id']
+
+
+@requires_mongo
+class SolrIndexerTest(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        self.ids = ['EXD%06d' % i for i in xrange(1, 8)]
+        db.bills.save({'_id': 'EXB000001', 'state': 'ex', 'session': '2010',
+                       'chamber': 'upper', 'bill_id': 'SB 1',
+                       'title': 'An act',
+                       'versions': [{'name': 'Version %s' % id,
+                                     'url': 'http://example.com/%s' % id,
+                                     'document_id': id}
+                                    for id in self.ids]})
+        for id in self.ids:
+            db.document_text.save({'_id': id, 'state': 'ex',
+                                   'text': 'text of %s' % id})
+
+        self.solr = StubServer(FakeSolr)
+        self.solr.lock = threading.Lock()
+        self.solr.posts = []
+        self.solr.fail_ids = []
+
+    def tearDown(self):
+        self.solr.close()
+
+    def index(self, resume=True, **kwargs):
+        from fiftystates.search.index_versions import SolrIndexer
+        indexer = SolrIndexer(self.solr.url('/solr'), **kwargs)
+        return indexer.index_state('ex', resume)
+
+    def adds(self):
+        return [body for path, body in self.solr.posts
+                if body.startswith('<add')]
+
+    def test_batches_and_commit(self):
+        self.assertEqual(self.index(batch_size=3, commit_within=5000), 7)
+
+        paths = set(path for path, body in self.solr.posts)
+        self.assertEqual(paths, set(['/solr/update']))
+
+        adds = self.adds()
+        self.assertEqual(sorted(len(added_ids(body)) for body in adds),
+                         [1, 3, 3])
+        for body in adds:
+            self.assertEqual(ElementTree.fromstring(body).get(
+                    'commitWithin'), '5000')
+        self.assertEqual(sorted(sum(map(added_ids, adds), [])), self.ids)
+
+        # committed once, after every batch
+        self.assertEqual(self.solr.posts[-1][1], '<commit/>')
+        self.assertEqual(len(self.solr.posts), len(adds) + 1)
+
+        indexed = db.search_index.versions.find({'state': 'ex'})
+        self.assertEqual(sorted(doc['_id'] for doc in indexed), self.ids)
+
+    def test_no_commit_within(self):
+        self.index(batch_size=10)
+        self.assertEqual(ElementTree.fromstring(self.adds()[0]).get(
+                'commitWithin'), None)
+
+    def test_resume(self):
+        # the third of four batches fails, so only it is posted again
+        self.solr.fail_ids = [self.ids[4]]
+        self.assertEqual(self.index(batch_size=2, workers=1), 5)
+
+        self.solr.fail_ids = []
+        self.solr.posts = []
+        self.assertEqual(self.index(batch_size=2, workers=1), 2)
+        self.assertEqual(sum(map(added_ids, self.adds()), []),
+                         self.ids[4:6])
+
+        self.solr.posts = []
+        self.assertEqual(self.index(batch_size=2, workers=1), 0)
+        self.assertEqual(self.adds(), [])
+
+        # unless told not to resume
+        self.solr.posts = []
+        self.assertEqual(self.index(batch_size=2, workers=1, resume=False),
+                         7)
+        self.assertEqual(sum(map(added_ids, self.adds()), []), self.ids)
+
+    def test_out_of_order_versions(self):
+        # a version whose download finished late (so its text is
+        # extracted after versions with larger ids were indexed) is
+        # still indexed by the next run
+        db.document_text.remove({'_id': self.ids[2]})
+        self.assertEqual(self.index(batch_size=3), 6)
+        self.assertFalse(self.ids[2] in sum(map(added_ids, self.adds()), []))
+
+        db.document_text.save({'_id': self.ids[2], 'state': 'ex',
+                               'text': 'text of %s' % self.ids[2]})
+        self.solr.posts = []
+        self.assertEqual(self.index(batch_size=3), 1)
+        self.assertEqual(sum(map(added_ids, self.adds()), []),
+                         [self.ids[2]])
+
+    def test_changed_files(self):
+        self.index()
+
+        # re-extracted from a changed file
+        db.document_text.update({'_id': self.ids[1]},
+                                {'$set': {'sha256': 'changed',
+                                          'text': 'new text'}})
+        self.solr.posts = []
+        self.assertEqual(self.index(), 1)
+        self.assertEqual(sum(map(added_ids, self.adds()), []),
+                         [self.ids[1]])
+        self.assertTrue('new text' in self.adds()[0])
+        self.assertFalse('_sha256' in self.adds()[0])
@@ -0,0 +1,85 @@
+import unittest
+
+from pymongo.errors import ConnectionFailure
+
+try:
+    from fiftystates.backend.names import NameMatcher
+except (ImportError, ConnectionFailure):
+    NameMatcher = None
+
+requires_names = unittest.skipIf(NameMatcher is None,
+                                 'fiftystates.backend.names is unavailable')
+
+
+def person(first, last, middle=''):
+    return {'full_name': '%s %s' % (first, last), 'first_name': first,
+            'last_name': last, 'middle_name': middle}
+
+
+@requires_names
+class FuzzyMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = NameMatcher()
+        self.matcher[person(u'Dawnna', u'Dukes')] = 1
+        self.matcher[person(u'Veronica', u'Gonz\xe1lez-Toureilles')] = 2
+        self.matcher[person(u'Craig', u'Eiland')] = 3
+
+    def test_exact(self):
+        self.assertEqual(self.matcher.fuzzy_get('Dukes'), 1)
+        self.assertEqual(self.matcher.fuzzy_get('Eiland, C.'), 3)
+        self.assertEqual(self.matcher.fuzzy_get(' craig eiland '), 3)
+
+    def test_near_miss(self):
+        self.assertEqual(self.matcher['Gonzalez Toureilles'], None)
+        self.assertEqual(self.matcher.fuzzy_get('Gonzalez Toureilles'), 2)
+        self.assertEqual(self.matcher.fuzzy_get('Dukes, Dawnna Jr.'), 1)
+        self.assertEqual(self.matcher.fuzzy_get('Eilend'), 3)
+
+    def test_too_far(self):
+        self.assertEqual(self.matcher.fuzzy_get('Smith'), None)
+        self.assertEqual(self.matcher.fuzzy_get('Dorothy'), None)
+
+    def test_ambiguous_exact_match(self):
+        self.matcher[person(u'Dan', u'Duke')] = 4
+        self.matcher[person(u'Don', u'Duke')] = 5
+
+        # 'Duke' names two people, so it doesn't fall through to the
+        # fuzzy tier (where it could match 'Dukes' or one of them)
+        self.assertEqual(self.matcher['Duke'], None)
+        self.assertEqual(self.matcher.fuzzy_get('Duke'), None)
+        self.assertEqual(self.matcher._fuzzy_index, None)
+        self.assertEqual(self.matcher._fuzzy_cache, {})
+
+        self.assertEqual(self.matcher.fuzzy_get('Duke, Dan'), 4)
+        self.assertEqual(self.matcher.resolve_many(['Duke', 'Dukes'], True),
+                         {'Duke': None, 'Dukes': 1})
+
+    def test_ambiguous_fuzzy_match(self):
+        self.matcher[person(u'Dawnna', u'Dukas')] = 4
+        self.assertEqual(self.matcher.fuzzy_get('Dawnna Dukos'), None)
+
+    def test_miss_cache(self):
+        self.assertEqual(self.matcher.fuzzy_get('Eilend'), 3)
+        self.assertEqual(self.matcher.fuzzy_get('Smith'), None)
+        self.assertEqual(self.matcher._fuzzy_cache,
+                         {'Eilend': 3, 'Smith': None})
+
+        # exact matches aren't cached
+        self.matcher.fuzzy_get('Dukes')
+        self.assertFalse('Dukes' in self.matcher._fuzzy_cache)
+
+        # cached results are used without consulting the index
+        self.matcher._fuzzy_cache['Smith'] = 1
+        self.assertEqual(self.matcher.fuzzy_get('Smith'), 1)
+
+        # adding a name drops the cache and the index
+        self.matcher[person(u'Wayne', u'Smith')] = 5
+        self.assertEqual(self.matcher._fuzzy_cache, {})
+        self.assertEqual(self.matcher._fuzzy_index, None)
+        self.assertEqual(self.matcher.fuzzy_get('Smith'), 5)
+        self.assertEqual(self.matcher.fuzzy_get('Smithe'), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import copy
+import unittest
+
+from pymongo.errors import ConnectionFailure
+
+try:
+    from fiftystates.backend.utils import (prepare_obj, compile_transformer,
+                                           convert_timestamps, split_name,
+                                           make_plus_fields,
+                                           timestamp_to_dt)
+except ConnectionFailure:
+    prepare_obj = None
+
+requires_backend = unittest.skipIf(prepare_obj is None,
+                                   'no MongoDB server available')
+
+TS = 1280000000
+
+
+def three_pass(obj):
+    """
+    How objects were prepared before prepare_obj used compiled
+    transformers.
+    """
+    convert_timestamps(obj)
+    split_name(obj)
+    return make_plus_fields(obj)
+
+
+def source():
+    return {'url': 'http://example.com/', 'retrieved': TS, 'note': 'x'}
+
+
+SAMPLES = [
+    {'_type': 'bill', 'state': 'ex', 'session': '2010', 'chamber': 'lower',
+     'bill_id': 'HB 1', 'title': 'A bill', 'type': ['bill'],
+     'sources': [source()], 'extra': 'field', '_internal': 1,
+     'sponsors': [{'type': 'primary', 'name': 'Smith', 'party': 'X'}],
+     'versions': [{'name': 'Introduced', 'url': 'http://example.com/v1',
+                   'mimetype': 'text/html'}],
+     'actions': [{'date': TS, 'actor': 'lower', 'action': 'Introduced',
+                  'type': ['bill:introduced'], 'extra': 1},
+                 {'date': TS + 1, 'actor': 'lower', 'action': 'Read',
+                  'type': ['other']}],
+     'votes': [{'date': TS, 'chamber': 'lower', 'motion': 'Passage',
+                'passed': True, 'yes_count': 1, 'no_count': 0,
+                'other_count': 0, 'yes_votes': ['Smith'], 'no_votes': [],
+                'other_votes': [], 'sources': [source()],
+                'threshold': '1/2'}]},
+    {'_type': 'person', 'state': 'ex', 'full_name': 'Jane Smith',
+     'first_name': 'Jane', 'last_name': 'Smith', 'sources': [source()],
+     'roles': [{'type': 'member', 'chamber': 'upper', 'district': '1',
+                'term': '2009-2010', 'start_date': TS, 'end_date': None,
+                'party': 'Democrat'}],
+     'photo_url': 'http://example.com/jane.jpg'},
+    {'_type': 'person', 'full_name': 'John Doe', 'first_name': 'John',
+     'last_name': 'Doe', 'roles': []},
+    {'_type': 'committee', 'state': 'ex', 'chamber': 'upper',
+     'committee': 'Finance', 'subcommittee': None, 'sources': [source()],
+     'members': [{'legislator': 'Jane Smith', 'role': 'chair',
+                  'extra': True}]},
+    {'_type': 'event', 'state': 'ex', 'session': '2010', 'type': 'committee',
+     'description': 'Hearing', 'when': TS, 'end': TS + 3600,
+     'location': 'Room 1', 'sources': [source()],
+     'participants': [{'type': 'host', 'participant': 'Finance'}],
+     'link': 'http://example.com/event'},
+    {'_type': 'vote', 'state': 'ex', 'session': '2010', 'chamber': 'lower',
+     'bill_id': 'HB 1', 'bill_chamber': 'lower', 'date': TS,
+     'motion': 'Passage', 'passed': False, 'yes_count': 0, 'no_count': 1,
+     'other_count': 0, 'yes_votes': [], 'no_votes': ['Smith'],
+     'other_votes': [], 'sources': [source()], 'type': 'passage'},
+    {'_type': 'metadata', 'abbreviation': 'ex', 'name': 'Example',
+     'session_details': {'2010': {'start_date': TS, 'type': 'primary'}},
+     'terms': [{'name': '2009-2010', 'sessions': ['2010']}],
+     'lower_chamber_name': 'House', 'nickname': 'Sample State'},
+    {'_type': 'unknown', 'state': 'ex', 'date': TS, 'name': 'x',
+     'actions': [{'date': TS}]},
+]
+
+
+@requires_backend
+class PrepareObjTest(unittest.TestCase):
+
+    def test_matches_three_pass(self):
+        for sample in SAMPLES:
+            self.assertEqual(prepare_obj(copy.deepcopy(sample)),
+                             three_pass(copy.deepcopy(sample)),
+                             'prepared %s differs' % sample['_type'])
+
+    def test_roles_without_state(self):
+        obj = prepare_obj({'_type': 'person', 'full_name': 'John Doe',
+                           'first_name': 'John', 'last_name': 'Doe',
+                           'roles': []})
+        self.assertEqual(obj['roles'], [])
+
+    def test_compiled_transformer(self):
+        transform = compile_transformer({'date': None,
+                                         'items': {'name': None}})
+        obj = transform({'date': TS, 'other': 1, '_private': 2,
+                         'items': [{'name': 'a', 'extra': 'b'}]})
+        self.assertEqual(obj['date'], timestamp_to_dt(TS))
+        self.assertEqual(obj['+other'], 1)
+        self.assertEqual(obj['_private'], 2)
+        self.assertEqual(obj['items'], [{'name': 'a', '+extra': 'b'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+from __future__ import with_statement
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from fiftystates.tests import db, requires_mongo, reset_db
+
+
+def legislator(name, district):
+    first, last = name.split()
+    return {'_type': 'person', 'state': 'ex', 'full_name': name,
+            'first_name': first, 'last_name': last, 'middle_name': '',
+            'suffixes': '', 'sources': [],
+            'roles': [{'role': 'member', 'state': 'ex',
+                       'term': '2009-2010', 'chamber': 'upper',
+                       'district': district, 'party': 'Independent',
+                       'start_date': None, 'end_date': None}]}
+
+
+@requires_mongo
+class PruneTest(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        db.metadata.save({'_id': 'ex',
+                          'terms': [{'name': '2009-2010',
+                                     'sessions': ['2009']}]})
+        self.data_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.data_dir, 'ex', 'legislators'))
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def write(self, filename, obj):
+        path = os.path.join(self.data_dir, 'ex', 'legislators', filename)
+        with open(path, 'w') as f:
+            json.dump(obj, f)
+        return path
+
+    def import_legislators(self, prune):
+        from fiftystates.backend.legislators import import_legislators
+        import_legislators('ex', self.data_dir, prune)
+
+    def test_prune_leaves_tombstones(self):
+        self.write('a.json', legislator('Ann Smith', '1'))
+        gone = self.write('b.json', legislator('Bob Jones', '2'))
+        self.import_legislators(prune=True)
+        self.assertEqual(db.legislators.find().count(), 2)
+        bob = db.legislators.find_one({'full_name': 'Bob Jones'})
+
+        os.remove(gone)
+        self.import_legislators(prune=False)
+        self.assertEqual(db.legislators.find().count(), 2)
+        self.assertEqual(db.tombstones.find().count(), 0)
+
+        self.import_legislators(prune=True)
+        self.assertEqual([l['full_name'] for l in db.legislators.find()],
+                         ['Ann Smith'])
+
+        tombstone = db.tombstones.find_one()
+        self.assertEqual(tombstone['_id'], bob['_id'])
+        self.assertEqual(tombstone['type'], 'legislators')
+        self.assertEqual(tombstone['state'], 'ex')
+        self.assertTrue(tombstone['updated_at'] >= bob['updated_at'])
+
+    def test_empty_scrape_prunes_nothing(self):
+        path = self.write('a.json', legislator('Ann Smith', '1'))
+        self.import_legislators(prune=True)
+
+        os.remove(path)
+        self.import_legislators(prune=True)
+        self.assertEqual(db.legislators.find().count(), 1)
+        self.assertEqual(db.tombstones.find().count(), 0)
@@ -0,0 +1,185 @@
+import datetime
+import unittest
+from collections import defaultdict
+
+from pymongo.errors import ConnectionFailure
+
+try:
+    from fiftystates.backend import utils, pipeline
+except ConnectionFailure:
+    utils = pipeline = None
+
+requires_backend = unittest.skipIf(utils is None,
+                                   'no MongoDB server available')
+
+
+class FakeCollection(object):
+    """
+    Records the updates made through it.
+    """
+
+    def __init__(self):
+        self.updates = []
+
+    def update(self, spec, document, **kwargs):
+        self.updates.append((spec, document))
+
+
+def diff(old, new):
+    result = {'$set': {}, '$unset': {}, '$pushAll': {}}
+    utils._diff(old, new, 'obj', result)
+    return dict((op, fields) for op, fields in result.iteritems() if fields)
+
+
+@requires_backend
+class DiffTest(unittest.TestCase):
+
+    def test_fields(self):
+        self.assertEqual(diff({'a': 1, 'b': 2, 'c': 3},
+                              {'a': 1, 'b': 4, 'd': 5}),
+                         {'$set': {'obj.b': 4, 'obj.d': 5},
+                          '$unset': {'obj.c': 1}})
+
+    def test_nested(self):
+        self.assertEqual(diff({'a': {'b': {'c': 1, 'd': 2}}},
+                              {'a': {'b': {'c': 1, 'd': 3}}}),
+                         {'$set': {'obj.a.b.d': 3}})
+
+    def test_appended(self):
+        self.assertEqual(diff({'a': [1, 2]}, {'a': [1, 2, 3, 4]}),
+                         {'$pushAll': {'obj.a': [3, 4]}})
+
+        # a changed prefix can't be pushed onto
+        self.assertEqual(diff({'a': [1, 2]}, {'a': [1, 5, 3]}),
+                         {'$set': {'obj.a': [1, 5, 3]}})
+
+    def test_list_elements(self):
+        old = {'a': [{'x': 1}, {'x': 2}, {'x': 3}]}
+        new = {'a': [{'x': 1}, {'x': 5}, {'x': 3}]}
+        self.assertEqual(diff(old, new), {'$set': {'obj.a.1.x': 5}})
+
+        # most elements changed, so the list is replaced
+        new = {'a': [{'x': 4}, {'x': 5}, {'x': 3}]}
+        self.assertEqual(diff(old, new), {'$set': {'obj.a': new['a']}})
+
+    def test_replaced(self):
+        self.assertEqual(diff({'a': [1, 2]}, {'a': [1]}),
+                         {'$set': {'obj.a': [1]}})
+        self.assertEqual(diff({'a': []}, {'a': [1]}),
+                         {'$set': {'obj.a': [1]}})
+        self.assertEqual(diff({'a': 'x'}, {'a': {'b': 1}}),
+                         {'$set': {'obj.a': {'b': 1}}})
+
+
+@requires_backend
+class UpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.coll = FakeCollection()
+
+    def test_changed_fields(self):
+        old = {'_id': 'EXB1', 'title': 'A bill', '+extra': 1,
+               'actions': [{'action': 'Introduced'}], 'gone': 1}
+        new = {'title': 'The bill', 'extra': 1,
+               'actions': [{'action': 'Introduced'}, {'action': 'Read'}]}
+
+        self.assertTrue(utils.update(old, new, self.coll))
+        self.assertEqual(len(self.coll.updates), 1)
+
+        spec, document = self.coll.updates[0]
+        self.assertEqual(spec, {'_id': 'EXB1'})
+        self.assertEqual(document['$unset'], {'+extra': 1})
+        self.assertEqual(document['$pushAll'],
+                         {'actions': [{'action': 'Read'}]})
+        self.assertEqual(sorted(document['$set']),
+                         ['extra', 'title', 'updated_at'])
+        self.assertTrue(isinstance(document['$set']['updated_at'],
+                                   datetime.datetime))
+
+        # fields missing from the new object are kept
+        self.assertEqual(old['gone'], 1)
+        self.assertEqual(old['title'], 'The bill')
+        self.assertFalse('+extra' in old)
+
+    def test_unchanged(self):
+        old = {'_id': 'EXB1', 'title': 'A bill', 'votes': [{'motion': 'x'}]}
+
+        # an empty votes list doesn't replace the standalone votes
+        self.assertFalse(utils.update(old, {'title': 'A bill', 'votes': []},
+                                      self.coll))
+        self.assertEqual(self.coll.updates, [])
+        self.assertEqual(old['votes'], [{'motion': 'x'}])
+
+    def test_content_hash(self):
+        old = {'_id': 'EXB1', 'title': 'A bill', '_content_hash': 'a'}
+
+        # a new hash alone is written, but isn't a change
+        self.assertFalse(utils.update(old, {'title': 'A bill',
+                                            '_content_hash': 'b'},
+                                      self.coll))
+        self.assertEqual(self.coll.updates,
+                         [({'_id': 'EXB1'},
+                           {'$set': {'_content_hash': 'b'}})])
+
+    def test_derived_fields(self):
+        old = {'_id': 'EXL1', 'last_name': 'Smith',
+               '_norm': {'last_name': 'smith'},
+               'roles': [{'district': '1', '_norm': {'district': '1'}}]}
+        new = {'last_name': 'Smith', 'roles': [{'district': '1'}]}
+
+        self.assertFalse(utils.update(old, new, self.coll))
+        self.assertEqual(self.coll.updates, [])
+        self.assertEqual(old['_norm'], {'last_name': 'smith'})
+
+
+@requires_backend
+class NormalizeTest(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(utils.normalize(' Lower '), 'lower')
+        self.assertEqual(utils.normalize(u'\xc9COLE'), u'\xe9cole')
+        self.assertEqual(utils.normalize(5), 5)
+        self.assertEqual(utils.normalize(None), None)
+
+    def test_norm_fields(self):
+        obj = {'last_name': 'Smith', 'party': ' Democrat', 'district': None,
+               'chamber': 'upper'}
+        self.assertEqual(utils.norm_fields(obj, ('last_name', 'party',
+                                                 'district', 'missing')),
+                         {'last_name': 'smith', 'party': 'democrat'})
+
+
+@requires_backend
+class PipelineTest(unittest.TestCase):
+
+    def test_batched(self):
+        self.assertEqual(list(pipeline.batched(xrange(7), 3)),
+                         [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(pipeline.batched(xrange(6), 3)),
+                         [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(list(pipeline.batched([], 3)), [])
+
+    def test_skip_unchanged(self):
+        objs = [{'_content_hash': 'a'}, {'_content_hash': 'b'}, {},
+                {'_content_hash': 'c'}]
+        counts = defaultdict(int)
+        seen = set()
+
+        kept = list(pipeline.skip_unchanged(objs, set(['a', 'c']), counts,
+                                            seen))
+        self.assertEqual(kept, [{'_content_hash': 'b'}, {}])
+        self.assertEqual(counts['skipped'], 2)
+        self.assertEqual(seen, set(['a', 'b', 'c', None]))
+
+        # seen is optional
+        kept = list(pipeline.skip_unchanged(objs, set(), counts))
+        self.assertEqual(kept, objs)
+
+    def test_format_counts(self):
+        counts = defaultdict(int, inserted=2, skipped=1)
+        self.assertEqual(pipeline.format_counts(counts),
+                         '2 inserted, 0 updated, 0 unchanged, 1 skipped')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+from __future__ import with_statement
+import time
+import urllib2
+import urlparse
+import threading
+import unittest
+from collections import defaultdict
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from fiftystates.tests import db, requires_mongo, reset_db, StubServer
+
+
+class FakeSite(BaseHTTPRequestHandler):
+    """
+    Serves bill versions for any host, acting as the fetcher's proxy.
+
+    /missing is a 404, /flaky fails with a 503 while the server has
+    ``flaky_failures`` left, and anything else is a document with an
+    ETag that answers a matching If-None-Match with a 304.
+    """
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        server = self.server
+        host = self.headers['Host']
+        path = urlparse.urlparse(self.path)[2]
+        etag = '"%s%s"' % (host, path)
+
+        with server.lock:
+            server.requests.append((host, path, dict(self.headers)))
+            server.started[host].append(time.time())
+            server.active[host] += 1
+            server.max_active[host] = max(server.max_active[host],
+                                          server.active[host])
+        try:
+            time.sleep(server.delay)
+
+            if path == '/missing':
+                self.send_response(404)
+                self.end_headers()
+                return
+            elif path == '/flaky':
+                with server.lock:
+                    server.flaky_failures -= 1
+                    failing = server.flaky_failures >= 0
+                if failing:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            body = 'content of %s%s' % (host, path)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active[host] -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@requires_mongo
+class VersionFetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        reset_db()
+        db.doc_ids.save({'_id': 'ex', 'seq': 0})
+
+        self.site = StubServer(FakeSite)
+        self.site.lock = threading.Lock()
+        self.site.requests = []
+        self.site.started = defaultdict(list)
+        self.site.active = defaultdict(int)
+        self.site.max_active = defaultdict(int)
+        self.site.delay = 0
+        self.site.flaky_failures = 0
+
+        # real-looking URLs, all sent to the stub through a proxy
+        self.opener = urllib2.build_opener(
+            urllib2.ProxyHandler({'http': self.site.url()}))
+
+    def tearDown(self):
+        self.site.close()
+
+    def add_bill(self, bill_id, urls):
+        id = 'EXB%06d' % (db.bills.find().count() + 1)
+        db.bills.save({'_id': id, 'state': 'ex', 'chamber': 'upper',
+                       'session': '2010', 'bill_id': bill_id,
+                       'title': 'An act',
+                       'versions': [{'name': 'Version %d' % i, 'url': url}
+                                    for i, url in enumerate(urls)]})
+        return id
+
+    def fetch(self, **kwargs):
+        from fiftystates.backend.versions import VersionFetcher
+        kwargs.setdefault('rpm', 0)
+        kwargs.setdefault('backoff', 0.01)
+        fetcher = VersionFetcher(opener=self.opener, **kwargs)
+        return fetcher.fetch_state('ex')
+
+    def document_ids(self, bill):
+        return [version.get('document_id') for version in
+                db.bills.find_one({'_id': bill})['versions']]
+
+    def content(self, doc_id):
+        from fiftystates.backend.utils import get_document
+        return get_document(doc_id)[0].read()
+
+    def requests_for(self, path):
+        return [r for r in self.site.requests if r[1] == path]
+
+    def test_retries(self):
+        self.site.flaky_failures = 2
+        bill = self.add_bill('SB 1', ['http://a.example.com/flaky',
+                                      'http://a.example.com/missing'])
+
+        stats = self.fetch(retries=3)
+        self.assertEqual((stats.documents, stats.failures), (1, 1))
+
+        # 5xx responses are retried, 4xx responses aren't
+        self.assertEqual(len(self.requests_for('/flaky')), 3)
+        self.assertEqual(len(self.requests_for('/missing')), 1)
+
+        flaky, missing = self.document_ids(bill)
+        self.assertEqual(self.content(flaky),
+                         'content of a.example.com/flaky')
+        self.assertEqual(missing, None)
+
+    def test_gives_up_after_retries(self):
+        self.site.flaky_failures = 5
+        bill = self.add_bill('SB 1', ['http://a.example.com/flaky'])
+
+        stats = self.fetch(retries=2)
+        self.assertEqual((stats.documents, stats.failures), (0, 1))
+        self.assertEqual(len(self.requests_for('/flaky')), 3)
+        self.assertEqual(self.document_ids(bill), [None])
+
+    def test_conditional_get(self):
+        url = 'http://a.example.com/bill.html'
+        first = self.add_bill('SB 1', [url])
+        self.fetch()
+        self.assertFalse('if-none-match' in self.site.requests[0][2])
+
+        second = self.add_bill('SB 2', [url])
+        stats = self.fetch()
+        self.assertEqual(stats.unchanged, 1)
+        self.assertEqual(self.site.requests[-1][2].get('if-none-match'),
+                         '"a.example.com/bill.html"')
+
+        # the 304 reused the stored file under the new id
+        [first_id], [second_id] = (self.document_ids(first),
+                                   self.document_ids(second))
+        self.assertNotEqual(first_id, second_id)
+        self.assertEqual(self.content(second_id),
+                         'content of a.example.com/bill.html')
+        self.assertEqual(db.documents.files.find().count(), 1)
+
+    def test_repeated_url(self):
+        url = 'http://a.example.com/bill.html'
+        bill = self.add_bill('SB 1', [url, 'http://a.example.com/x', url])
+
+        self.assertEqual(self.fetch().documents, 3)
+        ids = self.document_ids(bill)
+        self.assertTrue(None not in ids)
+        self.assertEqual(self.fetch().documents, 0)
+
+    def test_per_host_concurrency(self):
+        self.site.delay = 0.1
+        for host in ('a.example.com', 'b.example.com'):
+            self.add_bill('SB %s' % host, ['http://%s/%d' % (host, i)
+                                           for i in xrange(3)])
+
+        self.assertEqual(self.fetch(workers=4).documents, 6)
+        self.assertEqual(dict(self.site.max_active),
+                         {'a.example.com': 1, 'b.example.com': 1})
+
+        self.site.max_active.clear()
+        db.bills.update({}, {'$unset': {'versions.0.document_id': 1,
+                                        'versions.1.document_id': 1,
+                                        'versions.2.document_id': 1}},
+                        multi=True)
+        self.fetch(workers=4, per_host=2)
+        self.assertEqual(dict(self.site.max_active),
+                         {'a.example.com': 2, 'b.example.com': 2})
+
+    def test_per_host_rate(self):
+        for host in ('a.example.com', 'b.example.com'):
+            self.add_bill('SB %s' % host, ['http://%s/%d' % (host, i)
+                                           for i in xrange(3)])
+
+        # at most one request every 0.2s to each host
+        self.fetch(workers=4, rpm=300)
+        for host, started in self.site.started.iteritems():
+            gaps = [b - a for a, b in zip(started, started[1:])]
+            self.assertTrue(min(gaps) >= 0.19, (host, gaps))
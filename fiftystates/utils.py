@@ -1,4 +1,7 @@
+from __future__ import with_statement
 import re
+import threading
+
 import jellyfish
 
 # Adapted from NLTK's english stopwords
@@ -25,16 +28,99 @@ stop_words = [
     'now', '']
 
 
+_split_re = re.compile(r"[\s.,!?'\"`()]+")
+
+
 def tokenize(str):
-    return re.split(r"[\s.,!?'\"`()]+", str)
+    return _split_re.split(str)
+
+
+class Analyzer(object):
+    """
+    Turns strings into sets of stemmed keywords.
+
+    Titles repeat the same vocabulary constantly, so the outcome for
+    each distinct token (its stem, or None if it is dropped) is cached.
+    The cache holds at most ``cache_size`` tokens and evicts the least
+    recently used ones in bulk: it is split into a current and a previous
+    generation, a hit in the previous generation moves the token to the
+    current one, and when the current generation fills up the previous
+    one is discarded. Hits on the current generation cost one dict
+    lookup.
+    """
+
+    def __init__(self, stop_words=stop_words, stem=jellyfish.porter_stem,
+                 cache_size=20000):
+        self.stop_words = frozenset(stop_words)
+        self.stem = stem
+        self.cache_size = cache_size
+        self._cache = {}
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    def _analyze(self, word):
+        if not (word.isalpha() or word.isdigit()):
+            return None
+
+        word = word.lower()
+        if word in self.stop_words:
+            return None
+
+        return self.stem(word.encode('ascii', 'ignore'))
+
+    def _keywords(self, str):
+        # must be called with self._lock held
+        cache = self._cache
+        keywords = set()
+
+        for word in _split_re.split(str):
+            try:
+                stem = cache[word]
+            except KeyError:
+                try:
+                    stem = self._previous[word]
+                except KeyError:
+                    stem = self._analyze(word)
+
+                if len(cache) >= self.cache_size // 2:
+                    self._previous = cache
+                    cache = self._cache = {}
+                cache[word] = stem
+
+            if stem is not None:
+                keywords.add(stem)
+
+        return keywords
+
+    def keywordize(self, str):
+        """
+        Splits a string into words, removes common stopwords, stems and
+        removes duplicates.
+        """
+        with self._lock:
+            return self._keywords(str)
+
+    def keywordize_many(self, strs):
+        """
+        Return the keyword set of each of ``strs``, in order.
+        """
+        with self._lock:
+            return [self._keywords(str) for str in strs]
+
+
+analyzer = Analyzer()
+
 
 def keywordize(str):
     """
     Splits a string into words, removes common stopwords, stems and removes
     duplicates.
     """
-    return set([jellyfish.porter_stem(word.lower().encode('ascii',
-                                                          'ignore'))
-                for word in tokenize(str)
-                if (word.isalpha() or word.isdigit()) and
-                word.lower() not in stop_words])
+    return analyzer.keywordize(str)
+
+
+def keywordize_many(strs):
+    """
+    Return the keyword set of each of ``strs``, in order.
+    """
+    return analyzer.keywordize_many(strs)